@@ -304,6 +304,8 @@ void connection_throttle_io_out_timeout_cb(struct ev_loop *loop, struct ev_timer
 void connection_throttle_reset(struct connection_throttle *thr);
 
 void connection_send(struct connection *con, const void *data, uint32_t size);
+void connection_send_queue(struct connection *con, const void *data, uint32_t size);
+void connection_send_flush(struct connection *con);
 void connection_send_string(struct connection *con, const char *str);
 
 void connection_set_type(struct connection *con, enum connection_type type);
@@ -211,6 +211,14 @@ static void check_run_count(void)
 					{
 						g_warning("DOWNLOAD FAIL: %s => (%d) %s", eff_url, msg->data.result, session->error);
 						tempfile_close(session->action.download.file);
+
+						struct incident *i = incident_new("dionaea.download.failed");
+						incident_value_string_set(i, "url", g_string_new(session->url));
+						if( session->action.download.ctxcon )
+							incident_value_con_set(i, "con", session->action.download.ctxcon);
+
+						incident_report(i);
+						incident_free(i);
 					}
 					break;
 
@@ -581,7 +589,7 @@ static void curl_ihandler_cb(struct incident *i, void *ctx)
 {
 	g_debug("%s i %p ctx %p", __PRETTY_FUNCTION__, i, ctx);
 	GString *url;
-	if( strcmp(i->origin, "dionaea.download.offer") == 0 )
+	if( strcmp(i->origin, "dionaea.download.fetch") == 0 )
 	{
 		if( incident_value_bytes_get(i, "url", &url) || incident_value_string_get(i, "url", &url) ) {
 			if( strncasecmp(url->str,  "http", 4) != 0 )
@@ -671,7 +679,7 @@ static bool curl_new(struct dionaea *d)
 		rc = curl_multi_socket_all(curl_runtime.multi, &curl_runtime.active);
 	} while( CURLM_CALL_MULTI_PERFORM == rc );
 
-	curl_runtime.download_ihandler = ihandler_new("dionaea.download.offer", curl_ihandler_cb, NULL);
+	curl_runtime.download_ihandler = ihandler_new("dionaea.download.fetch", curl_ihandler_cb, NULL);
 	curl_runtime.upload_ihandler = ihandler_new("dionaea.upload.request", curl_ihandler_cb, NULL);
 	return true;
 }
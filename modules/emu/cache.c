@@ -0,0 +1,161 @@
+/********************************************************************************
+ *                               Dionaea
+ *                           - catches bugs -
+ *
+ *
+ *
+ * Copyright (C) 2009  Paul Baecher & Markus Koetter
+ * 
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+ * 
+ * 
+ *             contact nepenthesdev@gmail.com  
+ *
+ *******************************************************************************/
+
+
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#include <glib.h>
+#include <ev.h>
+
+#include "module.h"
+
+#define D_LOG_DOMAIN "emu"
+
+/*
+ * LRU cache of detection and profiling results keyed by a checksum of the
+ * tested stream data. Repeated payloads, e.g. of worms, are detected and
+ * profiled once only. The cache is shared by the threads of the pool.
+ */
+
+/* all caches, created while reading the config and freed with the module */
+static GList *emu_caches = NULL;
+
+struct emu_cache_entry
+{
+	char *key;
+	int offset;
+	char *profile;
+};
+
+static void emu_cache_entry_free(struct emu_cache_entry *entry)
+{
+	g_free(entry->key);
+	g_free(entry->profile);
+	g_free(entry);
+}
+
+struct emu_cache *emu_cache_new(unsigned int size)
+{
+	struct emu_cache *cache = g_malloc0(sizeof(struct emu_cache));
+	g_mutex_init(&cache->mutex);
+	cache->size = size;
+	cache->entries = g_hash_table_new(g_str_hash, g_str_equal);
+	cache->lru = g_queue_new();
+	emu_caches = g_list_append(emu_caches, cache);
+	return cache;
+}
+
+void emu_cache_free(struct emu_cache *cache)
+{
+	struct emu_cache_entry *entry;
+	emu_caches = g_list_remove(emu_caches, cache);
+	while( (entry = g_queue_pop_head(cache->lru)) != NULL )
+		emu_cache_entry_free(entry);
+	g_queue_free(cache->lru);
+	g_hash_table_destroy(cache->entries);
+	g_mutex_clear(&cache->mutex);
+	g_free(cache);
+}
+
+bool emu_cache_lookup(struct emu_cache *cache, const char *key, int *offset, char **profile)
+{
+	bool found = false;
+	g_mutex_lock(&cache->mutex);
+	GList *link = g_hash_table_lookup(cache->entries, key);
+	if( link != NULL )
+	{
+		struct emu_cache_entry *entry = link->data;
+		g_queue_unlink(cache->lru, link);
+		g_queue_push_head_link(cache->lru, link);
+		*offset = entry->offset;
+		*profile = g_strdup(entry->profile);
+		cache->hits++;
+		found = true;
+	} else
+		cache->misses++;
+	g_mutex_unlock(&cache->mutex);
+	return found;
+}
+
+void emu_cache_insert(struct emu_cache *cache, const char *key, int offset, const char *profile)
+{
+	g_mutex_lock(&cache->mutex);
+	GList *link = g_hash_table_lookup(cache->entries, key);
+	if( link != NULL )
+	{
+		/* update, e.g. add the profile to a detection result */
+		struct emu_cache_entry *entry = link->data;
+		entry->offset = offset;
+		g_free(entry->profile);
+		entry->profile = g_strdup(profile);
+		g_queue_unlink(cache->lru, link);
+		g_queue_push_head_link(cache->lru, link);
+	} else
+	{
+		struct emu_cache_entry *entry = g_malloc0(sizeof(struct emu_cache_entry));
+		entry->key = g_strdup(key);
+		entry->offset = offset;
+		entry->profile = g_strdup(profile);
+		g_queue_push_head(cache->lru, entry);
+		g_hash_table_insert(cache->entries, entry->key, cache->lru->head);
+
+		while( g_queue_get_length(cache->lru) > cache->size )
+		{
+			entry = g_queue_pop_tail(cache->lru);
+			g_hash_table_remove(cache->entries, entry->key);
+			emu_cache_entry_free(entry);
+		}
+	}
+	g_mutex_unlock(&cache->mutex);
+}
+
+void emu_cache_report(struct emu_cache *cache)
+{
+	g_mutex_lock(&cache->mutex);
+	g_message("emu cache %p: %u entries, %lu hits, %lu misses",
+		cache, g_queue_get_length(cache->lru), cache->hits, cache->misses);
+	g_mutex_unlock(&cache->mutex);
+}
+
+void emu_caches_report(void)
+{
+	for( GList *it = emu_caches; it != NULL; it = it->next )
+		emu_cache_report(it->data);
+}
+
+void emu_caches_free(void)
+{
+	/* the thread pool has been stopped, no detection uses the caches */
+	while( emu_caches != NULL )
+	{
+		struct emu_cache *cache = emu_caches->data;
+		emu_cache_report(cache);
+		emu_cache_free(cache);
+	}
+}
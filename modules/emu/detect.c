@@ -92,6 +92,31 @@ void *proc_emu_ctx_cfg_new(gchar *group_name)
 	if (error != NULL)
 		goto err;
 
+	/* optional, 0 is unlimited */
+	if( g_key_file_has_key(g_dionaea->config, group_name, "config.limits.detect_bytes", NULL) )
+	{
+		conf->limits.detect_bytes = g_key_file_get_integer(g_dionaea->config, group_name, "config.limits.detect_bytes", &error);
+		if (error != NULL)
+			goto err;
+	}
+
+	if( g_key_file_has_key(g_dionaea->config, group_name, "config.limits.detect_cpu", NULL) )
+	{
+		conf->limits.detect_cpu = g_key_file_get_double(g_dionaea->config, group_name, "config.limits.detect_cpu", &error);
+		if (error != NULL)
+			goto err;
+	}
+
+	int cache_size = 1000;
+	if( g_key_file_has_key(g_dionaea->config, group_name, "config.cache.size", NULL) )
+	{
+		cache_size = g_key_file_get_integer(g_dionaea->config, group_name, "config.cache.size", &error);
+		if (error != NULL)
+			goto err;
+	}
+	if( cache_size > 0 )
+		conf->cache = emu_cache_new(cache_size);
+
 	g_debug(
 		" files %i filesize %i sockets %i steps %i idle %f listen %f sustain %f cpu %f ",
 		conf->limits.files,
@@ -103,6 +128,7 @@ void *proc_emu_ctx_cfg_new(gchar *group_name)
 		conf->limits.sustain,
 		conf->limits.cpu
 	);
+	g_debug(" detect_bytes %i detect_cpu %f cache %i", conf->limits.detect_bytes, conf->limits.detect_cpu, cache_size);
 
 //	g_error("STOP");
 	return conf;
@@ -137,6 +163,15 @@ void proc_emu_on_io_in(struct connection *con, struct processor_data *pd)
 {
 	g_debug("%s con %p pd %p", __PRETTY_FUNCTION__, con, pd);
 	struct emu_ctx *ctx = pd->ctx;
+	struct emu_config *conf = ctx->config;
+
+	if( (conf->limits.detect_bytes > 0 && ctx->detect_bytes >= conf->limits.detect_bytes) ||
+		(conf->limits.detect_cpu > 0 && ctx->detect_cpu >= conf->limits.detect_cpu) )
+	{
+		g_debug("detection budget of con %p exhausted (%lu bytes, %f s)", con, ctx->detect_bytes, ctx->detect_cpu);
+		pd->state = processor_done;
+		return;
+	}
 
 	int offset = MAX(ctx->offset-300, 0);
 	void *streamdata = NULL;
@@ -144,14 +179,32 @@ void proc_emu_on_io_in(struct connection *con, struct processor_data *pd)
 	int ret = 0;
 	if( size != -1 )
 	{
-		struct emu *e = emu_new();
+		GTimer *timer = g_timer_new();
+		gchar *key = NULL;
+		char *cached_profile = NULL;
+		bool cached = false;
+
+		if( conf->cache != NULL )
+		{
+			key = g_compute_checksum_for_data(G_CHECKSUM_SHA256, streamdata, size);
+			cached = emu_cache_lookup(conf->cache, key, &ret, &cached_profile);
+		}
+
+		if( cached == false )
+		{
+			struct emu *e = emu_new();
 #if 0
-		emu_cpu_debugflag_set(emu_cpu_get(e), instruction_string);
-		emu_log_level_set(emu_logging_get(e),EMU_LOG_DEBUG);
+			emu_cpu_debugflag_set(emu_cpu_get(e), instruction_string);
+			emu_log_level_set(emu_logging_get(e),EMU_LOG_DEBUG);
 #endif
-		ret = emu_shellcode_test(e, streamdata, size);
-		emu_free(e);
+			ret = emu_shellcode_test(e, streamdata, size);
+			emu_free(e);
+			if( key != NULL && ret < 0 )
+				emu_cache_insert(conf->cache, key, ret, NULL);
+		}
+
 		ctx->offset += size;
+		ctx->detect_bytes += size;
 		if( ret >= 0 )
 		{
 			struct incident *ix = incident_new("dionaea.shellcode.detected");
@@ -160,10 +213,27 @@ void proc_emu_on_io_in(struct connection *con, struct processor_data *pd)
 			g_async_queue_unref(aq);
 			ev_async_send(g_dionaea->loop, &g_dionaea->threads->trigger);
 			g_debug("shellcode found offset %i", ret);
-			profile(ctx->config, con, streamdata, size, ret);
+
+			if( cached_profile != NULL )
+			{
+				g_debug("using cached profile");
+				profile_report(con, g_string_new(cached_profile));
+			} else
+			{
+				/* shellcode which has to be emulated is not cached, it interacts with the connection */
+				char *json = profile(conf, con, streamdata, size, ret);
+				if( key != NULL && json != NULL )
+					emu_cache_insert(conf->cache, key, ret, json);
+				g_free(json);
+			}
 
 			pd->state = processor_done;
 		}
+		g_free(cached_profile);
+		g_free(key);
 		g_free(streamdata);
+
+		ctx->detect_cpu += g_timer_elapsed(timer, NULL);
+		g_timer_destroy(timer);
 	}
 }
@@ -62,12 +62,14 @@ static bool emu_new(struct dionaea *d)
 static bool emu_free(void)
 {
 	g_debug("%s", __PRETTY_FUNCTION__);
+	emu_caches_free();
 	return true;
 }
 
 static bool emu_hup(void)
 {
 	g_debug("%s", __PRETTY_FUNCTION__);
+	emu_caches_report();
 	return true;
 }
 
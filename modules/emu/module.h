@@ -34,8 +34,30 @@ struct emu_ctx
 {
 	struct emu_config *config;
 	int offset;
+	/* bytes tested and cpu time spent in detection for this connection */
+	unsigned long detect_bytes;
+	double detect_cpu;
 };
 
+struct emu_cache
+{
+	GMutex mutex;
+	unsigned int size;
+	/* key -> GList link of lru */
+	GHashTable *entries;
+	GQueue *lru;
+	unsigned long hits;
+	unsigned long misses;
+};
+
+struct emu_cache *emu_cache_new(unsigned int size);
+void emu_cache_free(struct emu_cache *cache);
+bool emu_cache_lookup(struct emu_cache *cache, const char *key, int *offset, char **profile);
+void emu_cache_insert(struct emu_cache *cache, const char *key, int offset, const char *profile);
+void emu_cache_report(struct emu_cache *cache);
+void emu_caches_report(void);
+void emu_caches_free(void);
+
 struct emu_config
 {
 	struct 
@@ -48,7 +70,10 @@ struct emu_config
 		double listen;
 		int steps;
 		double cpu;
+		int detect_bytes;
+		double detect_cpu;
 	}limits;
+	struct emu_cache *cache;
 };
 
 void *proc_emu_ctx_new(void *cfg);
@@ -58,7 +83,8 @@ void proc_emu_on_io_in(struct connection *con, struct processor_data *pd);
 void proc_emu_on_io_out(struct connection *con, struct processor_data *pd);
 
 int run(struct emu *e, struct emu_env *env);
-void profile(struct emu_config *conf, struct connection *con, void *data, unsigned int size, unsigned int offset);
+char *profile(struct emu_config *conf, struct connection *con, void *data, unsigned int size, unsigned int offset);
+void profile_report(struct connection *con, GString *str);
 
 
 
@@ -355,7 +355,24 @@ void json_profile_function_debug(struct emu_profile_function *function, int inde
 
 }
 
-void profile(struct emu_config *conf, struct connection *con, void *data, unsigned int size, unsigned int offset)
+void profile_report(struct connection *con, GString *str)
+{
+	struct incident *i = incident_new("dionaea.module.emu.profile");
+	incident_value_string_set(i, "profile", str);
+	incident_value_con_set(i, "con", con);
+	connection_ref(con);
+	GAsyncQueue *aq = g_async_queue_ref(g_dionaea->threads->cmds);
+	g_async_queue_push(aq, async_cmd_new(async_incident_report, i));
+	g_async_queue_unref(aq);
+	ev_async_send(g_dionaea->loop, &g_dionaea->threads->trigger);
+}
+
+/**
+ * profile the shellcode and report the profile
+ *
+ * @return a copy of the json profile, NULL if the shellcode had to be emulated
+ */
+char *profile(struct emu_config *conf, struct connection *con, void *data, unsigned int size, unsigned int offset)
 {
 	struct emu *e = emu_new();
 	struct emu_env *env = emu_env_new(e);
@@ -370,6 +387,7 @@ void profile(struct emu_config *conf, struct connection *con, void *data, unsign
 	run(e, env);
 
 	bool needemu = false;
+	char *json = NULL;
 
 	struct emu_profile_function *function;
 	for( function = emu_profile_functions_first(env->profile->functions); !emu_profile_functions_istail(function); function = emu_profile_functions_next(function) )
@@ -390,16 +408,11 @@ void profile(struct emu_config *conf, struct connection *con, void *data, unsign
 		GString *str = g_string_new(NULL);
 		json_profile_debug(env->profile, str);
 		//printf("%s", str->str);
-		struct incident *i = incident_new("dionaea.module.emu.profile");
-		incident_value_string_set(i, "profile", str);
-		incident_value_con_set(i, "con", con);
-		connection_ref(con);
-		GAsyncQueue *aq = g_async_queue_ref(g_dionaea->threads->cmds);
-		g_async_queue_push(aq, async_cmd_new(async_incident_report, i));
-		g_async_queue_unref(aq);
-		ev_async_send(g_dionaea->loop, &g_dionaea->threads->trigger);
+		json = g_strdup(str->str);
+		profile_report(con, str);
 	}
 
 	emu_env_free(env);
 	emu_free(e);
+	return json;
 }
@@ -45,6 +45,7 @@ cdef extern from "module.h":
 	cdef object c_pygetifaddrs "pygetifaddrs"(object self, object args)
 	cdef object c_py_config "py_config"(object self, object args)
 	cdef object c_version "pyversion"(object self, object args)
+	cdef object c_resolve "pyresolve"(object self, object args)
 	
 
 #cdef extern from "../../include/dionaea.h":
@@ -61,6 +62,10 @@ cdef class dionaea:
 		return c_pygetifaddrs(<object> None, <object> None)
 	def version(self):
 		return c_version(<object> None, <object> None)
+	def resolve(self, hostname, callback):
+		"""Resolve the IPv4 addresses of hostname without blocking the loop.
+		callback(hostname, addresses) is called with a list of address strings, the list is empty if the lookup failed."""
+		return c_resolve(<object> None, (hostname, callback))
 	
 
 g_dionaea = dionaea() 
@@ -162,6 +167,8 @@ cdef extern from "../../include/connection.h":
 	int c_connection_listen "connection_listen" (c_connection *, int)
 	void c_connection_connect "connection_connect" (c_connection *, char *, int port, char *)
 	void c_connection_send "connection_send" (c_connection *, char *, int)
+	void c_connection_send_queue "connection_send_queue" (c_connection *, char *, int)
+	void c_connection_send_flush "connection_send_flush" (c_connection *)
 	void c_connection_close "connection_close" 	(c_connection *)
 	void c_connection_process "connection_process" 	(c_connection *)
 	
@@ -656,6 +663,23 @@ cdef class connection:
 			raise ValueError(u"requires text/bytes input, got %s" % type(data))
 		c_connection_send(self.thisptr, data_bytes, len(data_bytes))
 
+	def send_many(self, packets):
+		"""send several packets at once
+		for udp connections every item is sent as one packet, the queued packets are sent using sendmmsg if available"""
+		if self.thisptr == NULL:
+			raise ReferenceError(u'the object requested does not exist')
+		for data in packets:
+			if isinstance(data, unicode):
+				data_bytes = data.encode(u'UTF-8')
+			elif isinstance(data, bytes):
+				data_bytes = data
+			elif isinstance(data, (bytearray, memoryview)):
+				data_bytes = bytes(data)
+			else:
+				raise ValueError(u"requires text/bytes input, got %s" % type(data))
+			c_connection_send_queue(self.thisptr, data_bytes, len(data_bytes))
+		c_connection_send_flush(self.thisptr)
+
 
 
 	def close(self):
@@ -35,6 +35,9 @@ class ServiceLoader(object, metaclass=RegisterClasses):
 
 
 class IHandlerLoader(object, metaclass=RegisterClasses):
+    # Start the ihandler with the default config if it is not configured
+    required = False
+
     @classmethod
     def start(cls):
         raise NotImplementedError("do it")
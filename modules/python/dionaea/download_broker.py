@@ -0,0 +1,269 @@
+#################################################################################
+#                                Dionaea
+#                            - catches bugs -
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+################################################################################
+
+"""
+The download broker sits between the 'dionaea.download.offer' incidents and the downloaders (curl, ftpdownload,
+tftp_download).
+
+* Offers for an URL which is already being downloaded are attached to the running download. If the download
+  completes a 'dionaea.download.complete' incident is reported for every attached connection.
+* The results of completed and failed downloads are cached for some time. Offers for a cached URL are handled
+  without a new download.
+* All other offers are passed to the downloaders as 'dionaea.download.fetch' incidents.
+"""
+
+from collections import OrderedDict
+import logging
+import os
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from dionaea import IHandlerLoader, pyev
+from dionaea.core import ihandler, incident
+from dionaea.exception import LoaderError
+from dionaea.util import get_file_hashes
+
+
+logger = logging.getLogger("download_broker")
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_PORTS = {
+    "ftp": 21,
+    "http": 80,
+    "https": 443,
+    "tftp": 69,
+}
+
+
+class DownloadBrokerLoader(IHandlerLoader):
+    name = "download_broker"
+    # The downloaders only handle 'dionaea.download.fetch' incidents
+    required = True
+
+    @classmethod
+    def start(cls, config=None):
+        try:
+            return DownloadBroker("dionaea.download.*", config=config)
+        except LoaderError as e:
+            logger.error(e.msg, *e.args)
+            return None
+
+
+def normalize_url(url):
+    """
+    Normalize an URL to detect offers for the same file. The scheme and the host are converted to lower case, the
+    default port and the fragment are removed.
+
+    :param url: The URL
+    :type url: bytes or str
+    :return: The normalized URL
+    :rtype: str
+    """
+    if isinstance(url, bytes):
+        url = url.decode("latin-1")
+
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if parts.hostname is not None:
+        userinfo, _, hostport = netloc.rpartition("@")
+        host = parts.hostname
+        if ":" in host:
+            host = "[%s]" % host
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            host = "%s:%d" % (host, port)
+        netloc = host
+        if userinfo:
+            netloc = userinfo + "@" + host
+
+    path = parts.path
+    if path == "":
+        path = "/"
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+class Download(object):
+    def __init__(self, url):
+        self.url = url
+        self.start_time = time.monotonic()
+        # List of (url, connection) tuples of all offers attached to this download
+        self.waiters = []
+
+
+class DownloadBroker(ihandler):
+    def __init__(self, path, config=None):
+        logger.debug("%s ready!", self.__class__.__name__)
+        ihandler.__init__(self, path)
+        if config is None:
+            config = {}
+
+        try:
+            self.cache_ttl = float(config.get("cache_ttl", 300))
+            self.failure_ttl = float(config.get("failure_ttl", 60))
+            self.cache_size = int(config.get("cache_size", 10000))
+            self.timeout = float(config.get("timeout", 300))
+        except (TypeError, ValueError) as e:
+            raise LoaderError("Unable to parse config: %s", e)
+
+        schemes = config.get("schemes", ["ftp", "http", "https", "tftp"])
+        if not isinstance(schemes, list):
+            raise LoaderError("Setting schemes must be a list")
+        self.schemes = set(scheme.lower() for scheme in schemes)
+
+        # normalized URL -> Download
+        self.downloads = {}
+        # normalized URL -> (expire time, file, digests), file is None for failed downloads
+        self.cache = OrderedDict()
+
+        self._timer = pyev.Timer(10.0, 10.0, pyev.default_loop(), self._handle_timer)
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+        for download in self.downloads.values():
+            self._release(download)
+        self.downloads.clear()
+        self.cache.clear()
+
+    def handle_incident(self, icd):
+        pass
+
+    def handle_incident_dionaea_download_offer(self, icd):
+        url = icd.get("url")
+        try:
+            con = icd.con
+        except AttributeError:
+            con = None
+
+        key = normalize_url(url)
+        if urlsplit(key).scheme not in self.schemes:
+            self._fetch(icd)
+            return
+
+        result = self._get_cached(key)
+        if result is not None:
+            filename, digests = result
+            if filename is None:
+                logger.debug("Download of %s failed recently, ignoring offer", key)
+                return
+            logger.debug("Using cached result for %s", key)
+            self._report_complete(url, con, filename, digests)
+            return
+
+        download = self.downloads.get(key)
+        if download is not None:
+            logger.debug("Attaching offer to running download of %s", key)
+            if con is not None:
+                con.ref()
+            download.waiters.append((url, con))
+            return
+
+        # Register before reporting, the downloader might fail immediately
+        self.downloads[key] = Download(key)
+        self._fetch(icd)
+
+    def handle_incident_dionaea_download_complete_unique(self, icd):
+        # Reported by the store after the file has been linked into the download directory
+        key = normalize_url(icd.get("url"))
+        digests = get_file_hashes(icd)
+        if digests is None:
+            return
+
+        download = self.downloads.pop(key, None)
+        if download is None:
+            # Not fetched by the broker, e.g. a cached result reported again
+            return
+
+        if self.cache_ttl > 0:
+            self._set_cached(key, time.monotonic() + self.cache_ttl, icd.file, digests)
+
+        logger.debug("Download of %s complete, reporting %d attached offers", key, len(download.waiters))
+        for url, con in download.waiters:
+            self._report_complete(url, con, icd.file, digests)
+        self._release(download)
+
+    handle_incident_dionaea_download_complete_again = handle_incident_dionaea_download_complete_unique
+
+    def handle_incident_dionaea_download_failed(self, icd):
+        key = normalize_url(icd.get("url"))
+        download = self.downloads.pop(key, None)
+        if download is None:
+            return
+
+        if self.failure_ttl > 0:
+            self._set_cached(key, time.monotonic() + self.failure_ttl, None, None)
+        logger.debug("Download of %s failed, dropping %d attached offers", key, len(download.waiters))
+        self._release(download)
+
+    def _fetch(self, icd):
+        i = incident("dionaea.download.fetch")
+        for key in icd.keys():
+            i.set(key, icd.get(key))
+        i.report()
+
+    def _get_cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expire_time, filename, digests = entry
+        if expire_time < time.monotonic() or (filename is not None and not os.path.exists(filename)):
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return filename, digests
+
+    def _set_cached(self, key, expire_time, filename, digests):
+        self.cache.pop(key, None)
+        self.cache[key] = (expire_time, filename, digests)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _release(self, download):
+        for url, con in download.waiters:
+            if con is not None:
+                con.unref()
+        download.waiters = []
+
+    def _report_complete(self, url, con, filename, digests):
+        i = incident("dionaea.download.complete")
+        i.path = filename
+        i.url = url
+        if con is not None:
+            i.con = con
+        for name, value in digests.items():
+            i.set(name + "hash", value)
+        i.report()
+
+    def _handle_timer(self, watcher, events):
+        now = time.monotonic()
+        for key, download in list(self.downloads.items()):
+            if download.start_time + self.timeout < now:
+                logger.info("Download of %s timed out, dropping %d attached offers", key, len(download.waiters))
+                del self.downloads[key]
+                self._release(download)
+
+        for key, (expire_time, filename, digests) in list(self.cache.items()):
+            if expire_time < now:
+                del self.cache[key]
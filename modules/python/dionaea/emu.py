@@ -29,6 +29,8 @@
 from dionaea import IHandlerLoader
 from dionaea.core import ihandler, incident
 from dionaea.cmd import cmdexe
+from collections import OrderedDict
+import hashlib
 import logging
 import json
 
@@ -44,11 +46,109 @@ class EMUProfileHandlerLoader(IHandlerLoader):
         return emuprofilehandler("dionaea.module.emu.profile", config=config)
 
 
+def _sockaddr(api):
+    return api['args'][1]['sin_addr']['s_addr'], api['args'][1]['sin_port']
+
+
+def _action_offer(api, host, port):
+    url = api['args'][1]
+    logger.debug("download file %s" % (url))
+    return ("offer", url)
+
+
+def _action_winexec(api, host, port):
+    return ("exec", api['args'][0])
+
+
+def _action_createprocess(api, host, port):
+    return ("exec", api['args'][1])
+
+
+def _action_bindshell(api, host, port):
+    logger.debug("bindshell host %s port %s" % (host, port))
+    return ("shell.listen", int(port))
+
+
+def _action_connectbackshell(api, host, port):
+    logger.debug("connectbackshell host %s port %s" % (host, port))
+    return ("shell.connect", host, int(port))
+
+
+def _action_createprocess_connect(api, host, port):
+    host, port = _sockaddr(api)
+    return _action_connectbackshell(api, host, port)
+
+
+# state -> API call -> (next state, store sockaddr, action)
+# A next state of None keeps the current state
+TRANSITIONS = {
+    "NONE": {
+        "WSASocket": ("SOCKET", False, None),
+        "socket": ("SOCKET", False, None),
+        "URLDownloadToFile": (None, False, _action_offer),
+        "WinExec": (None, False, _action_winexec),
+        "CreateProcess": (None, False, _action_createprocess),
+    },
+    "SOCKET": {
+        "bind": ("BIND", True, None),
+        "connect": ("CONNECT", True, None),
+        "CreateProcess": ("CREATEPROCESS", False, None),
+    },
+    "BIND": {
+        "listen": ("LISTEN", False, None),
+    },
+    "LISTEN": {
+        "accept": ("ACCEPT", False, None),
+    },
+    "ACCEPT": {
+        "CreateProcess": (None, False, _action_bindshell),
+    },
+    "CONNECT": {
+        "CreateProcess": (None, False, _action_connectbackshell),
+    },
+    "CREATEPROCESS": {
+        "connect": ("DONE", False, _action_createprocess_connect),
+    },
+}
+
+
+def interpret_profile(profile):
+    """
+    Run the API calls of a profile through the state machine.
+
+    :param list profile: The decoded profile
+    :return: List of actions, every action is a tuple starting with the name of the action
+    """
+    actions = []
+    state = "NONE"
+    host = None
+    port = None
+    transitions = TRANSITIONS[state]
+    for api in profile:
+        transition = transitions.get(api['call'])
+        if transition is None:
+            continue
+        next_state, store_sockaddr, action = transition
+        if store_sockaddr:
+            host, port = _sockaddr(api)
+        if action is not None:
+            actions.append(action(api, host, port))
+        if next_state is not None:
+            state = next_state
+            transitions = TRANSITIONS.get(state, {})
+    return actions
+
+
 class emuprofilehandler(ihandler):
 
     def __init__(self, path, config=None):
         logger.debug("%s ready!" % (self.__class__.__name__))
         ihandler.__init__(self, path)
+        if config is None:
+            config = {}
+        self.cache_size = int(config.get("cache_size", 1000))
+        # digest of the profile -> list of actions
+        self.cache = OrderedDict()
 
     def handle_incident(self, icd):
         logger.debug("profiling")
@@ -57,89 +157,59 @@ class emuprofilehandler(ihandler):
             con = icd.get("con")
         except AttributeError:
             con = None
-        p = json.loads(p)
-#        print(p)
-        logger.info("profiledump %s" % (p))
-        state = "NONE"
-        host = None
-        port = None
-
-        for api in p:
-
-            if state == "NONE":
-                if api['call'] == 'WSASocket' or api['call'] == 'socket':
-                    state = "SOCKET"
-                if api['call'] == 'URLDownloadToFile':
-                    url = api['args'][1]
-                    logger.debug("download file %s" % (url))
-                    i = incident("dionaea.download.offer")
-                    i.set("url", url)
-                    if con is not None:
-                        i.set("con", con)
-                    i.report()
-                if api['call'] == 'WinExec':
-                    r = cmdexe(None)
-                    r.con = con
-                    r.handle_io_in(api['args'][0].encode() + b'\0')
-                if api['call'] == 'CreateProcess':
-                    r = cmdexe(None)
-                    r.con = con
-                    r.handle_io_in(api['args'][1].encode() + b'\0')
-
-            elif state == "SOCKET":
-                if api['call'] == 'bind':
-                    state = "BIND"
-                    host = api['args'][1]['sin_addr']['s_addr']
-                    port = api['args'][1]['sin_port']
-                elif api['call'] == 'connect':
-                    state = "CONNECT"
-                    host = api['args'][1]['sin_addr']['s_addr']
-                    port = api['args'][1]['sin_port']
-                elif api['call'] == 'CreateProcess':
-                    state = "CREATEPROCESS"
-
-            elif state == "BIND":
-                if api['call'] == 'listen':
-                    state = "LISTEN"
-
-            elif state == "LISTEN":
-                if api['call'] == 'accept':
-                    state = "ACCEPT"
-
-            elif state == "ACCEPT":
-                if api['call'] == 'CreateProcess':
-                    logger.debug("bindshell host %s port %s"  % (host, port) )
-                    i = incident("dionaea.service.shell.listen")
-                    i.set("port", int(port))
-                    if con is not None:
-                        i.set("con", con)
-                    i.report()
-
-            elif state == "CONNECT":
-                if api['call'] == 'CreateProcess':
-                    logger.debug(
-                        "connectbackshell host %s port %s"  % (host, port) )
-                    i = incident("dionaea.service.shell.connect")
-                    i.set("port", int(port))
-                    i.set("host", host)
-                    if con is not None:
-                        i.set("con", con)
-                    i.report()
-
-            elif state == "CREATEPROCESS":
-                if api['call'] == 'connect':
-                    host = api['args'][1]['sin_addr']['s_addr']
-                    port = api['args'][1]['sin_port']
-                    logger.debug(
-                        "connectbackshell host %s port %s"  % (host, port) )
-                    i = incident("dionaea.service.shell.connect")
-                    i.set("port", int(port))
-                    i.set("host", host)
-                    if con is not None:
-                        i.set("con", con)
-                    i.report()
-                    state = "DONE"
 
+        raw = p
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        digest = hashlib.sha1(raw).hexdigest()
+
+        actions = self.cache.get(digest)
+        if actions is None:
+            p = json.loads(p)
+            logger.info("profiledump %s" % (p))
+            actions = interpret_profile(p)
+            if self.cache_size > 0:
+                self.cache[digest] = actions
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        else:
+            logger.debug("using cached profile %s", digest)
+            self.cache.move_to_end(digest)
+
+        self.replay(actions, con)
 
         # set connection sustain timeout to low value, fainting death
         con.timeouts.sustain = 3.0
+
+    def replay(self, actions, con):
+        """
+        Report the incidents of the actions derived from a profile.
+
+        :param list actions: The actions returned by interpret_profile()
+        :param con: The connection
+        """
+        for action in actions:
+            name = action[0]
+            if name == "offer":
+                i = incident("dionaea.download.offer")
+                i.set("url", action[1])
+                if con is not None:
+                    i.set("con", con)
+                i.report()
+            elif name == "exec":
+                r = cmdexe(None)
+                r.con = con
+                r.handle_io_in(action[1].encode() + b'\0')
+            elif name == "shell.listen":
+                i = incident("dionaea.service.shell.listen")
+                i.set("port", action[1])
+                if con is not None:
+                    i.set("con", con)
+                i.report()
+            elif name == "shell.connect":
+                i = incident("dionaea.service.shell.connect")
+                i.set("port", action[2])
+                i.set("host", action[1])
+                if con is not None:
+                    i.set("con", con)
+                i.report()
@@ -21,6 +21,8 @@
 ################################################################################
 
 import logging
+import mmap
+import os
 
 from dionaea import IHandlerLoader
 from dionaea.core import ihandler, incident
@@ -30,6 +32,22 @@ from dionaea.exception import LoaderError
 logger = logging.getLogger("emu_scripts")
 logger.setLevel(logging.DEBUG)
 
+# Files starting with one of these byte sequences are not scanned for scripts
+BINARY_MAGICS = (
+    b"MZ",  # PE
+    b"\x7fELF",  # ELF
+    b"\xca\xfe\xba\xbe",  # Mach-O universal
+    b"\xce\xfa\xed\xfe",  # Mach-O 32-bit
+    b"\xcf\xfa\xed\xfe",  # Mach-O 64-bit
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"PK\x03\x04",  # zip
+    b"Rar!\x1a\x07",  # rar
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+)
+BINARY_MAGIC_LENGTH = max(len(magic) for magic in BINARY_MAGICS)
+
 
 class EmulateScriptsLoader(IHandlerLoader):
     name = "emu_scripts"
@@ -51,8 +69,10 @@ class EmulateScriptsHandler(ihandler):
         self.handlers = []
         self.connection_url_levels = {}
         self.max_subdownloads = 20
+        self.max_scan_size = 1024 * 1024
+        self.skip_binaries = True
 
-        from .handler import PowerShell, RawURL, VBScript
+        from .handler import PowerShell, RawURL, Scanner, VBScript
 
         tmp_handlers = {}
         for h in (PowerShell, RawURL,VBScript):
@@ -62,6 +82,14 @@ class EmulateScriptsHandler(ihandler):
         if isinstance(tmp, int):
             self.max_subdownloads = tmp
 
+        tmp = config.get("max_scan_size")
+        if isinstance(tmp, int):
+            self.max_scan_size = tmp * 1024
+
+        tmp = config.get("skip_binaries")
+        if isinstance(tmp, bool):
+            self.skip_binaries = tmp
+
         enabled_handlers = config.get("enabled_handlers")
         if not isinstance(enabled_handlers, list) or len(enabled_handlers) == 0:
             logger.warning("No handlers specified")
@@ -84,6 +112,8 @@ class EmulateScriptsHandler(ihandler):
 
             self.handlers.append(h(config=handler_config))
 
+        self.scanner = Scanner(self.handlers)
+
     def handle_incident_dionaea_connection_free(self, icd):
         # Delete levels for this connection
         if icd.con not in self.connection_url_levels:
@@ -105,17 +135,7 @@ class EmulateScriptsHandler(ihandler):
             # ToDo: use config value
             return
 
-        fp = open(icd.path, "rb")
-        # ToDo: check size
-        data = fp.read()
-        fp.close()
-        urls = None
-        # use the url list of the first handler that matches
-        for handler in self.handlers:
-            urls = handler.run(data)
-            if urls is not None:
-                break
-
+        urls = self._scan_file(icd.path)
         if urls is None:
             return
 
@@ -132,3 +152,42 @@ class EmulateScriptsHandler(ihandler):
             i.con = icd.con
             i.url = url
             i.report()
+
+    def _scan_file(self, filename):
+        """
+        Scan the file with all handlers.
+
+        :param str filename: The file to scan
+        :return: List of URLs or None if no handler matches
+        """
+        try:
+            fp = open(filename, "rb")
+        except OSError as e:
+            logger.warning("Unable to open file %s: %s", filename, e)
+            return None
+
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size == 0:
+                return None
+
+            if self.skip_binaries and fp.read(BINARY_MAGIC_LENGTH).startswith(BINARY_MAGICS):
+                logger.debug("Skipping binary file %s", filename)
+                return None
+
+            endpos = size
+            if 0 < self.max_scan_size < size:
+                logger.info("Only scanning the first %d of %d bytes of %s", self.max_scan_size, size, filename)
+                endpos = self.max_scan_size
+
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                fp.seek(0)
+                data = fp.read(endpos)
+                return self.scanner.run(data, endpos)
+
+            try:
+                return self.scanner.run(data, endpos)
+            finally:
+                data.close()
@@ -4,8 +4,14 @@ import re
 logger = logging.getLogger("emu_scripts")
 
 
+REGEX_URL = b"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
+
+
 class BaseHandler(object):
     name = ""
+    # Patterns to detect the script type, combined into a single regex by the Scanner
+    detect_patterns = []
+    url_pattern = REGEX_URL
 
     def __init__(self, config=None):
         self._config = {}
@@ -13,11 +19,16 @@ class BaseHandler(object):
             self._config = config
 
         self.min_match_count = 0
-        self._regex_detect = []
+        self._regex_detect = [re.compile(pattern) for pattern in self.detect_patterns]
+        self._regex_url = re.compile(self.url_pattern)
 
-        self._regex_url = re.compile(
-            b"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
-        )
+    def get_urls(self, data, endpos=None):
+        if endpos is None:
+            endpos = len(data)
+        urls = []
+        for m in self._regex_url.finditer(data, 0, endpos):
+            urls.append(m.group("url"))
+        return urls
 
     def run(self, data):
         match_count = 0
@@ -31,60 +42,91 @@ class BaseHandler(object):
             return
 
         logger.info("Looking for URLs '%s'", self.name)
-        urls = []
-        for m in self._regex_url.finditer(data):
-            urls.append(m.group("url"))
-        return urls
+        return self.get_urls(data)
 
 
-class RawURL(object):
+class RawURL(BaseHandler):
     name = "raw_url"
 
-    def __init__(self, config=None):
-        self._config = {}
-        if isinstance(config, dict):
-            self._config = config
-
-        self._regex_url = re.compile(
-            b"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
-        )
-
-    def run(self, data):
-        urls = []
-        for m in self._regex_url.finditer(data):
-            urls.append(m.group("url"))
-        return urls
-
 
 class PowerShell(BaseHandler):
     name = "powershell"
+    detect_patterns = [
+        b"New-Object\s+System\.Net\.WebClient",
+        b"DownloadFile([^,]+?,[^,]+?)",
+        b"Invoke-Expression([^)]+?)"
+    ]
+    url_pattern = b"\w+\s*=\s*\"\s*" + REGEX_URL + b"\s*\""
 
     def __init__(self, config=None):
         BaseHandler.__init__(self, config=config)
 
         self.min_match_count = 2
-        self._regex_detect = [
-            re.compile(b"New-Object\s+System\.Net\.WebClient"),
-            re.compile(b"DownloadFile([^,]+?,[^,]+?)"),
-            re.compile(b"Invoke-Expression([^)]+?)")
-        ]
-
-        self._regex_url = re.compile(
-            b"\w+\s*=\s*\"\s*(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)\s*\""
-        )
 
 
 class VBScript(BaseHandler):
     name = "vbscript"
+    detect_patterns = [
+        b"Set\s+\w+\s+=\s+CreateObject\(.*?(Msxml2.XMLHTTP|Wscript.Shell).*?\)"
+    ]
+    url_pattern = b"\.Open\s+\"GET\"\s*,\s*\"" + REGEX_URL + b"\""
 
     def __init__(self, config=None):
         BaseHandler.__init__(self, config=config)
 
         self.min_match_count = 1
-        self._regex_detect = [
-            re.compile(b"Set\s+\w+\s+=\s+CreateObject\(.*?(Msxml2.XMLHTTP|Wscript.Shell).*?\)")
-        ]
 
-        self._regex_url = re.compile(
-            b"\.Open\s+\"GET\"\s*,\s*\"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)\""
-        )
+
+class Scanner(object):
+    """
+    Run the detection patterns of all handlers in a single pass over the data.
+
+    :param list handlers: The handler instances, the URLs of the first matching handler are used
+    """
+    def __init__(self, handlers):
+        self.handlers = []
+        patterns = []
+        for i, handler in enumerate(handlers):
+            names = set()
+            for j, pattern in enumerate(handler.detect_patterns):
+                name = "h%d_%d" % (i, j)
+                names.add(name)
+                patterns.append(b"(?P<" + name.encode("ascii") + b">" + pattern + b")")
+            self.handlers.append((handler, names))
+
+        self._detect_count = len(patterns)
+        self._regex_detect = None
+        if len(patterns) > 0:
+            self._regex_detect = re.compile(b"|".join(patterns))
+
+    def run(self, data, endpos=None):
+        """
+        :param data: bytes or mmap object
+        :param int endpos: Only scan the data up to this position
+        :return: List of URLs or None if no handler matches
+        """
+        if endpos is None:
+            endpos = len(data)
+
+        found = set()
+        if self._regex_detect is not None:
+            for m in self._regex_detect.finditer(data, 0, endpos):
+                found.add(m.lastgroup)
+                if len(found) == self._detect_count:
+                    break
+
+        for handler, names in self.handlers:
+            match_count = len(found & names)
+            if match_count < handler.min_match_count:
+                logger.info(
+                    "Match count for %s is %d should at least be %d",
+                    handler.name,
+                    match_count,
+                    handler.min_match_count
+                )
+                continue
+
+            logger.info("Looking for URLs '%s'", handler.name)
+            return handler.get_urls(data, endpos)
+
+        return None
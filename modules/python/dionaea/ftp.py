@@ -68,13 +68,15 @@
 
 
 # ftp server
-from dionaea import ServiceLoader
+from dionaea import pyev, ServiceLoader
 from dionaea.core import connection, ihandler, g_dionaea, incident
 from dionaea.exception import ServiceConfigError
+from dionaea.util import DirectoryListingCache
 import logging
 import os
 from os import stat
 from stat import *
+from collections import deque
 import time
 import io
 
@@ -82,6 +84,8 @@ import io
 logger = logging.getLogger('ftp')
 logger.setLevel(logging.DEBUG)
 
+listing_cache = DirectoryListingCache()
+
 #
 # Parts of the following definitions are taken from twisted
 # MIT licensed code, gpl compatible
@@ -165,9 +169,16 @@ class FTPd(connection):
     protocol_name = "ftpd"
     shared_config_values = (
         "basedir",
+        "login_throttle_attempts",
+        "login_throttle_delay",
+        "login_throttle_interval",
+        "max_line_length",
         "response_msgs"
     )
 
+    # Maps the command name to the method, filled by _build_command_table()
+    commands = {}
+
     def __init__(self, proto='tcp'):
         connection.__init__(self, proto)
         logger.debug("ftp test")
@@ -180,6 +191,20 @@ class FTPd(connection):
         self.limits = {}  # { '_out' : 8192 }
         # Copy default response messages
         self.response_msgs = dict(RESPONSE.items())
+        self.max_line_length = 4096
+        self.login_throttle_attempts = 0
+        self.login_throttle_delay = 2.0
+        self.login_throttle_interval = 60.0
+        self._buffer = bytearray()
+        self._login_attempts = deque()
+        self._reply_timer = None
+
+    @classmethod
+    def _build_command_table(cls):
+        cls.commands = {}
+        for name in dir(cls):
+            if name.startswith("ftp_"):
+                cls.commands[name[4:].encode("ascii")] = getattr(cls, name)
 
     def apply_config(self, config):
         self.basedir = config.get("root")
@@ -192,6 +217,20 @@ class FTPd(connection):
 
         self.response_msgs.update(config.get("response_messages", {}))
 
+        try:
+            self.max_line_length = int(config.get("max_line_length", self.max_line_length))
+        except ValueError:
+            raise ServiceConfigError("Unable to convert value of 'max_line_length' to an integer")
+
+        throttle_config = config.get("login_throttle")
+        if throttle_config:
+            try:
+                self.login_throttle_attempts = int(throttle_config.get("max_attempts", 10))
+                self.login_throttle_delay = float(throttle_config.get("delay", self.login_throttle_delay))
+                self.login_throttle_interval = float(throttle_config.get("interval", self.login_throttle_interval))
+            except ValueError:
+                raise ServiceConfigError("Unable to convert the values of the 'login_throttle' config")
+
     def chroot(self, p):
         self.basedir = p
 
@@ -211,68 +250,109 @@ class FTPd(connection):
         self.reply("welcome_msg")
 
     def handle_io_in(self, data):
-        # try:
-        #     data = data.decode()
-        # except UnicodeDecodeError:
-        #     logger.warn("error decoding")
-        #     logger.debug("io_in" + data)
-
-        logger.debug(data)
-        lastsep = data.rfind(b"\n")
-        if lastsep == -1:
-            logger.debug("data without linebreak")
-            return 0
-
-        lastsep += 1  # add last \n
-        logger.debug("input size %i, can do %i", len(data), lastsep)
-        data = data[:lastsep]
-        lines = data.splitlines(0)
-        for line in lines:
-            logger.debug("processing line '%s'" % line)
-            if len(line) == 0:
-                continue
-            space = line.find(b' ')
-            if space != -1:
-                cmd = line[:space]
-                args = (line[space + 1:],)
-            else:
-                cmd = line
-                args = ()
-            logger.warn("cmd '%s'" % cmd)
-            self.processcmd(cmd, args)
-        return lastsep
+        self._buffer += data
+        self._process_buffer()
+        return len(data)
+
+    def _process_buffer(self):
+        buf = self._buffer
+        commands = []
+        start = 0
+        try:
+            # Stop processing if a reply has been delayed, the remaining commands are processed after the reply has been sent
+            while self._reply_timer is None:
+                end = buf.find(b"\n", start)
+                if end == -1:
+                    break
+
+                line = bytes(buf[start:end])
+                start = end + 1
+                if line.endswith(b"\r"):
+                    line = line[:-1]
+                if len(line) == 0:
+                    continue
+
+                logger.debug("processing line '%s'", line)
+                space = line.find(b' ')
+                if space != -1:
+                    cmd = line[:space]
+                    args = (line[space + 1:],)
+                else:
+                    cmd = line
+                    args = ()
+                args = [i.decode() for i in args]
+                commands.append({
+                    "command": cmd,
+                    "arguments": args
+                })
+                self.processcmd(cmd, args)
+        finally:
+            # Drop the processed lines and report the commands even if a command failed
+            del buf[:start]
+            if len(buf) > self.max_line_length and buf.find(b"\n") == -1:
+                logger.warning("Line too long, discarding %d bytes", len(buf))
+                del buf[:]
+
+            if len(commands) > 0:
+                # Report all commands of the read at once
+                i = incident("dionaea.modules.python.ftp.commands")
+                i.con = self
+                i.commands = commands
+                i.report()
 
     def processcmd(self, cmd, args):
-        logger.debug("cmd '%s'" % cmd)
-        l = [i.decode() for i in args]
-
-        i = incident("dionaea.modules.python.ftp.command")
-        i.con = self
-        i.command = cmd
-        i.arguments = l
-        i.report()
+        logger.debug("cmd '%s'", cmd)
 
         cmd = cmd.upper()
         if self.state == self.UNAUTH:
             if cmd != b'USER':
                 self.reply("not_logged_in")
                 return
-            self.ftp_USER(*l)
+            self.ftp_USER(*args)
         elif self.state == self.INAUTH:
             if cmd != b'PASS':
                 self.reply("bad_cmd_seq_pass_after_user")
                 return
-            self.ftp_PASS(*l)
+            self.ftp_PASS(*args)
         else:
-            method = getattr(self, "ftp_" + cmd.decode(), None)
+            method = self.commands.get(cmd)
             if method is not None:
-                msg = method(*l)
+                msg = method(self, *args)
                 if isinstance(msg, str):
                     self.error("Returning messages is deprecated please report so we can fix it")
                     self.sendline(msg)
             else:
                 self.reply("cmd_not_implmntd", command=cmd.decode())
 
+    def _count_login_attempt(self):
+        """
+        Count the login attempt and check if the reply must be delayed.
+
+        :return: True if the configured number of login attempts has been exceeded
+        :rtype: bool
+        """
+        if self.login_throttle_attempts <= 0:
+            return False
+
+        now = time.monotonic()
+        attempts = self._login_attempts
+        attempts.append(now)
+        while attempts[0] < now - self.login_throttle_interval:
+            attempts.popleft()
+        return len(attempts) > self.login_throttle_attempts
+
+    def delayed_reply(self, name, **kwargs):
+        """
+        Send the reply after the configured delay and pause the processing of commands until the reply has been sent.
+        """
+        def _send(watcher, events):
+            self._reply_timer = None
+            self.reply(name, **kwargs)
+            self._process_buffer()
+
+        self._reply_timer = pyev.Timer(self.login_throttle_delay, 0.0, pyev.default_loop(), _send)
+        self._reply_timer.start()
+
     def ftp_USER(self, username):
         if not username:
             self.reply("syntax_error_user_requires_arg")
@@ -300,9 +380,15 @@ class FTPd(connection):
 
         self.state = self.AUTHED
         if self.user == "anonymous":
-            self.reply("guest_logged_in_proceed")
+            msg_name = "guest_logged_in_proceed"
         else:
-            self.reply("usr_logged_in_proceed")
+            msg_name = "usr_logged_in_proceed"
+
+        if self._count_login_attempt():
+            logger.debug("Too many login attempts, delaying reply")
+            self.delayed_reply(msg_name)
+        else:
+            self.reply(msg_name)
 
     def ftp_FEAT(self):
         self.send('211-Features:\r\n' +
@@ -567,6 +653,9 @@ class FTPd(connection):
         pass
 
     def handle_disconnect(self):
+        if self._reply_timer is not None:
+            self._reply_timer.stop()
+            self._reply_timer = None
         if self.dtf:
             self.dtf.close()
             self.dtf = None
@@ -576,6 +665,56 @@ class FTPd(connection):
         return 0
 
 
+FTPd._build_command_table()
+
+
+def format_list_line(name, s):
+    """
+    Format one line of the LIST command output like 'ls -l'.
+
+    :param str name: The file name
+    :param os.stat_result s: The stat result
+    :return: The formatted line including the line break
+    :rtype: bytes
+    """
+    mtime = time.gmtime(s.st_mtime)
+    if time.gmtime().tm_year != mtime.tm_year:
+        date = '%s %02d %5d' % (mtime.tm_mon, mtime.tm_mday, mtime.tm_year)
+    else:
+        date = '%s %02d %02d:%02d' % (mtime.tm_mon, mtime.tm_mday, mtime.tm_hour, mtime.tm_min)
+
+    mode = S_IMODE(s.st_mode)
+    line = '%s%s%4d %-9s %-9s %15d %12s %s\r\n' % (
+        S_ISDIR(s.st_mode) and 'd' or '-',
+        ''.join([mode & (256 >> n) and 'rwx'[n % 3] or '-' for n in range(9)]),
+        s.st_nlink,
+        s.st_uid,
+        s.st_gid,
+        s.st_size,
+        date,
+        name
+    )
+    return line.encode("utf-8", "surrogateescape")
+
+
+def render_list(entries):
+    """
+    Render the output of the LIST command for all entries of a directory.
+
+    :param list entries: List of os.DirEntry like objects
+    :return: The listing
+    :rtype: bytes
+    """
+    lines = []
+    for entry in entries:
+        try:
+            lines.append(format_list_line(entry.name, entry.stat()))
+        except OSError:
+            # Broken link or the file has been removed
+            continue
+    return b"".join(lines)
+
+
 def encodeHostPort(host, port):
     numbers = host.split('.') + [str(port >> 8), str(port % 256)]
     return ','.join(numbers)
@@ -593,67 +732,18 @@ class FTPDataCon(connection):
             self.ctrl.reply("cant_open_data_cnx")
 
     def send_list(self, p, rm):
-        def ls(f, r):
-            logger.debug("stat %s" % f)
-            name = f[r:]
-            s=stat(f)
-            size = s.st_size
-            directory = S_ISDIR(s.st_mode)
-            permissions = S_IMODE(s[ST_MODE])
-            hardlinks = s.st_nlink
-            modified = s.st_mtime
-            owner = s.st_uid
-            group = s.st_gid
-
-            def formatMode(mode):
-                return ''.join([mode & (256 >> n) and 'rwx'[n % 3] or '-' for n in range(9)])
-
-            def formatDate(mtime):
-                now = time.gmtime()
-                info = {
-                    'month': mtime.tm_mon,
-                    'day': mtime.tm_mday,
-                    'year': mtime.tm_year,
-                    'hour': mtime.tm_hour,
-                    'minute': mtime.tm_min
-                }
-                if now.tm_year != mtime.tm_year:
-                    return '%(month)s %(day)02d %(year)5d' % info
-                else:
-                    return '%(month)s %(day)02d %(hour)02d:%(minute)02d' % info
-
-            format = (
-                '%(directory)s%(permissions)s%(hardlinks)4d '
-                '%(owner)-9s %(group)-9s %(size)15d %(date)12s '
-                '%(name)s'
-            )
-            return format % {
-                'directory': directory and 'd' or '-',
-                'permissions': formatMode(permissions),
-                'hardlinks': hardlinks,
-                'owner': owner,
-                'group': group,
-                'size': size,
-                'date': formatDate(time.gmtime(modified)),
-                'name': name
-            }
-
         self.mode = 'list'
-        if os.path.isdir(p):
-            self.data = [ls(os.path.join(p,f), rm) for f in os.listdir(p)]
-        elif os.path.isfile(p):
-            self.data = [ls(p)]
-
-        logger.debug("p %s len %i" % (p, len(self.data)) )
-        if len(self.data) > 0:
-            self.off = 0
-            self.off = self.off + 1
-            self.send(self.data[self.off-1] + '\r\n')
-        else:
-            self.close()
-            if self.ctrl:
-                self.ctrl.dtp = None
-                self.ctrl.reply("txfr_complete_ok")
+        try:
+            if os.path.isdir(p):
+                self.data = listing_cache.get(p, render_list)
+            else:
+                self.data = format_list_line(os.path.basename(p), stat(p))
+        except OSError:
+            logger.warning("Unable to list '%s'", p, exc_info=True)
+            self.data = b""
+
+        logger.debug("p %s len %i" % (p, len(self.data)))
+        self.handle_io_out()
 
     def recv_file(self, p):
         logger.debug(p)
@@ -674,9 +764,9 @@ class FTPDataCon(connection):
     def handle_io_out(self):
         logger.debug("io_out")
         if self.mode == 'list':
-            if self.off < len(self.data):
-                self.off = self.off + 1
-                self.send(self.data[self.off - 1] + '\r\n')
+            if len(self.data) > 0:
+                self.send(self.data)
+                self.data = b""
             else:
                 self.close()
                 if self.ctrl:
@@ -22,6 +22,8 @@
 ################################################################################
 
 # ftp client
+from collections import deque
+import ipaddress
 import re
 import random
 import urllib.parse
@@ -37,12 +39,48 @@ logger.setLevel(logging.DEBUG)
 _linesep_regexp = re.compile(b"\r?\n")
 
 
+class PortAllocator(object):
+    """
+    Hand out ports for active mode data connections.
+
+    The free ports are kept in a shuffled queue, acquire() and release() are O(1).
+
+    :param int port_min: First port of the range
+    :param int port_max: End of the range (exclusive)
+    """
+    def __init__(self, port_min, port_max):
+        ports = [port for port in range(port_min, port_max) if ((port >> 4) & 0xf) != 0]
+        random.shuffle(ports)
+        self._free = deque(ports)
+        self._used = set()
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        """
+        :return: A free port or None if all ports are in use
+        :rtype: int
+        """
+        if len(self._free) == 0:
+            return None
+        port = self._free.popleft()
+        self._used.add(port)
+        return port
+
+    def release(self, port):
+        if port not in self._used:
+            return
+        self._used.remove(port)
+        self._free.append(port)
+
+
 class FTPIhandlerLoader(IHandlerLoader):
     name = "ftpdownload"
 
     @classmethod
     def start(cls, config=None):
-        return FTPDownloadHandler("dionaea.download.offer", config=config)
+        return FTPDownloadHandler("dionaea.download.fetch", config=config)
 
 
 class FTPCtrl(connection):
@@ -79,14 +117,12 @@ class FTPCtrl(connection):
                         self.cmd("TYPE I")
                         self.state = "TYPE"
                     else:
-                        port = self.ftp.makeport()
-                        self.cmd("PORT " + port)
                         self.state = "PORT"
+                        self.ftp.makeport(self.send_port)
             elif self.state == "TYPE":
                 if (c >= 200 and c < 300) and s != b"-":
-                    port = self.ftp.makeport()
-                    self.cmd("PORT " + port)
                     self.state = "PORT"
+                    self.ftp.makeport(self.send_port)
             elif self.state == "PORT":
                 if c == 200 and s != b"-":
                     self.cmd("RETR " + self.ftp.file)
@@ -105,6 +141,12 @@ class FTPCtrl(connection):
         logger.debug("FTP CMD: '%s'", + cmd)
         self.send(cmd + "\r\n")
 
+    def send_port(self, port):
+        if port is None:
+            self.ftp.fail()
+            return
+        self.cmd("PORT " + port)
+
     def handle_error(self, err):
         self.ftp.fail()
         return False
@@ -176,13 +218,19 @@ class FTPData(connection):
 
 
 class FTPClient:
-    def __init__(self, download_dir=None, download_suffix=None, host=None, port_min=62001, port_max=63000):
+    def __init__(self, download_dir=None, download_suffix=None, host=None, port_min=62001, port_max=63000,
+                 port_allocator=None):
         self.ctrl = FTPCtrl(self)
         self.download_dir = download_dir
         self.download_suffix = download_suffix
         self.host = host
         self.port_min = port_min
         self.port_max = port_max
+        if port_allocator is None:
+            port_allocator = PortAllocator(port_min, port_max)
+        self.port_allocator = port_allocator
+        self.dataport = None
+        self.url = None
 
     def download(self, con, user, passwd, host, port, file, mode, url):
         self.user = user
@@ -209,47 +257,73 @@ class FTPClient:
             i.child = self.ctrl
             i.report()
 
-    def makeport(self):
-        self.datalistener = FTPData(ftp=self)
+    def makeport(self, callback):
+        """
+        Listen for the data connection and call callback with the argument of the PORT command or None on error.
+        The configured host is resolved without blocking the loop.
+        """
+        # for NAT setups
+        host = self.host
+        if host is None or host == "0.0.0.0":
+            self._makeport(callback, self.ctrl.local.host)
+            return
 
         try:
-            # for NAT setups
-            host = self.host
-            if host == "0.0.0.0":
-                host = self.ctrl.local.host
-                logger.info("datalisten host %s", host)
-            else:
-                import socket
-                host = socket.gethostbyname(host)
-                logger.info("resolved host %s", host)
-        except:
-            host = self.ctrl.local.host
-            logger.info("except datalisten host %s", self.ctrl.local.host)
+            ipaddress.IPv4Address(host)
+        except ValueError:
+            pass
+        else:
+            self._makeport(callback, host)
+            return
+
+        try:
+            g_dionaea.resolve(host, lambda hostname, addresses: self._handle_resolved(callback, addresses))
+        except ValueError:
+            logger.warning("Unable to resolve host %s", host, exc_info=True)
+            self._makeport(callback, self.ctrl.local.host)
+
+    def _handle_resolved(self, callback, addresses):
+        if self.ctrl is None:
+            # download failed while resolving
+            return
+        if len(addresses) == 0:
+            logger.info("Unable to resolve host %s, using %s", self.host, self.ctrl.local.host)
+            self._makeport(callback, self.ctrl.local.host)
+            return
+        logger.info("resolved host %s", addresses[0])
+        self._makeport(callback, addresses[0])
+
+    def _makeport(self, callback, host):
+        logger.info("datalisten host %s", host)
+        self.datalistener = FTPData(ftp=self)
 
         # NAT, use a port range which is forwarded to your honeypot
-        ports = list(
-            filter(
-                lambda port: ((port >> 4) & 0xf) != 0,
-                range(self.port_min, self.port_max)
-            )
-        )
-        random.shuffle(ports)
+        # try a few ports, they might be used by other programs
         port = None
-        for port in ports:
+        for _ in range(min(10, len(self.port_allocator))):
+            port = self.port_allocator.acquire()
             self.datalistener.bind(self.ctrl.local.host, port)
             if self.datalistener.listen() == True:
-                port = self.datalistener.local.port
+                self.dataport = port
                 i = incident("dionaea.connection.link")
                 i.parent = self.ctrl
                 i.child = self.datalistener
                 i.report()
                 break
+            self.port_allocator.release(port)
+            port = None
+
+        if port is None:
+            logger.warning("Unable to find a free port for the data connection")
+            callback(None)
+            return
+
         hbytes = host.split(".")
         pbytes = [repr(port // 256), repr(port % 256)]
         bytes = hbytes + pbytes
         port = ",".join(bytes)
         logger.debug("PORT CMD %s", port)
-        return port
+        callback(port)
 
     def ctrldone(self):
         logger.info("SUCCESS DOWNLOADING FILE")
@@ -266,9 +340,20 @@ class FTPClient:
             self.finish()
 
     def fail(self):
+        if self.url is not None:
+            i = incident("dionaea.download.failed")
+            i.url = self.url
+            if self.con:
+                i.con = self.con
+            i.report()
+            # only report once, fail() might be called by the ctrl and the data connection
+            self.url = None
         self.finish()
 
     def finish(self):
+        if self.dataport is not None:
+            self.port_allocator.release(self.dataport)
+            self.dataport = None
         if self.con:
             self.con.unref()
             self.con = None
@@ -299,6 +384,7 @@ class FTPDownloadHandler(ihandler):
             logger.warning("Unable to pars port range")
 
         self.host = config.get("active_host")
+        self.port_allocator = PortAllocator(self.port_min, self.port_max)
 
         dionaea_config = g_dionaea.config().get("dionaea")
         self.download_dir = dionaea_config.get("download.dir")
@@ -325,6 +411,7 @@ class FTPDownloadHandler(ihandler):
                 download_suffix=self.download_suffix,
                 host=self.host,
                 port_min=self.port_min,
-                port_max=self.port_max
+                port_max=self.port_max,
+                port_allocator=self.port_allocator
             )
             f.download(con, p.username, p.password, p.hostname, p.port, p.path, ftpmode, url)
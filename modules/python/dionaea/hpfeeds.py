@@ -27,7 +27,7 @@
 
 from dionaea import IHandlerLoader
 from dionaea.core import ihandler, incident, g_dionaea, connection
-from dionaea.util import sha512file
+from dionaea.util import get_file_hash
 
 import os
 import logging
@@ -35,6 +35,8 @@ import struct
 import hashlib
 import json
 import datetime
+import time
+from collections import deque
 from time import gmtime, strftime
 
 try:
@@ -154,19 +156,144 @@ class FeedUnpack(object):
         return opcode, data
 
 
+class FrameSpool(object):
+    """
+    Append-only file of publish frames. It is used if the in-memory queue is full and it is replayed after a
+    restart. The offset of the frames already read is stored in the file '<filename>.offset', the spool file is
+    truncated once all frames have been read.
+
+    :param str filename: The spool file
+    :param int max_bytes: Max size of the file
+    """
+    def __init__(self, filename, max_bytes):
+        self.filename = filename
+        self.offset_filename = filename + ".offset"
+        self.max_bytes = max_bytes
+        self.fp = open(filename, "a+b")
+        self.fp.seek(0, os.SEEK_END)
+        self.size = self.fp.tell()
+        self.offset = self._load_offset()
+        # enqueue time of the oldest frame in the spool
+        self.oldest = None
+        if len(self) > 0:
+            logger.info("Replaying %d bytes from spool file %s", len(self), filename)
+            self.oldest = time.monotonic()
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def append(self, frame):
+        if self.size + len(frame) > self.max_bytes:
+            return False
+        if len(self) == 0:
+            self.oldest = time.monotonic()
+        self.fp.seek(0, os.SEEK_END)
+        self.fp.write(frame)
+        self.size += len(frame)
+        return True
+
+    def read(self, max_bytes):
+        """
+        Read frames from the spool.
+
+        :param int max_bytes: Read at most this many bytes, at least one frame is returned if available
+        :return: List of frames
+        """
+        self.fp.flush()
+        self.fp.seek(self.offset)
+        data = self.fp.read(max_bytes)
+        frames = []
+        pos = 0
+        while len(data) - pos >= 5:
+            ml, opcode = struct.unpack_from('!iB', data, pos)
+            if ml < 5 or ml > SIZES.get(opcode, MAXBUF):
+                logger.warning("Invalid frame in spool file %s, discarding %d bytes", self.filename, len(self))
+                self.reset()
+                return frames
+            if pos + ml > len(data):
+                if pos == 0:
+                    # frame larger than max_bytes
+                    data += self.fp.read(ml - len(data))
+                    if len(data) < ml:
+                        logger.warning("Truncated frame in spool file %s", self.filename)
+                        self.reset()
+                        return frames
+                    continue
+                break
+            frames.append(bytes(data[pos:pos+ml]))
+            pos += ml
+
+        self.offset += pos
+        if len(self) < 5:
+            self.reset()
+        else:
+            self._save_offset()
+        return frames
+
+    def reset(self):
+        self.fp.truncate(0)
+        self.size = 0
+        self.offset = 0
+        self.oldest = None
+        self._save_offset()
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_filename, "r") as fp:
+                offset = int(fp.read())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to read spool offset file %s: %s", self.offset_filename, e)
+            return 0
+        if offset < 0 or offset > self.size:
+            logger.warning("Invalid offset %d in spool offset file %s", offset, self.offset_filename)
+            return 0
+        return offset
+
+    def _save_offset(self):
+        try:
+            if self.offset == 0:
+                if os.path.exists(self.offset_filename):
+                    os.unlink(self.offset_filename)
+                return
+            # Replace the file to never leave a partially written offset
+            tmp_filename = self.offset_filename + ".tmp"
+            with open(tmp_filename, "w") as fp:
+                fp.write(str(self.offset))
+            os.replace(tmp_filename, self.offset_filename)
+        except OSError as e:
+            logger.warning("Unable to write spool offset file %s: %s", self.offset_filename, e)
+
+    def close(self):
+        self.fp.close()
+
+
 class hpclient(connection):
-    def __init__(self, server, port, ident, secret):
+    def __init__(self, server, port, ident, secret, max_queue_bytes=4*1024**2, spool_file=None,
+                 max_spool_bytes=100*1024**2, max_send_bytes=64*1024):
         logger.debug('hpclient init')
         connection.__init__(self, 'tcp')
         self.unpacker = FeedUnpack()
         self.ident, self.secret = ident.encode('latin1'), secret.encode('latin1')
 
-        self.connect(server, port)
-        self.timeouts.reconnect = 10.0
-        self.sendfiles = []
-        self.msgqueue = []
+        self.sendfiles = deque()
+        # (enqueue time, frame)
+        self.msgqueue = deque()
+        self.msgqueue_bytes = 0
+        self.max_queue_bytes = max_queue_bytes
+        self.max_send_bytes = max_send_bytes
+        self.spool = None
+        if spool_file:
+            self.spool = FrameSpool(spool_file, max_spool_bytes)
+        self.dropped = 0
         self.filehandle = None
         self.connected = False
+        self.authenticated = False
+        self.sending = False
+
+        self.connect(server, port)
+        self.timeouts.reconnect = 10.0
 
     def handle_established(self):
         self.connected = True
@@ -186,6 +313,9 @@ class hpclient(connection):
                     name, rand = strunpack8(data)
                     logger.debug('hpclient server name {0} rand {1}'.format(name, rand))
                     self.send(msgauth(rand, self.ident, self.secret))
+                    # replay everything queued while we were disconnected
+                    self.authenticated = True
+                    self.flush()
 
                 elif opcode == OP_PUBLISH:
                     ident, data = strunpack8(data)
@@ -203,30 +333,89 @@ class hpclient(connection):
         return len(indata)
 
     def handle_io_out(self):
+        self.sending = False
         if self.filehandle:
             self.sendfiledata()
         else:
-            if self.msgqueue:
-                m = self.msgqueue.pop(0)
-                self.send(m)
+            self.flush()
 
     def publish(self, channel, **kwargs):
-        if self.filehandle:
-            self.msgqueue.append(
-                msgpublish(self.ident, channel, json.dumps(kwargs).encode('latin1'))
-            )
-        else:
-            self.send(
-                msgpublish(self.ident, channel, json.dumps(kwargs).encode('latin1'))
-            )
+        self.enqueue(msgpublish(self.ident, channel, json.dumps(kwargs).encode('latin1')))
+        self.flush()
+
+    def enqueue(self, frame):
+        # keep the order, if frames are spooled all new frames have to be spooled too
+        if self.spool is not None and (len(self.spool) > 0 or self.msgqueue_bytes + len(frame) > self.max_queue_bytes):
+            if not self.spool.append(frame):
+                self.dropped += 1
+            return
+
+        while self.msgqueue and self.msgqueue_bytes + len(frame) > self.max_queue_bytes:
+            t, old_frame = self.msgqueue.popleft()
+            self.msgqueue_bytes -= len(old_frame)
+            self.dropped += 1
+        self.msgqueue.append((time.monotonic(), frame))
+        self.msgqueue_bytes += len(frame)
+
+    def flush(self):
+        """
+        Send queued frames, small frames are coalesced into one send() call.
+        """
+        if not self.authenticated or self.filehandle or self.sending:
+            return
+
+        if not self.msgqueue and self.spool is not None and len(self.spool) > 0:
+            t = self.spool.oldest
+            for frame in self.spool.read(self.max_queue_bytes // 2):
+                self.msgqueue.append((t, frame))
+                self.msgqueue_bytes += len(frame)
+
+        if not self.msgqueue:
+            if self.sendfiles:
+                self.sendfileheader(self.sendfiles.popleft())
+                self.sendfiledata()
+            return
+
+        frames = []
+        size = 0
+        while self.msgqueue and size < self.max_send_bytes:
+            t, frame = self.msgqueue.popleft()
+            frames.append(frame)
+            size += len(frame)
+        self.msgqueue_bytes -= size
+        self.sending = True
+        self.send(b"".join(frames))
+
+    def stats(self):
+        """
+        :return: Queue length, size in bytes, size of the spool in bytes, number of dropped frames and the age of
+                 the oldest queued frame in milliseconds
+        :rtype: dict
+        """
+        oldest = None
+        if self.msgqueue:
+            oldest = self.msgqueue[0][0]
+        spool_bytes = 0
+        if self.spool is not None:
+            spool_bytes = len(self.spool)
+            if oldest is None and self.spool.oldest is not None:
+                oldest = self.spool.oldest
+        lag = 0
+        if oldest is not None:
+            lag = int((time.monotonic() - oldest) * 1000)
+        return {
+            "queue_length": len(self.msgqueue),
+            "queue_bytes": self.msgqueue_bytes,
+            "spool_bytes": spool_bytes,
+            "dropped": self.dropped,
+            "files": len(self.sendfiles),
+            "lag": lag,
+        }
 
     def sendfile(self, filepath):
         # does not read complete binary into memory, read and send chunks
-        if not self.filehandle:
-            self.sendfileheader(filepath)
-            self.sendfiledata()
-        else:
-            self.sendfiles.append(filepath)
+        self.sendfiles.append(filepath)
+        self.flush()
 
     def sendfileheader(self, filepath):
         self.filehandle = open(filepath, 'rb')
@@ -238,35 +427,59 @@ class hpclient(connection):
     def sendfiledata(self):
         tmp = self.filehandle.read(BUFSIZ)
         if not tmp:
-            if self.sendfiles:
-                fp = self.sendfiles.pop(0)
-                self.sendfileheader(fp)
-            else:
-                self.filehandle = None
-                self.handle_io_in(b'')
+            self.filehandle.close()
+            self.filehandle = None
+            self.handle_io_in(b'')
+            self.flush()
         else:
+            self.sending = True
             self.send(tmp)
 
     def handle_timeout_idle(self):
         pass
 
+    def _reset(self):
+        self.connected = False
+        self.authenticated = False
+        self.sending = False
+        if self.filehandle:
+            # send the file again after reconnect
+            self.sendfiles.appendleft(self.filehandle.name)
+            self.filehandle.close()
+            self.filehandle = None
+
     def handle_disconnect(self):
         logger.info('hpclient disconnect')
-        self.connected = False
+        self._reset()
         return 1
 
     def handle_error(self, err):
         logger.warn('hpclient error {0}'.format(err))
-        self.connected = False
+        self._reset()
         return 1
 
 
 class hpfeedihandler(ihandler):
     def __init__(self, path, config=None):
         logger.debug('hpfeedhandler init')
-        self.client = hpclient(config['server'], int(config['port']), config['ident'], config['secret'])
+        queue_config = config.get("queue", {})
+        self.client = hpclient(
+            config['server'],
+            int(config['port']),
+            config['ident'],
+            config['secret'],
+            max_queue_bytes=int(queue_config.get("max_bytes", 4*1024**2)),
+            spool_file=queue_config.get("spool_file"),
+            max_spool_bytes=int(queue_config.get("max_spool_bytes", 100*1024**2))
+        )
         ihandler.__init__(self, path)
 
+        self.stats_timer = None
+        stats_interval = float(config.get("stats_interval", 60))
+        if stats_interval > 0 and pyev is not None:
+            self.stats_timer = pyev.Timer(stats_interval, stats_interval, pyev.default_loop(), self._report_stats)
+            self.stats_timer.start()
+
         self.dynip_resolve = config.get('dynip_resolve', '')
         self.dynip_timer = None
         self.ownip = None
@@ -280,6 +493,11 @@ class hpfeedihandler(ihandler):
                 self.dynip_timer.start()
 
     def stop(self):
+        if self.stats_timer:
+            self.stats_timer.stop()
+            self.stats_timer = None
+        if self.client.spool is not None:
+            self.client.spool.close()
         if self.dynip_timer:
             self.dynip_timer.stop()
             self.dynip_timer = None
@@ -373,7 +591,7 @@ class hpfeedihandler(ihandler):
 
     def handle_incident_dionaea_download_complete_unique(self, i):
         self.handle_incident_dionaea_download_complete_again(i)
-        if not hasattr(i, 'con') or not self.client.connected:
+        if not hasattr(i, 'con'):
             return
         logger.debug('unique complete, publishing md5 {0}, path {1}'.format(i.md5hash, i.file))
         try:
@@ -382,11 +600,11 @@ class hpfeedihandler(ihandler):
             logger.warn('exception when publishing: {0}'.format(e))
 
     def handle_incident_dionaea_download_complete_again(self, i):
-        if not hasattr(i, 'con') or not self.client.connected: return
+        if not hasattr(i, 'con'): return
         logger.debug('hash complete, publishing md5 {0}, path {1}'.format(i.md5hash, i.file))
         try:
             tstamp = timestr()
-            sha512 = sha512file(i.file)
+            sha512 = get_file_hash(i, "sha512")
             self.client.publish(
                 CAPTURECHAN,
                 time=tstamp,
@@ -402,7 +620,7 @@ class hpfeedihandler(ihandler):
             logger.warn('exception when publishing: {0}'.format(e))
 
     def handle_incident_dionaea_modules_python_smb_dcerpc_request(self, i):
-        if not hasattr(i, 'con') or not self.client.connected:
+        if not hasattr(i, 'con'):
             return
         logger.debug('dcerpc request, publishing uuid {0}, opnum {1}'.format(i.uuid, i.opnum))
         try:
@@ -419,7 +637,7 @@ class hpfeedihandler(ihandler):
             logger.warn('exception when publishing: {0}'.format(e))
 
     def handle_incident_dionaea_module_emu_profile(self, icd):
-        if not hasattr(icd, 'con') or not self.client.connected:
+        if not hasattr(icd, 'con'):
             return
         logger.debug('emu profile, publishing length {0}'.format(len(icd.profile)))
         try:
@@ -427,6 +645,14 @@ class hpfeedihandler(ihandler):
         except Exception as e:
             logger.warn('exception when publishing: {0}'.format(e))
 
+    def _report_stats(self, watcher, events):
+        stats = self.client.stats()
+        logger.debug("queue stats {0}".format(stats))
+        i = incident("dionaea.modules.python.hpfeeds.stats")
+        for k, v in stats.items():
+            i.set(k, v)
+        i.report()
+
     def _dynip_resolve(self, events, data):
         i = incident("dionaea.upload.request")
         i._url = self.dynip_resolve
@@ -28,7 +28,7 @@
 
 from dionaea import ServiceLoader
 from dionaea.core import connection, g_dionaea, incident, ihandler
-from dionaea.util import detect_shellshock
+from dionaea.util import detect_shellshock_lines, DirectoryListingCache
 from dionaea.exception import ServiceConfigError
 from collections import OrderedDict
 import logging
@@ -53,21 +53,30 @@ logger.setLevel(logging.DEBUG)
 
 STATE_HEADER, STATE_SENDFILE, STATE_POST, STATE_PUT = range(0, 4)
 
+listing_cache = DirectoryListingCache()
+
 
 class FileListItem(object):
-    def __init__(self, path, name):
+    def __init__(self, path, name, entry=None):
         self.path = path
         self.name = name
+        self._entry = entry
         self._size = None
         self._stat = None
         self._file_type = None
 
+    @classmethod
+    def from_entry(cls, path, entry):
+        return cls(path=path, name=entry.name, entry=entry)
+
     @property
     def fullname(self):
         return os.path.join(self.path, self.name)
 
     @property
     def is_dir(self):
+        if self._entry is not None:
+            return self._entry.is_dir()
         return os.path.isdir(self.fullname)
 
     @property
@@ -76,6 +85,8 @@ class FileListItem(object):
 
     @property
     def is_link(self):
+        if self._entry is not None:
+            return self._entry.is_symlink()
         return os.path.islink(self.fullname)
 
     @property
@@ -85,7 +96,10 @@ class FileListItem(object):
     @property
     def stat(self):
         if self._stat is None:
-            self._stat = os.stat(self.fullname)
+            if self._entry is not None:
+                self._stat = self._entry.stat()
+            else:
+                self._stat = os.stat(self.fullname)
         return self._stat
 
 
@@ -454,8 +468,7 @@ class httpd(connection):
             data = data[soc:]
             self.header = httpreq(header)
             self.header.log_req()
-            for n, v in self.header.headers.items():
-                detect_shellshock(self, v)
+            detect_shellshock_lines(self, self.header.headers.values())
 
             if self.header.type == b'GET':
                 self.handle_GET()
@@ -764,55 +777,29 @@ class httpd(connection):
 
         """
         try:
-            filenames = os.listdir(path)
+            files = listing_cache.get(
+                path,
+                self._build_file_list,
+                key=("files", self.template_file_extension)
+            )
         except os.error:
             self.send_error(404, "No permission to list directory")
             return None
 
-        files = []
-        for name in filenames:
-            if name.endswith(self.template_file_extension):
-                # ToDo: add templates to the file list
-                # How to calculate the size of the template file
-                continue
-            files.append(
-                FileListItem(
-                    path=path,
-                    name=name
-                )
-            )
-
         content = self._render_global_autoindex(files=files)
         enc = "utf-8"
         if content is None:
-            files.sort(key=lambda a: a.name.lower())
-            r = []
-            displaypath = html.escape(self.header.path)
-            r.append('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
-            r.append("<html>\n<title>Directory listing for %s</title>\n" % displaypath)
-            r.append("<body>\n<h2>Directory listing for %s</h2>\n" % displaypath)
-            r.append("<hr>\n<ul>\n")
-            r.append('<li><a href="../">../</a>\n')
-
-            for file in files:
-                displayname = linkname = file.name
-                # Append / for directories or @ for symbolic links
-                if file.is_dir:
-                    displayname = file.name + "/"
-                    linkname = file.name + "/"
-                if file.is_link:
-                    displayname = file.name + "@"
-                    # Note: a link to a directory displays with @ and links with /
-                r.append(
-                    '<li><a href="%s">%s</a>\n' % (
-                        urllib.parse.quote(linkname),
-                        html.escape(displayname)
-                    )
-                )
-
-            r.append("</ul>\n<hr>\n</body>\n</html>\n")
+            # The built-in listing only depends on the directory and the requested path, so cache the result
             enc = sys.getfilesystemencoding()
-            content = "".join(r).encode(enc)
+            try:
+                content = listing_cache.get(
+                    path,
+                    lambda entries: self._render_directory_listing(self._build_file_list(entries), enc),
+                    key=("html", self.template_file_extension, self.header.path)
+                )
+            except os.error:
+                self.send_error(404, "No permission to list directory")
+                return None
 
         if isinstance(content, str):
             content = content.encode("utf-8")
@@ -833,6 +820,50 @@ class httpd(connection):
         f.seek(0)
         return f
 
+    def _build_file_list(self, entries):
+        files = []
+        for entry in entries:
+            if entry.name.endswith(self.template_file_extension):
+                # ToDo: add templates to the file list
+                # How to calculate the size of the template file
+                continue
+            files.append(
+                FileListItem.from_entry(
+                    path=os.path.dirname(entry.path),
+                    entry=entry
+                )
+            )
+        return files
+
+    def _render_directory_listing(self, files, enc):
+        files.sort(key=lambda a: a.name.lower())
+        r = []
+        displaypath = html.escape(self.header.path)
+        r.append('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
+        r.append("<html>\n<title>Directory listing for %s</title>\n" % displaypath)
+        r.append("<body>\n<h2>Directory listing for %s</h2>\n" % displaypath)
+        r.append("<hr>\n<ul>\n")
+        r.append('<li><a href="../">../</a>\n')
+
+        for file in files:
+            displayname = linkname = file.name
+            # Append / for directories or @ for symbolic links
+            if file.is_dir:
+                displayname = file.name + "/"
+                linkname = file.name + "/"
+            if file.is_link:
+                displayname = file.name + "@"
+                # Note: a link to a directory displays with @ and links with /
+            r.append(
+                '<li><a href="%s">%s</a>\n' % (
+                    urllib.parse.quote(linkname),
+                    html.escape(displayname)
+                )
+            )
+
+        r.append("</ul>\n<hr>\n</body>\n</html>\n")
+        return "".join(r).encode(enc)
+
     def send_response(self, code, message=None):
         if message is None:
             if code in self.responses:
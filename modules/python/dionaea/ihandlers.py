@@ -69,6 +69,16 @@ def start():
             elif handlers is not None:
                 g_handlers[h].append(handlers)
 
+    for h in IHandlerLoader:
+        if h.required and h not in g_handlers:
+            logger.info("Starting required ihandler %s with default config", h.name)
+            g_handlers[h] = []
+            handlers = h.start(config={})
+            if isinstance(handlers, (list, tuple)):
+                g_handlers[h] += handlers
+            elif handlers is not None:
+                g_handlers[h].append(handlers)
+
     for handler_loader, ihandlers in g_handlers.items():
         for i in ihandlers:
             logger.info("Starting %s", str(i))
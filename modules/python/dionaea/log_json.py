@@ -249,7 +249,7 @@ class LogJsonHandler(ihandler):
         else:
             logger.warn("no attack data for %s:%s" % (con.local.host, con.local.port))
 
-    def handle_incident_dionaea_modules_python_ftp_command(self, icd):
+    def handle_incident_dionaea_modules_python_ftp_commands(self, icd):
         con = icd.con
         data = self.attacks.get(con)
         if not data:
@@ -261,10 +261,11 @@ class LogJsonHandler(ihandler):
         if "commands" not in data["ftp"]:
             data["ftp"]["commands"] = []
 
-        data["ftp"]["commands"].append({
-            "command": self._prepare_value(icd.command),
-            "arguments": self._prepare_value(icd.arguments)
-        })
+        for command in icd.commands:
+            data["ftp"]["commands"].append({
+                "command": self._prepare_value(command.get("command")),
+                "arguments": self._prepare_value(command.get("arguments"))
+            })
 
     def handle_incident_dionaea_modules_python_ftp_login(self, icd):
         self._append_credentials(icd)
@@ -1,9 +1,13 @@
+import functools
 import logging
+import math
 
 from dionaea import ServiceLoader
 from dionaea.core import connection, incident
 from dionaea.exception import ServiceConfigError
+from . import binary
 from .command import Command
+from .store import STAT_NAMES, SourceBudget, Store
 from .var import VarHandler
 
 
@@ -19,91 +23,129 @@ class MemcacheService(ServiceLoader):
         if config is None:
             config = {}
 
-        daemon = Memcache(proto="tcp")
-        try:
-            daemon.apply_config(config)
-        except ServiceConfigError as e:
-            logger.error(e.msg, *e.args)
+        protocols = config.get("protocols", ["tcp", "udp"])
+        if not isinstance(protocols, list):
+            logger.error("Setting protocols must be a list")
             return
 
-        daemon.bind(addr, 11211, iface=iface)
-        daemon.listen()
+        daemons = []
+        parent = None
+        for proto in protocols:
+            daemon = Memcache(proto=proto)
+            try:
+                if parent is None:
+                    daemon.apply_config(config)
+                    parent = daemon
+                else:
+                    # Use the same store for all protocols
+                    daemon.apply_parent_config(parent)
+            except ServiceConfigError as e:
+                logger.error(e.msg, *e.args)
+                return
+
+            daemon.bind(addr, 11211, iface=iface)
+            daemon.listen()
+            daemons.append(daemon)
 
-        return [daemon]
+        return daemons
 
 
 class Memcache(connection):
-    stat_vars = VarHandler()
+    shared_config_values = [
+        "budget",
+        "stat_vars",
+        "store",
+        "udp_budget"
+    ]
 
     def __init__(self, proto="tcp"):
         logger.debug("start memcache")
         connection.__init__(self, proto)
         self.command = None
+        self.budget = None
+        self.stat_vars = None
+        self.store = None
+        self.udp_budget = None
+        # Replies of all commands processed in one handle_io_in() call
+        self._out = bytearray()
+        self._quit = False
 
     def _handle_add(self, data):
-        read_len = self._handle_storage_command(data)
-        if read_len == 0:
-            return 0
-        self.command = None
-        self._send_line("STORED")
-        return read_len
+        return self._handle_storage_command(data, self.store.add)
 
     def _handle_append(self, data):
-        read_len = self._handle_storage_command(data)
-        if read_len == 0:
-            return 0
-        self.command = None
-        self._send_line("STORED")
-        return read_len
+        return self._handle_storage_command(data, self.store.append)
+
+    def _handle_cas(self, data):
+        return self._handle_storage_command(data, self.store.cas, cas_unique=self.command.cas_unique)
 
     def _handle_decr(self, data):
+        self._send_reply(self.store.decr(self.command.key, self.command.value))
         self.command = None
-        self._send_line("NOT_FOUND")
         return 0
 
     def _handle_delete(self, data):
+        self._send_reply(self.store.delete(self.command.key))
         self.command = None
-        self._send_line("DELETED")
         return 0
 
     def _handle_get(self, data):
+        out = self._out
+        for key in self.command.keys:
+            item = self.store.get(key)
+            if item is None:
+                continue
+            if self.command.with_cas:
+                line = b"VALUE " + key + (" %d %d %d\r\n" % (item.flags, len(item.value), item.cas)).encode()
+            else:
+                line = b"VALUE " + key + (" %d %d\r\n" % (item.flags, len(item.value))).encode()
+            if not self._consume_budget(len(line) + len(item.value) + 2):
+                # Reply as if the remaining keys do not exist
+                break
+            out += line
+            out += item.value
+            out += b"\r\n"
+        out += b"END\r\n"
         self.command = None
-        self._send_line("END")
         return 0
 
     def _handle_incr(self, data):
+        self._send_reply(self.store.incr(self.command.key, self.command.value))
         self.command = None
-        self._send_line("NOT_FOUND")
         return 0
 
     def _handle_prepend(self, data):
-        read_len = self._handle_storage_command(data)
-        if read_len == 0:
-            return 0
-        self.command = None
-        self._send_line("STORED")
-        return read_len
+        return self._handle_storage_command(data, self.store.prepend)
 
     def _handle_replace(self, data):
-        read_len = self._handle_storage_command(data)
-        if read_len == 0:
-            return 0
-        self.command = None
-        self._send_line("STORED")
-        return read_len
+        return self._handle_storage_command(data, self.store.replace)
 
     def _handle_set(self, data):
-        read_len = self._handle_storage_command(data)
-        if read_len == 0:
-            return 0
-        self.command = None
-        self._send_line("STORED")
-        return read_len
+        return self._handle_storage_command(data, self.store.set)
 
-    def _handle_storage_command(self, data):
-        if len(data) < self.command.byte_count + 2:
+    def _handle_storage_command(self, data, func, **kwargs):
+        byte_count = self.command.byte_count
+        if byte_count > self.store.max_item_size:
+            # Do not buffer the data block
+            logger.warning("Data block of storage command too large (%d bytes), closing connection", byte_count)
+            self._send_line("SERVER_ERROR object too large for cache")
+            self._quit = True
+            self.command = None
+            return len(data)
+        if len(data) < byte_count + 2:
             return 0
-        return self.command.byte_count + 2
+        if data[byte_count:byte_count + 2] != b"\r\n":
+            self._send_line("CLIENT_ERROR bad data chunk")
+        else:
+            self._send_reply(func(
+                self.command.key,
+                bytes(data[:byte_count]),
+                flags=self.command.flags,
+                exptime=self.command.exptime,
+                **kwargs
+            ))
+        self.command = None
+        return byte_count + 2
 
     def _handle_stats(self, data):
         if self.command.sub_command is None:
@@ -124,41 +166,299 @@ class Memcache(connection):
         return 0
 
     def _handle_touch(self, data):
+        self._send_reply(self.store.touch(self.command.key, self.command.exptime))
         self.command = None
-        self._send_line("TOUCHED")
         return 0
 
+    def _consume_budget(self, count):
+        if self.budget.consume(self.remote.host, count):
+            return True
+        logger.info("Byte budget of %s exhausted, truncating response", self.remote.host)
+        return False
+
     def _send_line(self, line):
-        self.send(line + "\r\n")
+        self._out += line.encode("ascii")
+        self._out += b"\r\n"
+
+    def _send_reply(self, line):
+        if self.command.noreply:
+            return
+        self._send_line(line)
 
     def apply_config(self, config):
         from .var import CFG_STAT_VARS
+        try:
+            self.store = Store(
+                max_bytes=int(config.get("max_bytes", 16 * 1024 * 1024)),
+                max_item_size=int(config.get("max_item_size", 1024 * 1024))
+            )
+            budget_config = config.get("source_budget", {})
+            self.budget = SourceBudget(
+                rate=float(budget_config.get("rate", 64 * 1024)),
+                capacity=float(budget_config.get("capacity", 1024 * 1024)),
+                max_sources=int(budget_config.get("max_sources", 10000))
+            )
+            budget_config = config.get("udp_budget", {})
+            self.udp_budget = SourceBudget(
+                rate=float(budget_config.get("rate", 2800)),
+                capacity=float(budget_config.get("capacity", 14000)),
+                max_sources=int(budget_config.get("max_sources", 10000))
+            )
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ServiceConfigError("Unable to parse config: %s", e)
+
+        self.stat_vars = VarHandler()
         self.stat_vars.load(CFG_STAT_VARS)
+        for name in STAT_NAMES:
+            self.stat_vars.bind(name, functools.partial(self.store.get_stat, name))
 
     def handle_established(self):
         self.timeouts.idle = 10
         self.processors()
 
     def handle_io_in(self, data):
-        processed_bytes = 0
-        if self.command is None:
-            # End Of Command
-            eoc = data.find(b"\r\n")
-            if eoc == -1:
-                return 0
-            logger.info("Command line: %r", data[:eoc])
-            self.command = Command.from_line(cmd_line=data[:eoc])
-            # End of Line
-            processed_bytes = eoc + 2
+        if self.transport == "udp":
+            self._handle_udp(data)
+            return len(data)
+
+        processed_bytes = self._process(data)
+        self._flush()
+        if self._quit:
+            self.close()
+        return processed_bytes
+
+    def _flush(self):
+        if len(self._out) > 0:
+            self.send(bytes(self._out))
+            self._out = bytearray()
+
+    def _handle_udp(self, data):
+        if len(data) < binary.UDP_HEADER.size:
+            return
+        request_id, seq_num, total, reserved = binary.UDP_HEADER.unpack_from(data)
+        if total != 1:
+            # Requests must fit into one datagram
+            return
+
+        # Every datagram is a new request, quit only ends the request
+        self.command = None
+        self._process(data[binary.UDP_HEADER.size:])
+        self.command = None
+        self._quit = False
+        if len(self._out) == 0:
+            return
+
+        out = self._out
+        self._out = bytearray()
+        chunk_size = binary.UDP_MAX_PAYLOAD_SIZE - binary.UDP_HEADER.size
+        total = int(math.ceil(len(out) / chunk_size))
+        if total > 0xffff or not self.udp_budget.consume(self.remote.host, len(out) + total * binary.UDP_HEADER.size):
+            logger.info("UDP budget of %s exhausted, dropping response", self.remote.host)
+            return
+
+        self.send_many([
+            binary.UDP_HEADER.pack(request_id, i, total, 0) + out[i * chunk_size:(i + 1) * chunk_size]
+            for i in range(total)
+        ])
+
+    def _process(self, data):
+        """
+        Process all complete commands.
+
+        :param bytes data: The received data
+        :return: Number of processed bytes
+        :rtype: int
+        """
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data) and not self._quit:
+            if self.command is None and data[offset] == binary.MAGIC_REQUEST:
+                processed_bytes = self._handle_binary(view[offset:])
+                if processed_bytes == 0:
+                    break
+                offset += processed_bytes
+                continue
+
             if self.command is None:
-                logger.warning("Unable to detect command or unsupported command")
-                self._send_line("ERROR")
-                return processed_bytes
-            logger.debug("Using command class to process data '%r'", self.command)
-            data = data[processed_bytes:]
+                # End Of Command
+                eoc = data.find(b"\r\n", offset)
+                if eoc == -1:
+                    break
+                cmd_line = data[offset:eoc]
+                # End of Line
+                offset = eoc + 2
+                logger.info("Command line: %r", cmd_line)
+                self.command = Command.from_line(cmd_line=cmd_line)
+                if self.command is None:
+                    logger.warning("Unable to detect command or unsupported command")
+                    self._send_line("ERROR")
+                    continue
+                logger.debug("Using command class to process data '%r'", self.command)
 
-        if self.command is not None:
             func = getattr(self, "_handle_%s" % self.command.name)
-            processed_bytes = processed_bytes + func(data)
+            processed_bytes = func(view[offset:])
+            assert processed_bytes >= 0, "Handler %s returned %d" % (self.command.name, processed_bytes)
+            offset += processed_bytes
+            if self.command is not None:
+                # Wait for the data block of the storage command
+                break
 
-        return processed_bytes
+        return offset
+
+    def _handle_binary(self, data):
+        if len(data) < binary.HEADER.size:
+            return 0
+        (magic, opcode, key_length, extras_length, data_type, vbucket, body_length, opaque,
+            cas) = binary.HEADER.unpack_from(data)
+        if body_length > self.store.max_item_size + binary.HEADER.size:
+            logger.warning("Body of binary request too large (%d bytes), closing connection", body_length)
+            self._quit = True
+            return len(data)
+        if len(data) < binary.HEADER.size + body_length:
+            return 0
+
+        body = bytes(data[binary.HEADER.size:binary.HEADER.size + body_length])
+        extras = body[:extras_length]
+        key = body[extras_length:extras_length + key_length]
+        value = body[extras_length + key_length:]
+
+        name, quiet = binary.OPCODES.get(opcode, (None, False))
+        logger.info("Binary command: %s key=%r", name, key)
+        if name is None or extras_length + key_length > body_length:
+            self._out += binary.build_response(opcode, opaque, status=binary.STATUS_UNKNOWN_COMMAND)
+        else:
+            func = getattr(self, "_handle_binary_%s" % name)
+            try:
+                func(opcode, quiet, opaque, cas, extras, key, value)
+            except binary.struct.error:
+                self._out += binary.build_response(opcode, opaque, status=binary.STATUS_INVALID_ARGUMENTS)
+        return binary.HEADER.size + body_length
+
+    def _send_binary_reply(self, opcode, quiet, opaque, reply, key=b""):
+        status = binary.get_status(reply)
+        if quiet and status == binary.STATUS_NO_ERROR:
+            return
+        cas = 0
+        item = self.store.items.get(key)
+        if status == binary.STATUS_NO_ERROR and item is not None:
+            cas = item.cas
+        self._out += binary.build_response(opcode, opaque, status=status, cas=cas)
+
+    def _handle_binary_add(self, opcode, quiet, opaque, cas, extras, key, value):
+        flags, exptime = binary.EXTRAS_STORAGE.unpack(extras)
+        reply = self.store.add(key, value, flags=flags, exptime=exptime)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_append(self, opcode, quiet, opaque, cas, extras, key, value):
+        reply = self.store.append(key, value)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_decr(self, opcode, quiet, opaque, cas, extras, key, value):
+        self._handle_binary_counter(self.store.decr, opcode, quiet, opaque, extras, key)
+
+    def _handle_binary_delete(self, opcode, quiet, opaque, cas, extras, key, value):
+        reply = self.store.delete(key)
+        self._send_binary_reply(opcode, quiet, opaque, reply)
+
+    def _handle_binary_gat(self, opcode, quiet, opaque, cas, extras, key, value):
+        exptime, = binary.EXTRAS_EXPTIME.unpack(extras)
+        self.store.touch(key, exptime)
+        self._handle_binary_get(opcode, quiet, opaque, cas, b"", key, value)
+
+    def _handle_binary_get(self, opcode, quiet, opaque, cas, extras, key, value, with_key=False):
+        item = self.store.get(key)
+        if item is not None:
+            response_key = key if with_key else b""
+            size = binary.HEADER.size + binary.EXTRAS_FLAGS.size + len(response_key) + len(item.value)
+            if not self._consume_budget(size):
+                item = None
+        if item is None:
+            if not quiet:
+                self._out += binary.build_response(
+                    opcode,
+                    opaque,
+                    status=binary.STATUS_KEY_NOT_FOUND,
+                    key=key if with_key else b""
+                )
+            return
+        self._out += binary.build_response(
+            opcode,
+            opaque,
+            extras=binary.EXTRAS_FLAGS.pack(item.flags),
+            key=response_key,
+            value=item.value,
+            cas=item.cas
+        )
+
+    def _handle_binary_getk(self, opcode, quiet, opaque, cas, extras, key, value):
+        self._handle_binary_get(opcode, quiet, opaque, cas, extras, key, value, with_key=True)
+
+    def _handle_binary_counter(self, func, opcode, quiet, opaque, extras, key):
+        delta, initial, exptime = binary.EXTRAS_COUNTER.unpack(extras)
+        reply = func(key, delta)
+        if reply == "NOT_FOUND" and exptime != binary.EXPTIME_NO_CREATE:
+            self.store.set(key, str(initial).encode("ascii"), exptime=exptime)
+            reply = str(initial)
+        status = binary.get_status(reply)
+        if status != binary.STATUS_NO_ERROR:
+            self._out += binary.build_response(opcode, opaque, status=status)
+            return
+        if quiet:
+            return
+        self._out += binary.build_response(
+            opcode,
+            opaque,
+            value=binary.COUNTER_VALUE.pack(int(reply)),
+            cas=self.store.items[key].cas
+        )
+
+    def _handle_binary_incr(self, opcode, quiet, opaque, cas, extras, key, value):
+        self._handle_binary_counter(self.store.incr, opcode, quiet, opaque, extras, key)
+
+    def _handle_binary_noop(self, opcode, quiet, opaque, cas, extras, key, value):
+        self._out += binary.build_response(opcode, opaque)
+
+    def _handle_binary_prepend(self, opcode, quiet, opaque, cas, extras, key, value):
+        reply = self.store.prepend(key, value)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_quit(self, opcode, quiet, opaque, cas, extras, key, value):
+        if not quiet:
+            self._out += binary.build_response(opcode, opaque)
+        self._quit = True
+
+    def _handle_binary_replace(self, opcode, quiet, opaque, cas, extras, key, value):
+        flags, exptime = binary.EXTRAS_STORAGE.unpack(extras)
+        if cas != 0:
+            reply = self.store.cas(key, value, flags=flags, exptime=exptime, cas_unique=cas)
+        else:
+            reply = self.store.replace(key, value, flags=flags, exptime=exptime)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_set(self, opcode, quiet, opaque, cas, extras, key, value):
+        flags, exptime = binary.EXTRAS_STORAGE.unpack(extras)
+        if cas != 0:
+            reply = self.store.cas(key, value, flags=flags, exptime=exptime, cas_unique=cas)
+        else:
+            reply = self.store.set(key, value, flags=flags, exptime=exptime)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_stat(self, opcode, quiet, opaque, cas, extras, key, value):
+        if key == b"":
+            for name, var in self.stat_vars.values.items():
+                self._out += binary.build_response(
+                    opcode,
+                    opaque,
+                    key=name.encode("ascii"),
+                    value=str(var).encode("ascii")
+                )
+        self._out += binary.build_response(opcode, opaque)
+
+    def _handle_binary_touch(self, opcode, quiet, opaque, cas, extras, key, value):
+        exptime, = binary.EXTRAS_EXPTIME.unpack(extras)
+        reply = self.store.touch(key, exptime)
+        self._send_binary_reply(opcode, quiet, opaque, reply, key)
+
+    def _handle_binary_version(self, opcode, quiet, opaque, cas, extras, key, value):
+        version = self.stat_vars.values.get("version")
+        self._out += binary.build_response(opcode, opaque, value=str(version).encode("ascii"))
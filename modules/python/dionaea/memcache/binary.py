@@ -0,0 +1,114 @@
+import struct
+
+MAGIC_REQUEST = 0x80
+MAGIC_RESPONSE = 0x81
+
+# magic, opcode, key length, extras length, data type, vbucket id/status, total body length, opaque, cas
+HEADER = struct.Struct(">BBHBBHIIQ")
+
+# request id, sequence number, total number of datagrams, reserved
+UDP_HEADER = struct.Struct(">HHHH")
+# memcached does not send datagrams larger than this, including the frame header
+UDP_MAX_PAYLOAD_SIZE = 1400
+
+EXTRAS_FLAGS = struct.Struct(">I")
+EXTRAS_STORAGE = struct.Struct(">II")
+EXTRAS_COUNTER = struct.Struct(">QQI")
+EXTRAS_EXPTIME = struct.Struct(">I")
+COUNTER_VALUE = struct.Struct(">Q")
+
+# Do not create the item if incr/decr is called with this exptime
+EXPTIME_NO_CREATE = 0xffffffff
+
+STATUS_NO_ERROR = 0x00
+STATUS_KEY_NOT_FOUND = 0x01
+STATUS_KEY_EXISTS = 0x02
+STATUS_VALUE_TOO_LARGE = 0x03
+STATUS_INVALID_ARGUMENTS = 0x04
+STATUS_ITEM_NOT_STORED = 0x05
+STATUS_NON_NUMERIC = 0x06
+STATUS_UNKNOWN_COMMAND = 0x81
+
+STATUS_MESSAGES = {
+    STATUS_KEY_NOT_FOUND: b"Not found",
+    STATUS_KEY_EXISTS: b"Data exists for key.",
+    STATUS_VALUE_TOO_LARGE: b"Too large.",
+    STATUS_INVALID_ARGUMENTS: b"Invalid arguments",
+    STATUS_ITEM_NOT_STORED: b"Not stored.",
+    STATUS_NON_NUMERIC: b"Non-numeric server-side value for incr or decr",
+    STATUS_UNKNOWN_COMMAND: b"Unknown command",
+}
+
+# opcode -> (command name, quiet)
+OPCODES = {
+    0x00: ("get", False),
+    0x01: ("set", False),
+    0x02: ("add", False),
+    0x03: ("replace", False),
+    0x04: ("delete", False),
+    0x05: ("incr", False),
+    0x06: ("decr", False),
+    0x07: ("quit", False),
+    0x09: ("get", True),
+    0x0a: ("noop", False),
+    0x0b: ("version", False),
+    0x0c: ("getk", False),
+    0x0d: ("getk", True),
+    0x0e: ("append", False),
+    0x0f: ("prepend", False),
+    0x10: ("stat", False),
+    0x11: ("set", True),
+    0x12: ("add", True),
+    0x13: ("replace", True),
+    0x14: ("delete", True),
+    0x15: ("incr", True),
+    0x16: ("decr", True),
+    0x17: ("quit", True),
+    0x19: ("append", True),
+    0x1a: ("prepend", True),
+    0x1c: ("touch", False),
+    0x1d: ("gat", False),
+    0x1e: ("gat", True),
+}
+
+
+def get_status(reply):
+    """
+    Get the status of a binary response from the response line of a text command.
+
+    :param str reply: The response line returned by the store
+    :return: The status
+    :rtype: int
+    """
+    if reply in ("STORED", "DELETED", "TOUCHED"):
+        return STATUS_NO_ERROR
+    if reply == "NOT_FOUND":
+        return STATUS_KEY_NOT_FOUND
+    if reply == "EXISTS":
+        return STATUS_KEY_EXISTS
+    if reply == "NOT_STORED":
+        return STATUS_ITEM_NOT_STORED
+    if reply.startswith("SERVER_ERROR object too large"):
+        return STATUS_VALUE_TOO_LARGE
+    if reply.startswith("CLIENT_ERROR"):
+        return STATUS_NON_NUMERIC
+    return STATUS_NO_ERROR
+
+
+def build_response(opcode, opaque, status=STATUS_NO_ERROR, extras=b"", key=b"", value=b"", cas=0):
+    """
+    Build a binary response packet. The value defaults to the message of the status.
+    """
+    if status != STATUS_NO_ERROR and value == b"":
+        value = STATUS_MESSAGES.get(status, b"")
+    return HEADER.pack(
+        MAGIC_RESPONSE,
+        opcode,
+        len(key),
+        len(extras),
+        0,
+        status,
+        len(extras) + len(key) + len(value),
+        opaque,
+        cas
+    ) + extras + key + value
@@ -1,122 +1,131 @@
-import re
+KEY_LENGTH_MAX = 250
 
 
 class Command(object):
+    noreply = None
+
     @classmethod
     def from_line(cls, cmd_line):
-        for cmd_cls in [Stats, StorageCommand, Decrement, Delete, Increment, Get, Touch]:
-            cmd = cmd_cls.from_line(cmd_line)
-            if cmd is not None:
-                return cmd
+        cmd_parts = cmd_line.split()
+        if len(cmd_parts) == 0:
+            return None
+        cmd_cls = COMMANDS.get(cmd_parts[0])
+        if cmd_cls is None:
+            return None
+        try:
+            return cmd_cls.from_parts(cmd_parts)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _check_key(key):
+        if len(key) > KEY_LENGTH_MAX:
+            raise ValueError("Key too long")
+        return key
+
+    @staticmethod
+    def _parse_uint(value):
+        # int() also accepts signs and whitespace
+        if not value.isdigit():
+            raise ValueError("Not an unsigned integer")
+        return int(value)
+
+    @staticmethod
+    def _split_noreply(cmd_parts):
+        if cmd_parts[-1] == b"noreply":
+            return cmd_parts[:-1], True
+        return cmd_parts, None
 
 
 class Decrement(Command):
     name = "decr"
-    regex_cmd = re.compile(b"^decr (?P<key>\w+) (?P<value>\d+)( (?P<noreply>noreply))?$")
 
     def __init__(self, key=None, value=0, no_reply=False):
         self.key = key
         self.value = value
+        self.noreply = no_reply
 
     @classmethod
-    def from_line(cls, cmd_line):
-        m = cls.regex_cmd.match(cmd_line)
-        if m:
-            return cls(
-                key=m.group("key"),
-                value=int(m.group("value")),
-                no_reply=m.group("noreply")
-            )
+    def from_parts(cls, cmd_parts):
+        cmd_parts, noreply = cls._split_noreply(cmd_parts)
+        if len(cmd_parts) != 3:
+            return None
+        return cls(
+            key=cls._check_key(cmd_parts[1]),
+            value=cls._parse_uint(cmd_parts[2]),
+            no_reply=noreply
+        )
 
 
 class Delete(Command):
     name = "delete"
-    regex_cmd = re.compile(b"^(?P<command>\w+) (?P<key>\w+)( (?P<noreply>noreply))?$")
 
     def __init__(self, key=None, no_reply=None):
         self.key = key
-        self.no_reply = no_reply
+        self.noreply = no_reply
 
     @classmethod
-    def from_line(cls, cmd_line):
-        m = cls.regex_cmd.match(cmd_line)
-        if m and m.group("command") == b"delete":
-            return cls(
-                key=m.group("key"),
-                no_reply=m.group("noreply")
-            )
+    def from_parts(cls, cmd_parts):
+        cmd_parts, noreply = cls._split_noreply(cmd_parts)
+        if len(cmd_parts) != 2:
+            return None
+        return cls(
+            key=cls._check_key(cmd_parts[1]),
+            no_reply=noreply
+        )
 
 
 class Get(Command):
     name = "get"
 
-    def __init__(self, keys=None):
+    def __init__(self, keys=None, with_cas=False):
         if keys is None:
             keys = []
         self.keys = keys
+        self.with_cas = with_cas
 
     @classmethod
-    def from_line(cls, cmd_line):
-        cmd_parts = cmd_line.split(b" ")
-        if len(cmd_parts) == 0:
+    def from_parts(cls, cmd_parts):
+        if len(cmd_parts) < 2:
             return None
-        if cmd_parts[0] == b"get" or cmd_parts[0] == b"gets":
-            return cls(keys=cmd_parts[1:])
-        return None
+        return cls(
+            keys=[cls._check_key(key) for key in cmd_parts[1:]],
+            with_cas=cmd_parts[0] == b"gets"
+        )
 
 
-class Increment(Command):
+class Increment(Decrement):
     name = "incr"
-    regex_cmd = re.compile(b"^incr (?P<key>\w+) (?P<value>\d+)( (?P<noreply>noreply))?$")
-
-    def __init__(self, key=None, value=0, no_reply=False):
-        self.key = key
-        self.value = value
-
-    @classmethod
-    def from_line(cls, cmd_line):
-        m = cls.regex_cmd.match(cmd_line)
-        if m:
-            return cls(
-                key=m.group("key"),
-                value=int(m.group("value")),
-                no_reply=m.group("noreply")
-            )
 
 
 class StorageCommand(Command):
-    regex_cmd = re.compile(b"^(?P<command>\w+) (?P<key>\w+) (?P<flags>\d+) (?P<exptime>\d+) (?P<byte_count>\d+)( (?P<noreply>noreply))?")
-
-    def __init__(self, key=None, flags=None, exptime=None, byte_count=None, noreply=None):
+    def __init__(self, key=None, flags=None, exptime=None, byte_count=None, noreply=None, cas_unique=None):
         self.key = key
         self.flags = flags
         self.exptime = exptime
         self.byte_count = byte_count
         self.noreply = noreply
+        self.cas_unique = cas_unique
 
     @classmethod
-    def from_line(cls, cmd_line):
-        cmd_classes = {
-            b"add": Add,
-            b"append": Append,
-            b"prepend": Prepend,
-            b"replace": Replace,
-            b"set": Set
-        }
-        m = cls.regex_cmd.match(cmd_line)
-        if m:
-            cmd_class = cmd_classes.get(m.group("command"))
-            if cmd_class is None:
+    def from_parts(cls, cmd_parts):
+        cmd_parts, noreply = cls._split_noreply(cmd_parts)
+        cas_unique = None
+        if cls is Cas:
+            if len(cmd_parts) != 6:
                 return None
+            cas_unique = cls._parse_uint(cmd_parts[5])
+        elif len(cmd_parts) != 5:
+            return None
 
-            return cmd_class(
-                key=m.group("key"),
-                flags=m.group("flags"),
-                exptime=m.group("exptime"),
-                byte_count=int(m.group("byte_count")),
-                noreply=m.group("noreply")
-            )
-        return None
+        return cls(
+            key=cls._check_key(cmd_parts[1]),
+            flags=cls._parse_uint(cmd_parts[2]),
+            exptime=int(cmd_parts[3]),
+            byte_count=cls._parse_uint(cmd_parts[4]),
+            noreply=noreply,
+            cas_unique=cas_unique
+        )
 
 
 class Add(StorageCommand):
@@ -127,6 +136,10 @@ class Append(StorageCommand):
     name = "append"
 
 
+class Cas(StorageCommand):
+    name = "cas"
+
+
 class Prepend(StorageCommand):
     name = "prepend"
 
@@ -154,31 +167,43 @@ class Stats(Command):
         return None
 
     @classmethod
-    def from_line(cls, cmd_line):
-        cmd_parts = cmd_line.split(b" ")
-        if len(cmd_parts) == 0:
-            return None
-        if cmd_parts[0] == b"stats":
-            return cls(arguments=cmd_parts[1:])
-        return None
+    def from_parts(cls, cmd_parts):
+        return cls(arguments=[arg.decode("ascii", "replace") for arg in cmd_parts[1:]])
 
 
 class Touch(Command):
     name = "touch"
-    regex_cmd = re.compile(b"^touch (?P<key>\w+) (?P<exptime>\d+)( (?P<noreply>noreply))?$")
 
     def __init__(self, key=None, exptime=None, no_reply=None):
         self.key = key
         self.exptime = exptime
-        self.no_reply = no_reply
+        self.noreply = no_reply
 
     @classmethod
-    def from_line(cls, cmd_line):
-        m = cls.regex_cmd.match(cmd_line)
-        if m:
-            return cls(
-                key=m.group("key"),
-                exptime=m.group("exptime"),
-                no_reply=m.group("noreply")
-            )
-        return None
+    def from_parts(cls, cmd_parts):
+        cmd_parts, noreply = cls._split_noreply(cmd_parts)
+        if len(cmd_parts) != 3:
+            return None
+        return cls(
+            key=cls._check_key(cmd_parts[1]),
+            exptime=int(cmd_parts[2]),
+            no_reply=noreply
+        )
+
+
+# First word of the command line -> class to parse the command
+COMMANDS = {
+    b"add": Add,
+    b"append": Append,
+    b"cas": Cas,
+    b"decr": Decrement,
+    b"delete": Delete,
+    b"get": Get,
+    b"gets": Get,
+    b"incr": Increment,
+    b"prepend": Prepend,
+    b"replace": Replace,
+    b"set": Set,
+    b"stats": Stats,
+    b"touch": Touch,
+}
@@ -0,0 +1,267 @@
+import time
+from collections import OrderedDict
+
+from dionaea.util import TokenBucket
+
+# An exptime larger than 30 days is an absolute unix timestamp
+REL_EXPTIME_MAX = 60 * 60 * 24 * 30
+
+# Per item overhead added to the size of key and value
+ITEM_OVERHEAD = 48
+
+STAT_NAMES = (
+    "curr_items",
+    "total_items",
+    "bytes",
+    "cmd_get",
+    "cmd_set",
+    "cmd_touch",
+    "get_hits",
+    "get_misses",
+    "delete_misses",
+    "delete_hits",
+    "incr_misses",
+    "incr_hits",
+    "decr_misses",
+    "decr_hits",
+    "cas_misses",
+    "cas_hits",
+    "cas_badval",
+    "touch_hits",
+    "touch_misses",
+    "evictions",
+    "reclaimed",
+    "limit_maxbytes",
+    "expired_unfetched",
+    "evicted_unfetched",
+)
+
+
+class Item(object):
+    __slots__ = ("value", "flags", "exptime", "cas", "fetched")
+
+    def __init__(self, value, flags, exptime, cas):
+        self.value = value
+        self.flags = flags
+        self.exptime = exptime
+        self.cas = cas
+        self.fetched = False
+
+    def expired(self, now):
+        return self.exptime is not None and self.exptime <= now
+
+
+class Store(object):
+    """
+    Key/value store with the semantics of memcached.
+
+    The items are kept in LRU order, the least recently used items are evicted if the size of all items exceeds
+    max_bytes. Expired items are removed on access. The methods return the response line of the command.
+
+    :param int max_bytes: Max size of all items in bytes
+    :param int max_item_size: Max size of a single item in bytes
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_item_size=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_size = max_item_size
+        # key -> Item
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.counters = dict((name, 0) for name in STAT_NAMES)
+        self._cas = 0
+
+    def get_stat(self, name):
+        if name == "curr_items":
+            return len(self.items)
+        if name == "bytes":
+            return self.bytes
+        if name == "limit_maxbytes":
+            return self.max_bytes
+        return self.counters[name]
+
+    def _exptime(self, exptime):
+        if exptime == 0:
+            return None
+        if exptime < 0:
+            return 0.0
+        if exptime > REL_EXPTIME_MAX:
+            return float(exptime)
+        return time.time() + exptime
+
+    def _size(self, key, item):
+        return len(key) + len(item.value) + ITEM_OVERHEAD
+
+    def _lookup(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item.expired(time.time()):
+            self._remove(key)
+            self.counters["reclaimed"] += 1
+            if not item.fetched:
+                self.counters["expired_unfetched"] += 1
+            return None
+        self.items.move_to_end(key)
+        return item
+
+    def _remove(self, key):
+        item = self.items.pop(key)
+        self.bytes -= self._size(key, item)
+        return item
+
+    def _put(self, key, value, flags, exptime):
+        if len(key) + len(value) + ITEM_OVERHEAD > self.max_item_size:
+            return "SERVER_ERROR object too large for cache"
+        if key in self.items:
+            self._remove(key)
+        self._cas += 1
+        item = Item(value, flags, exptime, self._cas)
+        self.items[key] = item
+        self.bytes += self._size(key, item)
+        self.counters["total_items"] += 1
+
+        while self.bytes > self.max_bytes and len(self.items) > 1:
+            evicted_key, evicted = self.items.popitem(last=False)
+            self.bytes -= self._size(evicted_key, evicted)
+            self.counters["evictions"] += 1
+            if not evicted.fetched:
+                self.counters["evicted_unfetched"] += 1
+        return "STORED"
+
+    def get(self, key):
+        """
+        :param bytes key: The key
+        :return: The item or None
+        :rtype: Item
+        """
+        self.counters["cmd_get"] += 1
+        item = self._lookup(key)
+        if item is None:
+            self.counters["get_misses"] += 1
+            return None
+        self.counters["get_hits"] += 1
+        item.fetched = True
+        return item
+
+    def set(self, key, value, flags=0, exptime=0):
+        self.counters["cmd_set"] += 1
+        return self._put(key, value, flags, self._exptime(exptime))
+
+    def add(self, key, value, flags=0, exptime=0):
+        self.counters["cmd_set"] += 1
+        if self._lookup(key) is not None:
+            return "NOT_STORED"
+        return self._put(key, value, flags, self._exptime(exptime))
+
+    def replace(self, key, value, flags=0, exptime=0):
+        self.counters["cmd_set"] += 1
+        if self._lookup(key) is None:
+            return "NOT_STORED"
+        return self._put(key, value, flags, self._exptime(exptime))
+
+    def append(self, key, value, flags=0, exptime=0):
+        self.counters["cmd_set"] += 1
+        item = self._lookup(key)
+        if item is None:
+            return "NOT_STORED"
+        # flags and exptime of the existing item are kept
+        return self._put(key, item.value + value, item.flags, item.exptime)
+
+    def prepend(self, key, value, flags=0, exptime=0):
+        self.counters["cmd_set"] += 1
+        item = self._lookup(key)
+        if item is None:
+            return "NOT_STORED"
+        return self._put(key, value + item.value, item.flags, item.exptime)
+
+    def cas(self, key, value, flags=0, exptime=0, cas_unique=0):
+        self.counters["cmd_set"] += 1
+        item = self._lookup(key)
+        if item is None:
+            self.counters["cas_misses"] += 1
+            return "NOT_FOUND"
+        if item.cas != cas_unique:
+            self.counters["cas_badval"] += 1
+            return "EXISTS"
+        self.counters["cas_hits"] += 1
+        return self._put(key, value, flags, self._exptime(exptime))
+
+    def delete(self, key):
+        if self._lookup(key) is None:
+            self.counters["delete_misses"] += 1
+            return "NOT_FOUND"
+        self._remove(key)
+        self.counters["delete_hits"] += 1
+        return "DELETED"
+
+    def incr(self, key, value):
+        return self._incr_decr("incr", key, value)
+
+    def decr(self, key, value):
+        return self._incr_decr("decr", key, value)
+
+    def _incr_decr(self, name, key, value):
+        item = self._lookup(key)
+        if item is None:
+            self.counters[name + "_misses"] += 1
+            return "NOT_FOUND"
+        try:
+            current = int(item.value.strip())
+        except ValueError:
+            return "CLIENT_ERROR cannot increment or decrement non-numeric value"
+        if current < 0 or current > 2**64 - 1:
+            return "CLIENT_ERROR cannot increment or decrement non-numeric value"
+        self.counters[name + "_hits"] += 1
+        if name == "incr":
+            # 64bit unsigned integer overflow
+            current = (current + value) % 2**64
+        else:
+            # decr does not go below 0
+            current = max(0, current - value)
+        self._put(key, str(current).encode("ascii"), item.flags, item.exptime)
+        # incr/decr are not storage commands
+        self.counters["total_items"] -= 1
+        return str(current)
+
+    def touch(self, key, exptime):
+        self.counters["cmd_touch"] += 1
+        item = self._lookup(key)
+        if item is None:
+            self.counters["touch_misses"] += 1
+            return "NOT_FOUND"
+        item.exptime = self._exptime(exptime)
+        self.counters["touch_hits"] += 1
+        return "TOUCHED"
+
+
+class SourceBudget(object):
+    """
+    Limit the number of bytes sent to a remote host, e.g. to limit amplification attacks.
+
+    :param float rate: Bytes per second
+    :param float capacity: Max number of bytes sent at once
+    :param int max_sources: Max number of remote hosts to keep track of
+    """
+    def __init__(self, rate, capacity, max_sources=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_sources = max_sources
+        # host -> TokenBucket
+        self._buckets = OrderedDict()
+
+    def consume(self, host, count):
+        """
+        :param str host: The remote host
+        :param int count: Number of bytes to send
+        :return: False if the budget of the host is exhausted
+        :rtype: bool
+        """
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[host] = bucket
+            while len(self._buckets) > self.max_sources:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(host)
+        return bucket.consume(count)
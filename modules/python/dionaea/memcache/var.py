@@ -601,11 +601,29 @@ class VarHandler(object):
                 var_params = {"value": value}
             self.values[var.get("name")] = var_cls(**var_params)
 
+    def bind(self, name, func):
+        """
+        Report the value returned by func instead of a static value.
+        """
+        self.values[name] = Callback(func)
+
 
 class BaseVar(object):
     pass
 
 
+class Callback(BaseVar):
+    def __init__(self, func):
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func()
+
+    def __str__(self):
+        return str(self.value)
+
+
 class Bool(BaseVar):
     def __init__(self, value=False):
         if not isinstance(value, bool):
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+
+
+class TopicNode(object):
+    __slots__ = ("children", "subscribers", "retained")
+
+    def __init__(self):
+        # topic level -> TopicNode
+        self.children = {}
+        # subscriber -> granted QoS of the topic filter ending at this node
+        self.subscribers = {}
+        # (topic, payload) of the retained message of the topic ending at this node
+        self.retained = None
+
+    def is_empty(self):
+        return len(self.children) == 0 and len(self.subscribers) == 0 and self.retained is None
+
+
+class TopicTree(object):
+    """
+    Trie of topic levels to match published topics against the topic filters of the subscribers and to store
+    retained messages.
+
+    Topics and topic filters are bytes, the wildcards '+' and '#' are only valid in topic filters. The trie is
+    walked without recursion.
+
+    :param int max_retained: Max number of retained messages, the oldest message is dropped if the limit is exceeded
+    :param int max_retained_bytes: Max size of the payloads of all retained messages, the oldest messages are
+                                   dropped if the limit is exceeded
+    """
+    def __init__(self, max_retained=1000, max_retained_bytes=16 * 1024 * 1024):
+        self.max_retained = max_retained
+        self.max_retained_bytes = max_retained_bytes
+        self.root = TopicNode()
+        # topic -> payload size, topics of the retained messages in the order they have been stored
+        self._retained = OrderedDict()
+        self._retained_bytes = 0
+        # subscriber -> set of topic filters
+        self._subscriptions = {}
+
+    def subscribe(self, topic_filter, subscriber, qos=0):
+        node = self.root
+        for level in topic_filter.split(b"/"):
+            child = node.children.get(level)
+            if child is None:
+                child = TopicNode()
+                node.children[level] = child
+            node = child
+        node.subscribers[subscriber] = qos
+        self._subscriptions.setdefault(subscriber, set()).add(topic_filter)
+
+    def unsubscribe(self, topic_filter, subscriber):
+        filters = self._subscriptions.get(subscriber)
+        if filters is None or topic_filter not in filters:
+            return False
+        self._remove(topic_filter.split(b"/"), lambda node: node.subscribers.pop(subscriber, None))
+        filters.discard(topic_filter)
+        if len(filters) == 0:
+            del self._subscriptions[subscriber]
+        return True
+
+    def unsubscribe_all(self, subscriber):
+        for topic_filter in list(self._subscriptions.get(subscriber, ())):
+            self.unsubscribe(topic_filter, subscriber)
+
+    def get_subscriptions(self, subscriber):
+        return self._subscriptions.get(subscriber, set())
+
+    def _remove(self, levels, func):
+        node = self.root
+        # (parent node, level) of all nodes on the path
+        path = []
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                return
+            path.append((node, level))
+            node = child
+        func(node)
+
+        # Remove nodes which are not used anymore
+        for parent, level in reversed(path):
+            if not parent.children[level].is_empty():
+                break
+            del parent.children[level]
+
+    def match(self, topic):
+        """
+        Find the subscribers of a topic.
+
+        :param bytes topic: The topic
+        :return: Dict of subscriber -> max granted QoS
+        :rtype: dict
+        """
+        levels = topic.split(b"/")
+        result = {}
+        # (node, index of the next level, wildcards allowed)
+        # Topics starting with $ are not matched by wildcards at the first level
+        pending = [(self.root, 0, not topic.startswith(b"$"))]
+        while len(pending) > 0:
+            node, i, wildcards = pending.pop()
+            if wildcards:
+                # '#' also matches the parent level
+                child = node.children.get(b"#")
+                if child is not None:
+                    self._add_subscribers(child, result)
+
+            if i == len(levels):
+                self._add_subscribers(node, result)
+                continue
+
+            child = node.children.get(levels[i])
+            if child is not None:
+                pending.append((child, i + 1, True))
+            if wildcards:
+                child = node.children.get(b"+")
+                if child is not None:
+                    pending.append((child, i + 1, True))
+        return result
+
+    def _add_subscribers(self, node, result):
+        for subscriber, qos in node.subscribers.items():
+            if result.get(subscriber, -1) < qos:
+                result[subscriber] = qos
+
+    def retain(self, topic, payload):
+        """
+        Store the retained message of a topic, an empty payload removes the message. A message larger than
+        max_retained_bytes also removes the retained message of the topic.
+
+        :param bytes topic: The topic
+        :param bytes payload: The message
+        """
+        self._retained_bytes -= self._retained.pop(topic, 0)
+        if len(payload) == 0 or len(payload) > self.max_retained_bytes:
+            self._remove(topic.split(b"/"), self._clear_retained)
+            return
+
+        node = self.root
+        for level in topic.split(b"/"):
+            child = node.children.get(level)
+            if child is None:
+                child = TopicNode()
+                node.children[level] = child
+            node = child
+        node.retained = (topic, payload)
+        self._retained[topic] = len(payload)
+        self._retained_bytes += len(payload)
+
+        while len(self._retained) > self.max_retained or self._retained_bytes > self.max_retained_bytes:
+            old_topic, size = self._retained.popitem(last=False)
+            self._retained_bytes -= size
+            self._remove(old_topic.split(b"/"), self._clear_retained)
+
+    def _clear_retained(self, node):
+        node.retained = None
+
+    def get_retained(self, topic_filter):
+        """
+        Find the retained messages matching a topic filter.
+
+        :param bytes topic_filter: The topic filter
+        :return: List of (topic, payload) tuples
+        """
+        levels = topic_filter.split(b"/")
+        result = []
+        # (node, index of the next level)
+        pending = [(self.root, 0)]
+        while len(pending) > 0:
+            node, i = pending.pop()
+            if i == len(levels):
+                if node.retained is not None:
+                    result.append(node.retained)
+                continue
+
+            level = levels[i]
+            if level == b"#":
+                self._collect_retained(node, result, i == 0)
+            elif level == b"+":
+                for name, child in node.children.items():
+                    if i == 0 and name.startswith(b"$"):
+                        continue
+                    pending.append((child, i + 1))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    pending.append((child, i + 1))
+        return result
+
+    def _collect_retained(self, node, result, root):
+        # '#' matches the parent level as well as all child levels
+        if node.retained is not None and not root:
+            result.append(node.retained)
+        pending = []
+        for name, child in node.children.items():
+            if root and name.startswith(b"$"):
+                continue
+            pending.append(child)
+        while len(pending) > 0:
+            node = pending.pop()
+            if node.retained is not None:
+                result.append(node.retained)
+            pending.extend(node.children.values())
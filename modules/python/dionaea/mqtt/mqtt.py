@@ -5,221 +5,363 @@
 #*
 #*
 #* Copyright (C) 2015  Tan Kean Siong
-#* 
+#*
 #* This program is free software; you can redistribute it and/or
 #* modify it under the terms of the GNU General Public License
 #* as published by the Free Software Foundation; either version 2
 #* of the License, or (at your option) any later version.
-#* 
+#*
 #* This program is distributed in the hope that it will be useful,
 #* but WITHOUT ANY WARRANTY; without even the implied warranty of
 #* MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #* GNU General Public License for more details.
-#* 
+#*
 #* You should have received a copy of the GNU General Public License
 #* along with this program; if not, write to the Free Software
 #* Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-#* 
-#* 
-#*             contact nepenthesdev@gmail.com  
+#*
+#*
+#*             contact nepenthesdev@gmail.com
 #*
 #*******************************************************************************/
 
-from dionaea.core import *
-
-import datetime
-import traceback
 import logging
-import binascii
-import os
-import tempfile
+import struct
 
+from dionaea.core import connection, incident
 from dionaea.mqtt.include.packets import *
 
+from .broker import TopicTree
+
 logger = logging.getLogger('mqtt')
 
-class mqttd(connection):
-	def __init__ (self):
-		connection.__init__(self,"tcp")
-		self.buf = b''
-
-	def handle_established(self):
-		self.timeouts.idle = 120
-		self.processors()
-
-	def handle_io_in(self, data):
-		l=0
-		size = 0
-		chunk = b''
-		
-		if len(data) > l:
-			p = None
-			x = None
-			try:
-
-				if len(data) > 0:
-					p = MQTT_ControlMessage_Type(data);
-					p.show()
-
-					self.pendingPacketType = p.ControlPacketType
-					logger.debug("MQTT Control Packet Type {}".format(self.pendingPacketType))
-
-				if len(data) == 0:
-					logger.warn("Bad MQTT Packet, Length = 0")
-					
-			except:
-				t = traceback.format_exc()
-				logger.error(t)
-				return l
-	
-			if self.pendingPacketType == MQTT_CONTROLMESSAGE_TYPE_CONNECT:
-				x = MQTT_Connect(data)
-
-				i = incident("dionaea.modules.python.mqtt.connect")
-				i.con = self
-				i.clientid = x.ClientID
-				i.willtopic = x.WillTopic
-				i.willmessage = x.WillMessage
-				i.username = x.Username
-				i.password = x.Password
-				i.report()
-				
-			elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISH) == 48) &
-				((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) > 0) ) :
-				x = MQTT_Publish(data)
-
-				i = incident("dionaea.modules.python.mqtt.publish")
-				i.con = self
-				i.publishtopic = x.Topic
-				i.publishmessage = x.Message
-				i.report()
-
-			elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISH) == 48) &
-				((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_QoS2) > 0) ) :
-				x = MQTT_Publish(data)
-
-				i = incident("dionaea.modules.python.mqtt.publish")
-				i.con = self
-				i.publishtopic = x.Topic
-				i.publishmessage = x.Message
-				i.report()
-
-			elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISHREL) == 96) &
-				((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) > 0) ) :
-				x = MQTT_Publish_Release(data)
-
-			elif self.pendingPacketType == MQTT_CONTROLMESSAGE_TYPE_PUBLISH:
-				x = MQTT_Publish(data)
-
-				i = incident("dionaea.modules.python.mqtt.publish")
-				i.con = self
-				i.publishtopic = x.Topic
-				i.publishmessage = x.Message
-				i.report()
-
-			elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_SUBSCRIBE) == 128) &
-				((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) > 0) ) :
-				x = MQTT_Subscribe(data)
-
-				i = incident("dionaea.modules.python.mqtt.subscribe")
-				i.con = self
-				i.subscribemessageid = x.PacketIdentifier
-				i.subscribetopic = x.Topic
-				i.report()
-
-			elif self.pendingPacketType == MQTT_CONTROLMESSAGE_TYPE_SUBSCRIBE:
-				x = MQTT_Subscribe(data)
-
-				i = incident("dionaea.modules.python.mqtt.subscribe")
-				i.con = self
-				i.subscribemessageid = x.PacketIdentifier
-				i.subscribetopic = x.Topic
-				i.report()
-
-			elif self.pendingPacketType == MQTT_CONTROLMESSAGE_TYPE_PINGREQ:
-				x = MQTT_PingRequest(data)
-
-			elif self.pendingPacketType == MQTT_CONTROLMESSAGE_TYPE_DISCONNECT:
-				x = MQTT_DisconnectReq(data)
-
-			self.buf = b''
-			x.show()
-
-			r = None			
-			r = self.process( self.pendingPacketType, x)
-
-			if r:
-				r.show()
-				self.send(r.build())
-				
-		return len(data)
-
-	def process(self, PacketType, p):
-		r =''
-		rp = None
-		
-		if PacketType == MQTT_CONTROLMESSAGE_TYPE_CONNECT:
-			r = MQTT_ConnectACK()
-
-		elif PacketType == MQTT_CONTROLMESSAGE_TYPE_DISCONNECT:
-			r = ''
-
-		elif PacketType == MQTT_CONTROLMESSAGE_TYPE_PINGREQ:
-			r = MQTT_PingResponse()
-
-		elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_SUBSCRIBE) == 128) &
-			((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) > 0) ) :
-			l = p.getlayer(MQTT_Subscribe)
-			packetidentifier = l.PacketIdentifier
-			GrantedQoS = l.GrantedQoS
-			r = MQTT_SubscribeACK_Identifier()
-			if (packetidentifier is not None):
-				r.PacketIdentifier = packetidentifier
-			if (GrantedQoS is not None):
-				r.GrantedQoS = GrantedQoS
-
-		# mqtt-v3.1.1-os.pdf - page 36
-		# For "Publish" Packet, the Response will be varied with the QoS level:
-		# - QoS level 0 - No response packet
-		# - QoS level 1 - PUBACK packet
-		# - QoS level 2 - PUBREC packet
-
-		elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISH) == 48) &
-			((PacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) == 2) ) :
-			l = p.getlayer(MQTT_Publish)
-			packetidentifier = l.PacketIdentifier
-			if (packetidentifier is not None):
-				r = MQTT_PublishACK_Identifier()
-				r.PacketIdentifier = packetidentifier
-
-		elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISH) == 48) &
-			((PacketType & MQTT_CONTROLMESSAGE_TYPE_QoS2) == 4) ) :
-			l = p.getlayer(MQTT_Publish)
-			packetidentifier = l.PacketIdentifier
-			if (packetidentifier is not None):
-				r = MQTT_PublishACK_Identifier()
-				r.HeaderFlags = MQTT_CONTROLMESSAGE_TYPE_PUBLISHRCV
-				r.PacketIdentifier = packetidentifier
-
-		elif (  ((self.pendingPacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISH) == 48) &
-			((PacketType & MQTT_CONTROLMESSAGE_TYPE_QoS1) == 0) ) :
-			r = ''
-
-		elif (PacketType & MQTT_CONTROLMESSAGE_TYPE_PUBLISHREL) == 96:
-			l = p.getlayer(MQTT_Publish_Release)
-			packetidentifier = l.PacketIdentifier
-			if (packetidentifier is not None):
-				r = MQTT_PublishACK_Identifier()
-				r.PacketIdentifier = packetidentifier
-				r.HeaderFlags = MQTT_CONTROLMESSAGE_TYPE_PUBLISHCOM
-		else:
-			logger.warn("Unknown Packet Type for MQTT {}".format(PacketType))
-		
-		return r
-	
-	def handle_timeout_idle(self):
-		return False
-
-	def handle_disconnect(self):
-		return False
+MQTT_CONTROLMESSAGE_TYPE_UNSUBSCRIBE = 0xA0
+MQTT_CONTROLMESSAGE_TYPE_UNSUBSCRIBEACK = 0xB0
+
+# protocol name -> protocol level, MQTT 3.1 and 3.1.1
+PROTOCOL_LEVELS = {
+    b"MQIsdp": 3,
+    b"MQTT": 4,
+}
+
+# CONNACK return code
+CONNECT_REFUSED_PROTOCOL_VERSION = 0x01
+
+# Limits of topics and topic filters, the trie of the broker has one node per level
+MAX_TOPIC_LENGTH = 256
+MAX_TOPIC_LEVELS = 32
+
+# The remaining length is encoded in at most 4 bytes
+MAX_LENGTH_BYTES = 4
+
+PACKET_ID = struct.Struct(">H")
+
+
+class MQTTError(Exception):
+    pass
+
+
+def encode_length(length):
+    """
+    Encode the remaining length of a packet as variable length integer.
+
+    :param int length: The length
+    :rtype: bytes
+    """
+    buf = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length > 0:
+            digit |= 0x80
+        buf.append(digit)
+        if length == 0:
+            return bytes(buf)
+
+
+def read_packet(data, offset=0):
+    """
+    Read a packet from the buffer.
+
+    :param bytes data: The buffer
+    :param int offset: Start of the packet
+    :return: Tuple (header byte, start of the body, end of the packet) or None if the packet is incomplete
+    :raises MQTTError: If the remaining length is malformed
+    """
+    length = 0
+    multiplier = 1
+    pos = offset + 1
+    while True:
+        if pos >= len(data):
+            return None
+        digit = data[pos]
+        pos += 1
+        length += (digit & 0x7f) * multiplier
+        if digit & 0x80 == 0:
+            break
+        multiplier *= 128
+        if pos - offset - 1 >= MAX_LENGTH_BYTES:
+            raise MQTTError("Malformed remaining length")
+
+    if len(data) < pos + length:
+        return None
+    return data[offset], pos, pos + length
 
+
+def build_packet(header, body=b""):
+    return bytes((header,)) + encode_length(len(body)) + body
+
+
+def build_publish(topic, payload, retain=False):
+    header = MQTT_CONTROLMESSAGE_TYPE_PUBLISH
+    if retain:
+        header |= 0x01
+    return build_packet(header, PACKET_ID.pack(len(topic)) + topic + payload)
+
+
+def check_topic(topic):
+    """
+    Check the size of a topic or a topic filter.
+
+    :param bytes topic: The topic or topic filter
+    :raises MQTTError: If the topic is too long or has too many levels
+    """
+    if len(topic) > MAX_TOPIC_LENGTH:
+        raise MQTTError("Topic too long")
+    if topic.count(b"/") >= MAX_TOPIC_LEVELS:
+        raise MQTTError("Too many topic levels")
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+    def read(self, length):
+        if self.remaining() < length:
+            raise MQTTError("Packet too short")
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def read_byte(self):
+        return self.read(1)[0]
+
+    def read_uint16(self):
+        return PACKET_ID.unpack(self.read(2))[0]
+
+    def read_string(self):
+        return self.read(self.read_uint16())
+
+    def read_rest(self):
+        return self.read(self.remaining())
+
+
+class mqttd(connection):
+    shared_config_values = [
+        "max_packet_size",
+        "max_subscriptions",
+        "topics"
+    ]
+
+    def __init__(self):
+        connection.__init__(self, "tcp")
+        self.max_packet_size = 1024 * 1024
+        self.max_subscriptions = 100
+        self.topics = None
+
+    def apply_config(self, config):
+        if config is None:
+            config = {}
+        self.max_packet_size = int(config.get("max_packet_size", 1024 * 1024))
+        self.max_subscriptions = int(config.get("max_subscriptions", 100))
+        self.topics = TopicTree(
+            max_retained=int(config.get("max_retained", 1000)),
+            max_retained_bytes=int(config.get("max_retained_bytes", 16 * 1024 * 1024))
+        )
+
+    def handle_established(self):
+        self.timeouts.idle = 120
+        self.processors()
+
+    def handle_io_in(self, data):
+        offset = 0
+        while offset < len(data):
+            try:
+                packet = read_packet(data, offset)
+                if packet is None:
+                    if len(data) - offset > self.max_packet_size:
+                        raise MQTTError("Packet too large")
+                    break
+                header, start, end = packet
+                if end - start > self.max_packet_size:
+                    raise MQTTError("Packet too large")
+
+                func = PACKET_HANDLERS.get(header & 0xf0)
+                if func is None:
+                    logger.warn("Unknown Packet Type for MQTT {}".format(header))
+                else:
+                    logger.debug("MQTT Control Packet Type {}".format(header))
+                    func(self, header, Reader(data[start:end]))
+                    if header & 0xf0 == MQTT_CONTROLMESSAGE_TYPE_DISCONNECT:
+                        return len(data)
+            except MQTTError as e:
+                logger.warn("Bad MQTT Packet: {}".format(e))
+                self.close()
+                return len(data)
+            offset = end
+        return offset
+
+    def _handle_connect(self, header, reader):
+        protocol_name = reader.read_string()
+        if protocol_name not in PROTOCOL_LEVELS:
+            raise MQTTError("Unknown protocol name")
+        version = reader.read_byte()
+        flags = reader.read_byte()
+        keep_alive = reader.read_uint16()
+        client_id = reader.read_string()
+        will_topic = will_message = username = password = b""
+        if flags & CONNECT_WILL:
+            will_topic = reader.read_string()
+            will_message = reader.read_string()
+        if flags & CONNECT_USERNAME:
+            username = reader.read_string()
+        if flags & CONNECT_PASSWORD:
+            password = reader.read_string()
+
+        i = incident("dionaea.modules.python.mqtt.connect")
+        i.con = self
+        i.clientid = client_id
+        i.willtopic = will_topic
+        i.willmessage = will_message
+        i.username = username
+        i.password = password
+        i.report()
+
+        if version != PROTOCOL_LEVELS[protocol_name]:
+            self.send(build_packet(
+                MQTT_CONTROLMESSAGE_TYPE_CONNECTACK,
+                bytes((0x00, CONNECT_REFUSED_PROTOCOL_VERSION))
+            ))
+            self.close()
+            return
+
+        if keep_alive > 0:
+            # The server disconnects the client after one and a half times the keep alive period
+            self.timeouts.idle = min(keep_alive * 1.5, 3600)
+
+        self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_CONNECTACK, b"\x00\x00"))
+
+    def _handle_disconnect(self, header, reader):
+        self.close()
+
+    def _handle_pingreq(self, header, reader):
+        self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_PINGRES))
+
+    # mqtt-v3.1.1-os.pdf - page 36
+    # For "Publish" Packet, the Response will be varied with the QoS level:
+    # - QoS level 0 - No response packet
+    # - QoS level 1 - PUBACK packet
+    # - QoS level 2 - PUBREC packet
+    def _handle_publish(self, header, reader):
+        qos = (header >> 1) & 0x03
+        topic = reader.read_string()
+        packet_identifier = None
+        if qos > 0:
+            packet_identifier = reader.read(2)
+        message = reader.read_rest()
+
+        i = incident("dionaea.modules.python.mqtt.publish")
+        i.con = self
+        i.publishtopic = topic
+        i.publishmessage = message
+        i.report()
+
+        if b"+" in topic or b"#" in topic:
+            raise MQTTError("Wildcard in topic name")
+        check_topic(topic)
+
+        if header & 0x01:
+            self.topics.retain(topic, message)
+
+        subscribers = self.topics.match(topic)
+        if len(subscribers) > 0:
+            # Every subscriber receives the message with QoS 0
+            packet = build_publish(topic, message)
+            for subscriber in subscribers:
+                subscriber.send(packet)
+
+        if qos == 1:
+            self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_PUBLISHACK, packet_identifier))
+        elif qos == 2:
+            self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_PUBLISHRCV, packet_identifier))
+
+    def _handle_pubrel(self, header, reader):
+        packet_identifier = reader.read(2)
+        self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_PUBLISHCOM, packet_identifier))
+
+    def _handle_subscribe(self, header, reader):
+        packet_identifier = reader.read(2)
+        topic_filters = []
+        while reader.remaining() > 0:
+            topic_filter = reader.read_string()
+            requested_qos = reader.read_byte()
+            if requested_qos > 2:
+                raise MQTTError("Malformed requested QoS")
+            topic_filters.append(topic_filter)
+
+            i = incident("dionaea.modules.python.mqtt.subscribe")
+            i.con = self
+            i.subscribemessageid = PACKET_ID.unpack(packet_identifier)[0]
+            i.subscribetopic = topic_filter
+            i.report()
+
+        if len(topic_filters) == 0:
+            raise MQTTError("Subscribe without topic filter")
+
+        granted = bytearray()
+        retained = []
+        for topic_filter in topic_filters:
+            check_topic(topic_filter)
+            if len(self.topics.get_subscriptions(self)) >= self.max_subscriptions:
+                granted.append(0x80)
+                continue
+            # Messages are only sent with QoS 0
+            self.topics.subscribe(topic_filter, self, 0)
+            granted.append(0x00)
+            retained.extend(self.topics.get_retained(topic_filter))
+
+        self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_SUBSCRIBEACK, packet_identifier + granted))
+        for topic, message in retained:
+            self.send(build_publish(topic, message, retain=True))
+
+    def _handle_unsubscribe(self, header, reader):
+        packet_identifier = reader.read(2)
+        while reader.remaining() > 0:
+            topic_filter = reader.read_string()
+            check_topic(topic_filter)
+            self.topics.unsubscribe(topic_filter, self)
+        self.send(build_packet(MQTT_CONTROLMESSAGE_TYPE_UNSUBSCRIBEACK, packet_identifier))
+
+    def handle_timeout_idle(self):
+        return False
+
+    def handle_disconnect(self):
+        if self.topics is not None:
+            self.topics.unsubscribe_all(self)
+        return False
+
+
+# packet type -> handler
+PACKET_HANDLERS = {
+    MQTT_CONTROLMESSAGE_TYPE_CONNECT: mqttd._handle_connect,
+    MQTT_CONTROLMESSAGE_TYPE_DISCONNECT: mqttd._handle_disconnect,
+    MQTT_CONTROLMESSAGE_TYPE_PINGREQ: mqttd._handle_pingreq,
+    MQTT_CONTROLMESSAGE_TYPE_PUBLISH: mqttd._handle_publish,
+    MQTT_CONTROLMESSAGE_TYPE_PUBLISHREL: mqttd._handle_pubrel,
+    MQTT_CONTROLMESSAGE_TYPE_SUBSCRIBE: mqttd._handle_subscribe,
+    MQTT_CONTROLMESSAGE_TYPE_UNSUBSCRIBE: mqttd._handle_unsubscribe,
+}
@@ -0,0 +1,175 @@
+#################################################################################
+#                                Dionaea
+#                            - catches bugs -
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+################################################################################
+
+from collections import deque
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger("mysqld")
+
+# Number of SQLite VM instructions between the checks for the query timeout
+PROGRESS_INTERVAL = 10000
+
+# Actions allowed by the authorizer of the connections, everything else is denied
+ALLOWED_ACTIONS = frozenset((
+    sqlite3.SQLITE_FUNCTION,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_SELECT,
+    # SQLITE_RECURSIVE, not available in the sqlite3 module of older Python versions
+    33,
+))
+# Used by COM_FIELD_LIST
+ALLOWED_PRAGMAS = frozenset(("table_info",))
+
+# path -> DatabasePool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class DatabasePool(object):
+    """
+    Pool of read-only connections to a SQLite database.
+
+    The database file is opened with an immutable=1 URI, so SQLite does not lock the file and does not check it for
+    changes. The connections are created with check_same_thread=False, a connection may be used by one thread at a
+    time and must be returned with release(). An authorizer only allows reading statements, so no state e.g. an
+    attached database or a temporary table is left on a connection for the next client.
+
+    :param str path: The database file or ':memory:'
+    :param int size: Max number of idle connections kept in the pool
+    """
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self._idle = deque()
+
+        if path == ":memory:":
+            self._uri = "file::memory:"
+        else:
+            path = os.path.abspath(path)
+            if not os.path.isfile(path):
+                raise sqlite3.OperationalError("unable to open database file %s" % path)
+            self._uri = pathlib.Path(path).as_uri() + "?mode=ro&immutable=1"
+
+        # Open one connection to report errors early
+        self.release(self._connect())
+
+    def _connect(self):
+        logger.debug("Opening database %s", self._uri)
+        dbh = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        # An in-memory database can not be opened read-only
+        dbh.execute("PRAGMA query_only = ON")
+        dbh.set_authorizer(_authorize)
+        return dbh
+
+    def acquire(self):
+        """
+        Get an idle connection or open a new one.
+
+        :return: The connection
+        :rtype: sqlite3.Connection
+        """
+        try:
+            return self._idle.pop()
+        except IndexError:
+            return self._connect()
+
+    def release(self, dbh):
+        """
+        Return a connection to the pool.
+
+        :param sqlite3.Connection dbh: The connection
+        """
+        # Discard the statement of an unfinished query
+        dbh.rollback()
+        if len(self._idle) < self.size:
+            self._idle.append(dbh)
+        else:
+            dbh.close()
+
+    def execute(self, query, params=(), timeout=None, max_rows=None, cancel=None):
+        """
+        Run a query on an idle connection.
+
+        A query running longer than the timeout or until cancel is set is interrupted and raises
+        sqlite3.OperationalError.
+
+        :param str query: The query
+        :param params: Values of the query parameters
+        :param float timeout: Max time in seconds to run the query
+        :param int max_rows: Max number of rows to fetch
+        :param threading.Event cancel: Interrupt the query if set
+        :return: Tuple (column names, rows), the names are None if the query does not return rows
+        """
+        dbh = self.acquire()
+        if timeout is not None or cancel is not None:
+            deadline = None
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+
+            def progress():
+                # A true value interrupts the query
+                return (deadline is not None and time.monotonic() > deadline) or \
+                    (cancel is not None and cancel.is_set())
+
+            dbh.set_progress_handler(progress, PROGRESS_INTERVAL)
+        try:
+            cursor = dbh.execute(query, params)
+            names = None
+            if cursor.description is not None:
+                names = [column[0] for column in cursor.description]
+            if max_rows is None:
+                rows = cursor.fetchall()
+            else:
+                rows = cursor.fetchmany(max_rows)
+            return names, rows
+        finally:
+            dbh.set_progress_handler(None, 0)
+            self.release(dbh)
+
+
+def _authorize(action, arg1, arg2, db_name, trigger_name):
+    if action in ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA and arg1 is not None and arg1.lower() in ALLOWED_PRAGMAS:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def get_database_pool(path, size=4):
+    """
+    Get the connection pool of a database, all services share the pool of a database file.
+
+    :param str path: The database file or ':memory:'
+    :param int size: Max number of idle connections if the pool is created
+    :return: The pool
+    :rtype: DatabasePool
+    """
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = DatabasePool(path, size=size)
+            _pools[path] = pool
+        return pool
@@ -30,11 +30,15 @@ import os
 import re
 import sqlite3
 import tempfile
+import threading
 
 from dionaea.core import incident, connection, g_dionaea
+from dionaea.smb.include.packet import Packet
+from dionaea.util import WorkerPool
 from .include.packets import *
 
-from .var import VarHandler
+from .database import get_database_pool
+from .var import CFG_VARS, VarHandler
 
 logger = logging.getLogger('mysqld')
 
@@ -48,49 +52,113 @@ re_select_var = re.compile(
     re.I
 )
 
+re_set_var = re.compile(
+    b"set\s+(?:(?:global|session|local)\s+|@@(?:(?:global|session|local)\.)?)?(?P<name>\w+)\s*=\s*(?P<value>.*?)\s*;?$",
+    re.I
+)
+
+re_statement = re.compile(
+    b"""([A-Za-z0-9_.]+\(.*?\)+|\(.*?\)+|"(?:[^"]|\"|"")*"+|'[^'](?:|\'|'')*'+|`(?:[^`]|``)*`+|[^ ,]+|,)"""
+)
+
+re_function = re.compile(b"(?P<name>[A-Za-z0-9_.]+)\((?P<args>.*?)\)+")
+re_url = re.compile(
+    b"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
+)
+
+re_set = re.compile(b"set ", re.I)
+re_select_database = re.compile(b"select\S+database\S*\(\S*\)$", re.I)
+re_show_databases = re.compile(b"show\S+databases$", re.I)
+re_show_tables = re.compile(b"show\S+tables$", re.I)
+
+# Send streamed result sets in chunks of this size
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+class Query(object):
+    """
+    A query to run on a worker thread.
+
+    :param str sql: The query
+    :param build: Called with the column names and the rows in the main loop, returns the result packets
+    """
+    def __init__(self, sql, build):
+        self.sql = sql
+        self.build = build
+        self.cancel = threading.Event()
+
 
 class mysqld(connection):
     shared_config_values = [
         "config",
         "download_dir",
-        "download_suffix"
+        "download_suffix",
+        "pools",
+        "vars",
+        "worker_pool",
+        "query_timeout",
+        "max_rows"
     ]
-    vars = VarHandler()
 
     def __init__(self):
         connection.__init__(self, "tcp")
         self.config = None
         self.state = ""
-        self.regex_statement = re.compile(
-            b"""([A-Za-z0-9_.]+\(.*?\)+|\(.*?\)+|"(?:[^"]|\"|"")*"+|'[^'](?:|\'|'')*'+|`(?:[^`]|``)*`+|[^ ,]+|,)"""
-        )
         self.download_dir = None
         self.download_suffix = ".tmp"
+        # database name -> DatabasePool
+        self.pools = {}
+        self.pool = None
+        self.database = None
+        self.vars = None
+        self.worker_pool = None
+        self.query_timeout = 5.0
+        self.max_rows = 1000
+        self._buffer = bytearray()
+        # The running Query, no commands are processed until its result has been sent
+        self._query = None
+        self._closed = False
 
     def apply_config(self, config):
         self.config = config.get("databases")
+        if not isinstance(self.config, dict):
+            self.config = {}
 
         dionaea_config = g_dionaea.config().get("dionaea")
         self.download_dir = dionaea_config.get("download.dir")
         self.download_suffix = dionaea_config.get("download.suffix", ".tmp")
 
-        from .var import CFG_VARS
+        pool_size = int(config.get("pool_size", 4))
+        self.query_timeout = float(config.get("query_timeout", 5.0))
+        self.max_rows = int(config.get("max_rows", 1000))
+        # Attackers must not be able to block the loop or other services with expensive queries
+        self.worker_pool = WorkerPool(max_workers=int(config.get("max_workers", 2)))
+        for name, db_config in self.config.items():
+            path = db_config.get("path")
+            try:
+                self.pools[name] = get_database_pool(path, size=pool_size)
+            except (TypeError, sqlite3.Error) as e:
+                logger.warning("Unable to open database '%s' (%s): %s", name, path, e)
+
+        # The connections copy the table on write
+        self.vars = VarHandler()
         self.vars.load(CFG_VARS)
         vars = config.get("vars")
         if not isinstance(vars, dict):
             vars = {}
 
         for name, value in vars.items():
-            obj = self.vars.values.get(name)
+            obj = self.vars.get(name)
             if obj is None:
-                logger.warning("Config value '%s' does not exist")
+                logger.warning("Config value '%s' does not exist", name)
                 continue
             obj.value = value
 
     def handle_established(self):
         self.processors()
         self.state = 'greeting'
-        var_version = self.vars.values.get("version")
+        self.vars = self.vars.new_session()
+        var_version = self.vars.get("version")
         greeting = MySQL_Server_Greeting(
             ServerVersion="%s\0" % var_version
         )
@@ -100,16 +168,104 @@ class mysqld(connection):
         self._open_db('information_schema')
 
     def _open_db(self, Database):
-        logger.warn("DATABASE opening %s" % Database)
-        try:
-            p = self.config[Database]['path']
-            logger.warn("open db %s -> %s" % (Database, p))
-            self.dbh = sqlite3.connect(p)
-            self.cursor = self.dbh.cursor()
-            self.database = Database
-            return True
-        except:
+        logger.debug("DATABASE opening %s" % Database)
+        pool = self.pools.get(Database)
+        if pool is None:
             return False
+        self.pool = pool
+        self.database = Database
+        return True
+
+    def _execute(self, query, **kwargs):
+        """
+        Run a query on the current database.
+
+        :param str query: The query
+        :return: Tuple (column names, rows), the names are None if the query does not return rows
+        """
+        if self.pool is None:
+            raise sqlite3.OperationalError("no database selected")
+        return self.pool.execute(query, **kwargs)
+
+    def _run_query(self, query, number):
+        """
+        Run a query on a worker thread and send the result with the given packet number.
+
+        :param Query query: The query
+        :param int number: Number of the first result packet
+        """
+        self._query = query
+        # Keep the connection until the result has been handled
+        self.ref()
+        self.worker_pool.submit(
+            lambda future: self._handle_query_result(future, query, number),
+            self._execute,
+            query.sql,
+            timeout=self.query_timeout,
+            max_rows=self.max_rows,
+            cancel=query.cancel
+        )
+
+    def _handle_query_result(self, future, query, number):
+        self._query = None
+        try:
+            if self._closed:
+                return
+            try:
+                names, rows = future.result()
+            except sqlite3.Error as e:
+                logger.warn("SQL ERROR %s" % e)
+                logger.warn("SQL ERROR in %s" % query.sql)
+                r = MySQL_Result_Error(Message="Learn SQL!")
+            else:
+                try:
+                    r = query.build(names, rows)
+                except Exception as e:
+                    logger.warn("Unable to build result of %s: %s" % (query.sql, e))
+                    r = MySQL_Result_Error(Message="Learn SQL!")
+            if not self._send_result(number, r):
+                # Part of the result has been sent, the client can not recover
+                self._closed = True
+                self.close()
+                return
+            self._process_buffer()
+        finally:
+            self.unref()
+
+    def _send_result(self, number, r):
+        """
+        Build and send the result packets, the packets may be generated while sending.
+
+        If building a packet fails an error packet is sent instead of the
+        result, unless parts of the result have already been sent.
+
+        :param int number: Number of the first packet
+        :param r: A packet or an iterable of packets
+        :return: False if sending the result failed after parts had been sent
+        :rtype: bool
+        """
+        if isinstance(r, Packet):
+            r = [r]
+        buf = bytearray()
+        sent = False
+        try:
+            for i, rp in enumerate(r):
+                rp = MySQL_Packet_Header(Number=number + i) / rp
+                rp.show()
+                buf += rp.build()
+                if len(buf) >= SEND_CHUNK_SIZE:
+                    self.send(bytes(buf))
+                    sent = True
+                    buf = bytearray()
+        except Exception as e:
+            logger.warn("Unable to build result packet: %s" % e)
+            if sent:
+                return False
+            rp = MySQL_Packet_Header(Number=number) / MySQL_Result_Error(Message="Learn SQL!")
+            buf = bytearray(rp.build())
+        if len(buf) > 0:
+            self.send(bytes(buf))
+        return True
 
     def _handle_COM_INIT_DB(self, p):
         Database = p.Database.decode('utf-8')
@@ -119,15 +275,15 @@ class mysqld(connection):
             return MySQL_Result_Error(Message="No such database")
 
     def _handle_COM_FIELD_LIST(self, p):
-        r = []
         query = "PRAGMA table_info(%s);" % p.Table.decode('ascii')[:-1]
         # FIXME sqlite does not allow ? for PRAGMA? I'm not afraid of SQLi here
         # though.
-        result = self.cursor.execute(query)
-        names = [result.description[x][0] for x in range(len(result.description))]
+        return Query(query, lambda names, rows: self._build_field_list(p, names, rows))
+
+    def _build_field_list(self, p, names, result):
         result = [dict(zip(names, i)) for i in result]
         for res in result:
-            x = MySQL_Result_Field(
+            yield MySQL_Result_Field(
                 Catalog='def',
                 Database=self.database,
                 Table=p.Table[:-1],
@@ -141,13 +297,11 @@ class mysqld(connection):
                 Decimals=0,
                 Default='0'
             )
-            r.append(x)
-        r.append(MySQL_Result_EOF(ServerStatus=0x002))
-        return r
+        yield MySQL_Result_EOF(ServerStatus=0x002)
 
     def _handle_COM_QUERY(self, p):
         r = None
-        query = self.regex_statement.findall(p.Query)
+        query = re_statement.findall(p.Query)
 
         if len(query) > 0 and query[0].lower() == b"select":
             print("foo")
@@ -163,10 +317,16 @@ class mysqld(connection):
         if r is True:
             return MySQL_Result_OK(Message="")
 
-        if re.match(b'set ', p.Query, re.I):
+        if re_set.match(p.Query):
+            m = re_set_var.match(p.Query)
+            if m:
+                try:
+                    self.vars.set(m.group("name").decode("ascii"), m.group("value").decode("utf-8"))
+                except (UnicodeDecodeError, ValueError):
+                    logger.debug("Unable to set variable from %r", p.Query, exc_info=True)
             r = MySQL_Result_OK(Message="#2")
 
-        elif re.match(b'select\S+database\S*\(\S*\)$', p.Query, re.I):
+        elif re_select_database.match(p.Query):
             r = [
                 MySQL_Result_Header(FieldCount=1),
                 MySQL_Result_Field(
@@ -183,7 +343,7 @@ class mysqld(connection):
                 MySQL_Result_EOF(ServerStatus=0x002)
             ]
 
-        elif re.match(b"show\S+databases$", p.Query, re.I):
+        elif re_show_databases.match(p.Query):
             r = [
                 MySQL_Result_Header(FieldCount=1),
                 MySQL_Result_Field(
@@ -205,7 +365,7 @@ class mysqld(connection):
             # r.append(MySQL_Result_Row_Data(ColumnValues=['information_schema']))
             r.append(MySQL_Result_EOF(ServerStatus=0x002))
 
-        elif re.match(b'show\S+tables$', p.Query, re.I):
+        elif re_show_tables.match(p.Query):
             r = [
                 MySQL_Result_Header(FieldCount=1),
                 MySQL_Result_Field(
@@ -221,8 +381,7 @@ class mysqld(connection):
                 MySQL_Result_EOF(ServerStatus=0x002)
             ]
 
-            result = self.cursor.execute("select tbl_name from sqlite_master where type = 'table'")
-            names = [result.description[x][0] for x in range(len(result.description))]
+            names, result = self._execute("select tbl_name from sqlite_master where type = 'table'")
             result = [dict(zip(names, i)) for i in result]
             for res in result:
                 x = MySQL_Result_Row_Data(ColumnValues=[res[name] for name in names])
@@ -234,42 +393,37 @@ class mysqld(connection):
             try:
                 query = p.Query.decode('utf-8')
                 print(query)
-                result = self.cursor.execute(query)
-                print(result)
-                if result.description is None:
-                    r = MySQL_Result_OK()
-                else:
-                    names = [result.description[x][0] for x in range(len(result.description))]
-                    print(result)
-                    result = [dict(zip(names, i)) for i in result]
-                    r = [MySQL_Result_Header(FieldCount=len(names))]
-                    for name in names:
-                        r.append(
-                            MySQL_Result_Field(
-                                #Catalog='def',
-                                Table=b'',
-                                ORGTable=b"",
-                                Database=b"",
-                                Name=name,
-                                CharSet=33,
-                                Length=255,
-                                Type=FIELD_TYPE_VAR_STRING,
-                                Flags=FLAG_NOT_NULL,
-                                Decimals=0
-                            )
-                        )
-                    r.append(MySQL_Result_EOF(ServerStatus=0x002))
-                    for res in result:
-                        x = MySQL_Result_Row_Data(ColumnValues=[res[name] for name in names])
-                        # x.show()
-                        r.append(x),
-                    r.append(MySQL_Result_EOF(ServerStatus=0x002))
-            except Exception as e:
+                r = Query(query, self._build_query_result)
+            except UnicodeDecodeError as e:
                 logger.warn("SQL ERROR %s" % e)
                 logger.warn("SQL ERROR in %s" % p.Query)
                 r = MySQL_Result_Error(Message="Learn SQL!")
         return r
 
+    def _build_query_result(self, names, result):
+        if names is None:
+            yield MySQL_Result_OK()
+            return
+
+        yield MySQL_Result_Header(FieldCount=len(names))
+        for name in names:
+            yield MySQL_Result_Field(
+                #Catalog='def',
+                Table=b'',
+                ORGTable=b"",
+                Database=b"",
+                Name=name,
+                CharSet=33,
+                Length=255,
+                Type=FIELD_TYPE_VAR_STRING,
+                Flags=FLAG_NOT_NULL,
+                Decimals=0
+            )
+        yield MySQL_Result_EOF(ServerStatus=0x002)
+        for res in result:
+            yield MySQL_Result_Row_Data(ColumnValues=list(res))
+        yield MySQL_Result_EOF(ServerStatus=0x002)
+
     def _handle_com_query_select(self, p, query):
         """
 
@@ -280,15 +434,12 @@ class mysqld(connection):
         if len(query) == 0:
             return False
 
-        regex_function = re.compile(b"(?P<name>[A-Za-z0-9_.]+)\((?P<args>.*?)\)+")
-        regex_url = re.compile(b"(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)")
-
         m = re_select_var.match(p.Query)
         if m:
             r = []
             var_name = m.group("name").decode("ascii")
             var_full_name = m.group("full_name").decode("ascii")
-            var = self.vars.values.get(var_name)
+            var = self.vars.get(var_name)
             if var is None:
                 return [MySQL_Result_Error(Message="ERROR 1193 (HY000): Unknown system variable '%s'" % var_name)]
 
@@ -312,7 +463,7 @@ class mysqld(connection):
             r.append(MySQL_Result_EOF(ServerStatus=0x002))
             return r
 
-        m = regex_function.match(query[0])
+        m = re_function.match(query[0])
 
         if m and m.group("name") == b"unhex":
             if len(query) < 4:
@@ -354,7 +505,7 @@ class mysqld(connection):
 
         if m and m.group("name") == b"xpdl3":
             args = m.group("args")
-            m_url = regex_url.search(args)
+            m_url = re_url.search(args)
             if m_url:
                 i = incident("dionaea.download.offer")
                 i.con = self
@@ -406,7 +557,7 @@ class mysqld(connection):
                 var_name = var_name.replace(b"%", b".*")
                 var_name = re.compile(var_name)
 
-            for name, var in self.vars.values.items():
+            for name, var in self.vars.items():
                 if var_name and not var_name.match(name.encode("ascii")):
                     continue
                 r.append(
@@ -441,7 +592,20 @@ class mysqld(connection):
         icd.report()
         os.unlink(fp_tmp.name)
 
-    def handle_io_in(self,data):
+    def handle_io_in(self, data):
+        self._buffer.extend(data)
+        if self._query is None:
+            self._process_buffer()
+        return len(data)
+
+    def handle_disconnect(self):
+        self._closed = True
+        if self._query is not None:
+            self._query.cancel.set()
+        return 0
+
+    def _process_buffer(self):
+        data = bytes(self._buffer)
         offset = 0
         while len(data) - offset >= 4:
             h = MySQL_Packet_Header(data[offset:offset+4])
@@ -454,9 +618,9 @@ class mysqld(connection):
                 p = MySQL_Client_Authentication(data[offset+4:offset+4+h.Length])
                 if p.DatabaseName != b'\x00':
                     Database = p.DatabaseName[:-1]
-                    if type(Database) == str:
-                        Database = Database.encode('ascii')
-                    if self._open_db(Database) == True:
+                    if type(Database) == bytes:
+                        Database = Database.decode('utf-8', 'replace')
+                    if self._open_db(Database) == False:
                         r = MySQL_Result_Error(Message="Could not open Database %s" % Database)
                     else:
                         r = MySQL_Result_OK()
@@ -493,15 +657,12 @@ class mysqld(connection):
                 h = h / p
             h.show()
 
-            if r is not None:
-                if type(r) is not list:
-                    r = [r]
-                buf = b''
-                for i in range(len(r)):
-                    rp = r[i]
-                    rp = MySQL_Packet_Header(Number=h.Number+1+i) / rp
-                    rp.show()
-                    buf += rp.build()
-                self.send(buf)
             offset += 4 + h.Length
-        return offset
+            if isinstance(r, Query):
+                self._run_query(r, h.Number + 1)
+                break
+            if r is not None and not self._send_result(h.Number + 1, r):
+                self._closed = True
+                self.close()
+                return
+        del self._buffer[:offset]
@@ -1,3 +1,4 @@
+import copy
 import random
 from collections import OrderedDict
 from datetime import datetime
@@ -3181,12 +3182,21 @@ CFG_VARS = [
 
 
 class VarHandler(object):
-    def __init__(self):
+    """
+    Table of the server variables.
+
+    A table created with a parent only stores the variables changed with set(), all other variables are looked up in
+    the parent. The table of a service is built once and every connection uses its own table on top of it.
+
+    :param VarHandler parent: The table to look up unchanged variables
+    """
+    def __init__(self, parent=None):
         self._class_map = {
             "boolean": Bool,
             "integer": Integer,
             "string": String
         }
+        self.parent = parent
         self.values = OrderedDict()
 
     def _get_var_class(self, name):
@@ -3206,6 +3216,47 @@ class VarHandler(object):
 
             self.values[var.get("name")] = var_cls(**type_options)
 
+    def get(self, name):
+        var = self.values.get(name)
+        if var is None and self.parent is not None:
+            var = self.parent.get(name)
+        return var
+
+    def items(self):
+        if self.parent is None:
+            yield from self.values.items()
+            return
+        for name, var in self.parent.items():
+            yield name, self.values.get(name, var)
+
+    def set(self, name, value):
+        """
+        Change the value of a variable, the variable of the parent is copied on the first change.
+
+        :param str name: Name of the variable
+        :param str value: The new value
+        :return: False if the variable does not exist
+        :rtype: bool
+        """
+        var = self.values.get(name)
+        if var is None:
+            var = self.get(name)
+            if var is None:
+                return False
+            var = copy.copy(var)
+            self.values[name] = var
+        var.value = var.parse(value)
+        return True
+
+    def new_session(self):
+        """
+        Create a table for a connection.
+
+        :return: The table
+        :rtype: VarHandler
+        """
+        return VarHandler(parent=self)
+
 
 class BaseVar(object):
     def __init__(self, dynamic=None, scopes=None):
@@ -3214,6 +3265,9 @@ class BaseVar(object):
         if self.scopes is None:
             self.scopes = []
 
+    def parse(self, value):
+        return value.strip("'\"")
+
 
 class Bool(BaseVar):
     def __init__(self, dynamic=None, scopes=None, value=None, value_default=False):
@@ -3228,6 +3282,9 @@ class Bool(BaseVar):
             return "ON"
         return "OFF"
 
+    def parse(self, value):
+        return BaseVar.parse(self, value).lower() in ("1", "on", "true", "yes")
+
 
 class Integer(BaseVar):
     def __init__(self, dynamic=None, scopes=None, value=None, value_default=0, value_max=None, value_min=None):
@@ -3245,6 +3302,14 @@ class Integer(BaseVar):
     def __str__(self):
         return str(self.value)
 
+    def parse(self, value):
+        value = int(BaseVar.parse(self, value))
+        if self.value_min is not None:
+            value = max(self.value_min, value)
+        if self.value_max is not None:
+            value = min(self.value_max, value)
+        return value
+
     def _value_get(self):
         return self._value
 
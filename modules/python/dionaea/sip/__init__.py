@@ -35,7 +35,6 @@ import logging
 import random
 import os
 import datetime
-import tempfile
 
 from dionaea.core import connection, g_dionaea, incident
 from dionaea import pyev, ServiceLoader
@@ -154,8 +153,16 @@ class RtpUdpStream(connection):
         self.remote.host = remote_address
         self.remote.port = remote_port
 
-        self._bistream = []
-        self._bistream_enabled = bistream_enabled
+        self._bistream = None
+        if bistream_enabled:
+            now = datetime.datetime.now()
+            dirname = "%04i-%02i-%02i" % (now.year, now.month, now.day)
+            self._bistream = session.config.get_bistream(
+                path=os.path.join(g_dionaea.config()['bistreams']['python']['dir'], dirname),
+                prefix="SipCall-{local_port}-{remote_host}:{remote_port}-".format(
+                    local_port = self.local.port, remote_host = self.remote.host,
+                    remote_port = self.remote.port)
+            )
 
         # Send byte buffer
         self.__sendBuffer = b''
@@ -175,26 +182,11 @@ class RtpUdpStream(connection):
         logger.debug("{!s} close".format(self))
         logger.debug("Closing stream dump (in)")
         connection.close(self)
+        if self._pcap is not None:
+            self._pcap.close()
 
-        if len(self._bistream) == 0:
-            return
-
-        now = datetime.datetime.now()
-        dirname = "%04i-%02i-%02i" % (now.year, now.month, now.day)
-        bistream_path = os.path.join(g_dionaea.config()['bistreams']['python']['dir'], dirname)
-        if not os.path.exists(bistream_path):
-            os.makedirs(bistream_path)
-
-        fp = tempfile.NamedTemporaryFile(
-            delete = False,
-            prefix = "SipCall-{local_port}-{remote_host}:{remote_port}-".format(
-                local_port = self.local.port, remote_host = self.remote.host,
-                remote_port = self.remote.port),
-            dir = bistream_path
-        )
-        fp.write(b"stream = ")
-        fp.write(str(self._bistream).encode())
-        fp.close()
+        if self._bistream is not None:
+            self._bistream.close()
 
     def handle_established(self):
         logger.debug("{!s} handle_established".format(self))
@@ -214,10 +206,10 @@ class RtpUdpStream(connection):
         logger.debug("{!s} handle_io_in".format(self))
         #logger.debug("Incoming RTP data (length {})".format(len(data)))
 
-        if self._bistream_enabled:
-            self._bistream.append(("in", data))
+        if self._bistream is not None:
+            self._bistream.write("in", data)
         if self._pcap is not None:
-            self._pcap.write(src_port = self.remote.port, dst_port = self.local.port, data = data)
+            self._pcap.write(direction = "in", src_port = self.remote.port, dst_port = self.local.port, data = data)
 
         return len(data)
 
@@ -227,7 +219,8 @@ class RtpUdpStream(connection):
     def handle_disconnect(self):
         logger.info("{!s} handle_disconnect".format(self))
         self._call.event_stream_closed(self._name)
-        self._pcap.close()
+        if self._pcap is not None:
+            self._pcap.close()
         return False
 
     def handle_error(self, err):
@@ -604,19 +597,12 @@ class SipSession(connection):
         logger.debug("{!s} handle_io_in".format(self))
 
         if self.transport == "udp":
-            # Header must be terminated by an empty line.
-            # If empty line is missing add it.
-            # This works only for sip over udp but not for sip over tcp,
-            # because one UDP package is exactly one sip message.
+            # One UDP package is exactly one sip message, so the empty line at
+            # the end of the header is optional. This works only for sip over
+            # udp but not for sip over tcp.
             # SIP-Servers like Asterisk do it the same way.
             len_used = len(data)
 
-            if not b"\n\r\n" in data and not b"\n\n" in data:
-                data = data + b"\n\r\n"
-
-            # all lines must end with \r\n
-            data = data.replace(b"\r\n", b"\n")
-            data = data.replace(b"\n", b"\r\n")
             try:
                 msg = rfc3261.Message.froms(data, session=self)
             except rfc3261.SipParsingError:
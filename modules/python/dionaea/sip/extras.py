@@ -1,6 +1,7 @@
 """
 Some helper functions.
 """
+from collections import OrderedDict
 import datetime
 import logging
 import os
@@ -8,6 +9,7 @@ import pprint
 import re
 import sqlite3
 import struct
+import tempfile
 import time
 
 logger = logging.getLogger('sip')
@@ -43,6 +45,8 @@ a=rtpmap:97 H263-N800/90000
 [/video_port]
 """
 
+REGEX_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
 
 def int2bytes(value):
     """
@@ -61,6 +65,140 @@ class ErrorWithResponse(Exception):
         return self._msg.create_response(self._response_code, self._status_message)
 
 
+class UserDirectory(object):
+    """
+    In-memory copy of the users and sdp tables.
+
+    The username patterns of every personality are combined into a single regex with one named group per user, the
+    first user in the table matching the username is used. The tables are loaded on first use and reloaded if the
+    modification time of the database file changes.
+
+    :param str filename: SQLite database
+    :param int cache_size: Max number of cached lookups
+    :param float check_interval: Min time in seconds between two checks of the modification time
+    """
+    def __init__(self, filename, cache_size=1000, check_interval=5.0):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+
+        self._mtime = None
+        self._next_check = 0
+        # personality -> (combined regex or None, list of (compiled regex, row))
+        self._users = {}
+        self.sdps = {}
+        # (personality, username) -> row or None
+        self._cache = OrderedDict()
+
+    def _check(self):
+        now = time.monotonic()
+        if self._mtime is not None and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError as e:
+            if self._mtime is None:
+                logger.warning("Unable to load users from %s: %s", self.filename, e)
+                self._mtime = 0
+            return
+        if mtime != self._mtime:
+            self.load()
+            self._mtime = mtime
+
+    def load(self):
+        """
+        Load the users and the sdp tables.
+        """
+        logger.info("Loading SIP users from %s", self.filename)
+        conn = sqlite3.connect(self.filename)
+        try:
+            cur = conn.cursor()
+            rows = cur.execute(
+                "SELECT personality, username, password, pickup_delay_min, pickup_delay_max, action, sdp "
+                "FROM users ORDER BY rowid"
+            ).fetchall()
+            sdps = cur.execute("SELECT name, sdp FROM sdp ORDER BY rowid DESC").fetchall()
+        except sqlite3.Error as e:
+            logger.warning("Unable to load users from %s: %s", self.filename, e)
+            return
+        finally:
+            conn.close()
+
+        patterns = {}
+        for row in rows:
+            expr = row[1]
+            if type(expr) != str:
+                expr = str(expr)
+            try:
+                regex = re.compile(expr)
+            except re.error as e:
+                logger.warning("Invalid username pattern '%s': %s", expr, e)
+                continue
+            patterns.setdefault(row[0], []).append((regex, row[1:]))
+
+        users = {}
+        for personality, entries in patterns.items():
+            combined_regex = None
+            # group numbers change in the combined regex, so patterns with back references can't be combined
+            if not any(REGEX_BACKREFERENCE.search(regex.pattern) for regex, row in entries):
+                combined = "|".join(
+                    "(?P<u%d>%s)" % (i, regex.pattern) for i, (regex, row) in enumerate(entries)
+                )
+                try:
+                    combined_regex = re.compile(combined)
+                except re.error:
+                    # e.g. the same named group in two patterns
+                    combined_regex = None
+            if combined_regex is None:
+                logger.debug("Unable to combine username patterns of personality '%s'", personality)
+            users[personality] = (combined_regex, entries)
+
+        self._users = users
+        # first row wins
+        self.sdps = dict(sdps)
+        self._cache.clear()
+
+    def get_sdp(self, name):
+        self._check()
+        return self.sdps.get(name)
+
+    def get_user(self, personality, username):
+        """
+        Find the first user of the personality with a pattern matching the username.
+
+        :param str personality: Name of the personality
+        :param str username: The username
+        :return: Tuple (username pattern, password, pickup_delay_min, pickup_delay_max, action, sdp) or None
+        """
+        self._check()
+        key = (personality, username)
+        try:
+            row = self._cache[key]
+            self._cache.move_to_end(key)
+            return row
+        except KeyError:
+            pass
+
+        row = None
+        combined_regex, entries = self._users.get(personality, (None, []))
+        if combined_regex is not None:
+            m = combined_regex.match(username)
+            if m is not None:
+                row = entries[int(m.lastgroup[1:])][1]
+        else:
+            for regex, entry in entries:
+                if regex.match(username) is not None:
+                    row = entry
+                    break
+
+        if self.cache_size > 0:
+            self._cache[key] = row
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return row
+
+
 class SipConfig(object):
     """
     This class helps to access the config values.
@@ -93,6 +231,13 @@ class SipConfig(object):
             self._cur.execute("CREATE TABLE IF NOT EXISTS sdp (name STRING, sdp STRING)")
             self._cur.execute("INSERT INTO sdp (name, sdp) VALUES ('default', ?)", (DEFAULT_SDP,))
 
+        self._conn.commit()
+        # (sdp, names of unused media ports) -> sdp without the unused sections
+        self._sdp_templates = {}
+        # sdp -> names of the media ports
+        self._sdp_media_port_names = {}
+        self.user_directory = UserDirectory(self.users, cache_size=config.get("user_cache_size", 1000))
+
         # set default values
         self.personalities = {
             "default": {
@@ -168,26 +313,12 @@ class SipConfig(object):
         )
 
     def get_user_by_username(self, personality, username):
-        def regexp(expr, value):
-            if type(expr) != str:
-                expr = str(expr)
-            regex = re.compile(expr)
-            return regex.match(value) is not None
-
-        conn = sqlite3.connect(self.users)
-
-        sqlite3.enable_callback_tracebacks(True)
-        conn.create_function("regexp", 2, regexp)
-
         if username is None:
             username = b""
 
         username = username.decode("utf-8")
 
-        cur = conn.cursor()
-        cur.execute("SELECT username, password, pickup_delay_min, pickup_delay_max, action, sdp FROM users WHERE personality = ? AND ? REGEXP username", (personality, username))
-        row = cur.fetchone()
-
+        row = self.user_directory.get_user(personality, username)
         if row is None:
             return None
 
@@ -198,7 +329,7 @@ class SipConfig(object):
         # ToDo: sdp is not used! Recheck!!!
         sdp = row[5]
         if sdp == '' or sdp is None:
-            sdp = self.personalities[personality].default_sdp
+            sdp = self.personalities.get(personality, self.personalities["default"])["default_sdp"]
 
         return User(
             username=username,
@@ -207,7 +338,7 @@ class SipConfig(object):
             pickup_delay_min=row[2],
             pickup_delay_max=row[3],
             action=row[4],
-            sdp=row[5]
+            sdp=sdp
         )
 
     def get_personality_by_address(self, address):
@@ -229,6 +360,24 @@ class SipConfig(object):
             mode=self._rtp.get("mode", ["pcap"])
         )
 
+    def get_bistream(self, path, prefix):
+        """
+        Create a writer for a stream if the bistream mode is enabled.
+
+        :return: The writer or None
+        :rtype: BistreamWriter
+        """
+        if "bistream" not in self._rtp.get("modes", []):
+            return None
+
+        bistream_conf = self._rtp.get("bistream", {})
+        return BistreamWriter(
+            path=path,
+            prefix=prefix,
+            max_bytes=int(bistream_conf.get("max_bytes", 10 * 1024 * 1024)),
+            rotate_bytes=int(bistream_conf.get("rotate_bytes", 0))
+        )
+
     def get_pcap(self):
         pcap_conf = self._rtp.get("pcap", {})
         return PCAP(
@@ -236,50 +385,53 @@ class SipConfig(object):
             filename=pcap_conf.get("filename", "%H:%M:%S_{remote_host}_{remote_port}_in.pcap"),
         )
 
+    def _get_sdp(self, name):
+        sdp = self.user_directory.get_sdp(name)
+        if sdp is None:
+            # try to use the default sdp from the db
+            sdp = self.user_directory.get_sdp("default")
+        if sdp is None:
+            sdp = DEFAULT_SDP
+        return sdp
+
     def get_sdp_by_name(self, name, media_ports, **params):
         """
         Fetch the SDP content from the database and add missing values.
         """
         logger.debug("Loading sdp with: params = %s, media_ports %s", pprint.pformat(params), pprint.pformat(media_ports))
-        ret = self._cur.execute("SELECT sdp FROM sdp WHERE name='?'")
-        data = ret.fetchone()
-
-        if data is None:
-            # try to fetch the default sdp from the db
-            ret = self._cur.execute("SELECT sdp FROM sdp WHERE name='default'")
-            data = ret.fetchone()
-
-        if data is None:
-            data = (DEFAULT_SDP,)
-
-        sdp = data[0]
+        sdp = self._get_sdp(name)
+        unused = []
         for n,v in media_ports.items():
             if v is None:
-                sdp = re.sub("\[" + n +"\].*\[\/" + n + "\]", "", sdp, 0, re.DOTALL)
+                unused.append(n)
             else:
                 params[n] = v
 
-        sdp = sdp.format(**params)
+        # the template without the sections of unused media ports is the same for most calls
+        key = (sdp, tuple(sorted(unused)))
+        template = self._sdp_templates.get(key)
+        if template is None:
+            template = sdp
+            for n in key[1]:
+                template = re.sub("\[" + n +"\].*\[\/" + n + "\]", "", template, 0, re.DOTALL)
+            if len(self._sdp_templates) < 256:
+                self._sdp_templates[key] = template
+
+        sdp = template.format(**params)
         return bytes(sdp, "utf-8")
 
     def get_sdp_media_port_names(self, name):
         """
         Find all media ports.
         """
-        ret = self._cur.execute("SELECT sdp FROM sdp WHERE name='?'")
-        data = ret.fetchone()
-
-        if data is None:
-            # try to fetch the default sdp from the db
-            ret = self._cur.execute("SELECT sdp FROM sdp WHERE name='default'")
-            data = ret.fetchone()
+        sdp = self._get_sdp(name)
+        media_ports = self._sdp_media_port_names.get(sdp)
+        if media_ports is None:
+            media_ports = re.findall("{(audio_port[0-9]*|video_port[0-9]*)}", sdp)
+            if len(self._sdp_media_port_names) < 256:
+                self._sdp_media_port_names[sdp] = media_ports
 
-        if data is None:
-            data = (DEFAULT_SDP,)
-
-        media_ports = re.findall("{(audio_port[0-9]*|video_port[0-9]*)}", data[0])
-
-        return media_ports
+        return list(media_ports)
 
     def is_handled_by_personality(self, handler_name, personality = "default"):
         """
@@ -295,31 +447,70 @@ class SipConfig(object):
 
 
 class PCAP(object):
+    """
+    Write SIP and RTP packets as UDP/IPv4/Ethernet frames to a pcap file.
+
+    The records are built from a precomputed header template and written in batches.
+    """
+    # pcap record header + ethernet header + IPv4 header + udp header
+    RECORD_HEADER = struct.Struct("<iiii")
+    IP_LENGTH = struct.Struct(">H")
+    IP_CHECKSUM = struct.Struct("<H")
+    UDP_HEADER = struct.Struct(">HHH")
+    ETHER_OFFSET = 16
+    IP_OFFSET = ETHER_OFFSET + 14
+    UDP_OFFSET = IP_OFFSET + 20
+    HEADER_LENGTH = UDP_OFFSET + 8
+
+    # Write the buffered records if the buffer is larger than this
+    FLUSH_SIZE = 64 * 1024
+
+    # (MAC, IPv4 address) of the remote and the local host
+    REMOTE = (b"\x00\x00\x00\x00\x00\x02", b"\x0A\x00\x00\x02") # 10.0.0.2
+    LOCAL = (b"\x00\x00\x00\x00\x00\x01", b"\x0A\x00\x00\x01") # 10.0.0.1
+
     def __init__(self, path, filename):
         self.path = path
         self.filename = filename
         self._fp = None
+        self._buffer = bytearray()
+
+        # header template and sum of the static words of the IPv4 header for each direction
+        self._templates = {}
+        for direction, src, dst in (("in", self.REMOTE, self.LOCAL), ("out", self.LOCAL, self.REMOTE)):
+            ether = dst[0] # MAC dst
+            ether = ether + src[0] # MAC src
+            ether = ether + b"\x08\x00" # pkt type IPv4
+
+            ip = b"\x45" # version + header length 20bytes
+            ip = ip + b"\x00"
+            ip = ip + b"\x00\x00" # pkt length
+            ip = ip + b"\x00\x00" # identification
+            ip = ip + b"\x40\x00" # flags(do not fragment) + fragment offset(0)
+            ip = ip + b"\x40\x11" # ttl(64) + protocol(udp)
+            ip = ip + b"\x00\x00" # header checksum
+            ip = ip + src[1] # ip src
+            ip = ip + dst[1] # ip dst
+
+            self._templates[direction] = (
+                b"\x00" * self.ETHER_OFFSET + ether + ip + b"\x00" * 8,
+                sum(struct.unpack("<10H", ip))
+            )
 
     def __del__(self):
-        if self._fp is not None:
-            self._fp.close()
-
-    def _carry_arround_add(self, a, b):
-        c = a + b
-        return (c & 0xffff) + (c >> 16)
-
-    def _ip_checksum(self, data):
-        s = 0
-        for i in range(0, len(data), 2):
-            word = data[i] + (data[i + 1] << 8)
-            s = self._carry_arround_add(s, word)
-        return ~s & 0xffff
+        self.close()
 
     def close(self):
         if self._fp is not None:
+            self.flush()
             self._fp.close()
         self._fp = None
 
+    def flush(self):
+        if self._fp is not None and len(self._buffer) > 0:
+            self._fp.write(self._buffer)
+            del self._buffer[:]
+
     def open(self, msg_stack, **params):
         path = self.path.format(**params)
         today = datetime.datetime.now()
@@ -342,40 +533,27 @@ class PCAP(object):
         if self._fp is None:
             return False
 
-        # write pcap global header
-        self._fp.write(b"\xd4\xc3\xb2\xa1")
-        # version 2.4
-        self._fp.write(b"\x02\x00\x04\x00")
-        # GMT to local correction
-        self._fp.write(b"\x00\x00\x00\x00")
-        # accuracy of timestamps
-        self._fp.write(b"\x00\x00\x00\x00")
-        # max length of captured packets, in octets
-        self._fp.write(b"\xff\xff\x00\x00")
-        # data link type (1 = Ethernet) http://www.tcpdump.org/linktypes.html
-        self._fp.write(b"\x01\x00\x00\x00")
+        self._fp.write(
+            b"\xd4\xc3\xb2\xa1" # pcap magic
+            b"\x02\x00\x04\x00" # version 2.4
+            b"\x00\x00\x00\x00" # GMT to local correction
+            b"\x00\x00\x00\x00" # accuracy of timestamps
+            b"\xff\xff\x00\x00" # max length of captured packets, in octets
+            b"\x01\x00\x00\x00" # data link type (1 = Ethernet) http://www.tcpdump.org/linktypes.html
+        )
 
         for msg in msg_stack:
             t = msg[1].time
             ts = int(t)
             tm = int((t - ts) * 1000000)
+            self.write(ts=ts, tm=tm, direction=msg[0], src_port=5060, dst_port=5060, data=msg[1].dumps())
 
-            src_port = 5060
-            dst_port = 5060
-            if msg[0] == "in":
-                src_ether = b"\x00\x00\x00\x00\x00\x02"
-                src_host = b"\x0A\x00\x00\x02" # 10.0.0.2
-                dst_ether = b"\x00\x00\x00\x00\x00\x01"
-                dst_host = b"\x0A\x00\x00\x01" # 10.0.0.1
-            else:
-                src_ether = b"\x00\x00\x00\x00\x00\x01"
-                src_host = b"\x0A\x00\x00\x01" # 10.0.0.1
-                dst_ether = b"\x00\x00\x00\x00\x00\x02"
-                dst_host = b"\x0A\x00\x00\x02" # 10.0.0.2
-
-            self.write(ts=ts, tm=tm, src_ether=src_ether, src_host=src_host, src_port=src_port, dst_ether=dst_ether, dst_host=dst_host, dst_port=dst_port, data=msg[1].dumps())
+    def write(self, ts=None, tm=None, direction="in", src_port=5060, dst_port=5060, data=b""):
+        """
+        Buffer a packet.
 
-    def write(self, ts=None, tm=None, src_ether=b"\x00\x00\x00\x00\x00\x02", src_host=b"\x0A\x00\x00\x02", src_port=5060, dst_ether=b"\x00\x00\x00\x00\x00\x01", dst_host=b"\x0A\x00\x00\x01", dst_port=5060, data=b""):
+        :param str direction: 'in' from the remote to the local host or 'out' from the local to the remote host
+        """
         if self._fp is None:
             return
 
@@ -384,47 +562,118 @@ class PCAP(object):
             ts = int(t)
             tm = int((t - ts) * 1000000)
 
-        src_ether = b"\x00\x00\x00\x00\x00\x02"
-        src_host = b"\x0A\x00\x00\x02" # 10.0.0.2
-        dst_ether = b"\x00\x00\x00\x00\x00\x01"
-        dst_host = b"\x0A\x00\x00\x01" # 10.0.0.1
-
-        # udp header
-        udp = struct.pack(">H", src_port)  # port src
-        udp = udp + struct.pack(">H", dst_port) # port dst
-        udp = udp + struct.pack(">H", len(data) + 8) # length
-        udp = udp + struct.pack(">H", 0) # checksum
-        udp = udp + data
-
-        # IPv4 header
-        ip = b"\x45" # version + header length 20bytes
-        ip = ip + b"\x00"
-        ip = ip + struct.pack(">H", len(udp) + 20) # pkt length
-        ip = ip + b"\x00\x00" # identification
-        ip = ip + b"\x40\x00" # flags(do not fragment) + fragment offset(0)
-        ip = ip + b"\x40\x11" # ttl(64) + protocol(udp)
-        ip = ip + b"\x00\x00" # header checksum
-        ip = ip + dst_host #b"\x0A\x00\x00\x01" # ip src
-        ip = ip + src_host #b"\x0A\x00\x00\x02" # ip dst
-
-        # add checksum to ip header
-        ip = ip[:10] + struct.pack("<H", self._ip_checksum(ip)) + ip[12:]
-
-        # ethernet header
-        ether = src_ether # MAC src
-        ether = ether + dst_ether # MAC dst
-        ether = ether + b"\x08\x00" # pkt type IPv4
-
-        pkt = ether + ip + udp
-
-        # pcap packet header
-        pcap = struct.pack("i", ts) # time seconds
-        pcap = pcap + struct.pack("i", tm) # microseconds
-        pcap = pcap + struct.pack("i", len(pkt)) # length captured
-        pcap = pcap + struct.pack("i", len(pkt)) # real length
-        pcap = pcap + pkt
-
-        self._fp.write(pcap)
+        template, ip_sum = self._templates[direction]
+        buf = self._buffer
+        offset = len(buf)
+        buf += template
+        buf += data
+
+        pkt_length = self.HEADER_LENGTH - self.ETHER_OFFSET + len(data)
+        self.RECORD_HEADER.pack_into(buf, offset, ts, tm, pkt_length, pkt_length)
+
+        ip_length = len(data) + 28
+        self.IP_LENGTH.pack_into(buf, offset + self.IP_OFFSET + 2, ip_length)
+        # add the length, as little-endian word, to the sum of the static words and fold
+        s = ip_sum + (((ip_length & 0xff) << 8) | (ip_length >> 8))
+        while s >> 16:
+            s = (s & 0xffff) + (s >> 16)
+        self.IP_CHECKSUM.pack_into(buf, offset + self.IP_OFFSET + 10, ~s & 0xffff)
+
+        self.UDP_HEADER.pack_into(buf, offset + self.UDP_OFFSET, src_port, dst_port, len(data) + 8)
+
+        if len(buf) >= self.FLUSH_SIZE:
+            self.flush()
+
+
+BISTREAM_MAGIC = b"DIONAEA-BISTREAM\x01"
+# direction (0 = in, 1 = out), timestamp, length of the payload
+BISTREAM_FRAME_HEADER = struct.Struct("<BdI")
+BISTREAM_DIRECTIONS = ("in", "out")
+
+
+class BistreamWriter(object):
+    """
+    Write the datagrams of a stream to an append-only file. Every frame is a header with the direction, the timestamp
+    and the length followed by the payload. Use the bistream2legacy script to convert the file into the old
+    'stream = [...]' format.
+
+    :param str path: Directory to create the files in
+    :param str prefix: Prefix of the filenames
+    :param int max_bytes: Stop recording if the stream exceeds this size, 0 is unlimited
+    :param int rotate_bytes: Start a new file if the current file exceeds this size, 0 disables rotation
+    """
+    def __init__(self, path, prefix, max_bytes=0, rotate_bytes=0):
+        self.path = path
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.rotate_bytes = rotate_bytes
+        self.bytes = 0
+        self.truncated = False
+        self._fp = None
+        self._file_bytes = 0
+        self._part = 0
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = None
+
+    def _open(self):
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self._fp = tempfile.NamedTemporaryFile(
+                delete=False,
+                prefix="%s%04d-" % (self.prefix, self._part),
+                suffix=".bistream",
+                dir=self.path
+            )
+        except OSError as e:
+            logger.warning("Can't create bistream file in %s: %s", self.path, e)
+            self._fp = None
+            return False
+        self._part += 1
+        self._fp.write(BISTREAM_MAGIC)
+        self._file_bytes = len(BISTREAM_MAGIC)
+        return True
+
+    def write(self, direction, data, t=None):
+        """
+        Append a frame.
+
+        :param str direction: 'in' or 'out'
+        :param bytes data: The payload
+        :param float t: Timestamp, default is now
+        :return: False if the frame has not been written
+        :rtype: bool
+        """
+        if self.truncated:
+            return False
+
+        size = BISTREAM_FRAME_HEADER.size + len(data)
+        if self.max_bytes > 0 and self.bytes + size > self.max_bytes:
+            logger.info("Bistream %s reached max size of %d bytes, stop recording", self.prefix, self.max_bytes)
+            self.truncated = True
+            self.close()
+            return False
+
+        if self._fp is not None and self.rotate_bytes > 0 and self._file_bytes + size > self.rotate_bytes:
+            self.close()
+
+        if self._fp is None and not self._open():
+            self.truncated = True
+            return False
+
+        if t is None:
+            t = time.time()
+        self._fp.write(BISTREAM_FRAME_HEADER.pack(BISTREAM_DIRECTIONS.index(direction), t, len(data)))
+        self._fp.write(data)
+        self._file_bytes += size
+        self.bytes += size
+        return True
 
 
 class Timer(object):
@@ -212,6 +212,9 @@ class Header(object):
         b"www-authenticate": b"WWW-Authenticate"
     }
 
+    # header name -> formatted name, shared by all headers
+    _formatted_names = {}
+
     _header_compact2long = {
         b"c": b"content-type",
         b"e": b"content-encoding",
@@ -225,14 +228,28 @@ class Header(object):
         b"v": b"via"
     }
 
-    def __init__(self, name, value = None):
+    def __init__(self, name, value = None, raw = None):
         if type(name) == str:
             name = bytes(name, "utf-8")
         self.name = name.lower()
 
         if type(value) == str:
             value = bytes(value, "utf-8")
-        self._value = value
+        self._parsed_value = value
+        #: unparsed value, it is parsed on first access
+        self._raw = raw
+
+    def _get_parsed_value(self):
+        if self._raw is not None:
+            self._parsed_value = self.parse_value(self._raw, self.name)
+            self._raw = None
+        return self._parsed_value
+
+    def _set_parsed_value(self, value):
+        self._raw = None
+        self._parsed_value = value
+
+    _value = property(_get_parsed_value, _set_parsed_value)
 
     def dumps(self):
         """
@@ -260,6 +277,16 @@ class Header(object):
         name = name.lower()
         name = cls._header_compact2long.get(name, name)
 
+        return (len(data), {'name':name,'value':cls.parse_value(data, name)})
+
+    @classmethod
+    def parse_value(cls, data, name):
+        """
+        Parse the value of a header.
+
+        :param bytes data: The value
+        :param bytes name: The lower case long name of the header
+        """
         if type(data) != bytes:
             value = data
         elif name in cls._address:
@@ -276,17 +303,25 @@ class Header(object):
         else:
             value = data
 
-        return (len(data), {'name':name,'value':value})
+        return value
 
     def format_name(self, name):
-        name = name.lower()
-        if name in self._exception:
-            return self._exception[name]
-        
-        names = name.split(b"-")
-        names = [n.capitalize() for n in names]
-        
-        return b"-".join(names)
+        try:
+            return self._formatted_names[name]
+        except KeyError:
+            pass
+
+        formatted = name.lower()
+        if formatted in self._exception:
+            formatted = self._exception[formatted]
+        else:
+            names = formatted.split(b"-")
+            names = [n.capitalize() for n in names]
+            formatted = b"-".join(names)
+
+        if len(self._formatted_names) < 1024:
+            self._formatted_names[name] = formatted
+        return formatted
 
     def get_raw(self):
         return self._value
@@ -295,6 +330,9 @@ class Header(object):
         """
         Prepare the value and return it as bytes.
         """
+        if self._raw is not None:
+            # not parsed yet, nothing has been changed
+            return self._raw
         if type(self._value) == bytes:
             return self._value
         if type(self._value) == int:
@@ -345,7 +383,10 @@ class Headers(object):
             headers = [headers]
         for header in headers:
             if copy:
-                header = Header.froms(header.dumps())
+                # Parse and serialise the value, the copy must not depend on
+                # whether the header has been accessed before
+                header.get_raw()
+                header = Header(name=header.name, raw=header.get_value())
             if name_new is not None:
                 header.name = name_new
 
@@ -442,6 +483,8 @@ class Message(object):
     b'IN IP4 192.168.1.2'
     """
 
+    _end_of_head = re.compile(b"\r?\n\r?\n")
+
     def __init__(self, session=None, method = None, uri = None, response_code = None, status_message = None, protocol = None, body = None, headers = None, sdp = None, personality = "default"):
         self.method = method
         self.uri = uri
@@ -459,6 +502,8 @@ class Message(object):
         self.sdp = sdp
         #: time of package creation
         self.time = time.time()
+        #: ResponseTemplate used to create the response
+        self._template = None
 
     def create_response(self, code, message = None, personality = None):
         logger.info("Creating Response: code=%s, message=%s", code, message)
@@ -466,18 +511,14 @@ class Message(object):
         if personality is not None:
             self._personality = personality
 
+        handler = self._session.config.get_handlers_by_personality(self._personality)
+        template = ResponseTemplate.get(self._personality, code, message, handler)
+
         res = Message(session=self._session)
-        res.protocol = b"SIP/2.0"
+        res.protocol = template.protocol
         res.response_code = code
-        res.status_message = message
-        if res.status_message is None:
-            if code in status_messages:
-                res.status_message = status_messages[code]
-            else:
-                res.status_message = b""
-
-        if type(res.status_message) == str:
-            res.status_message = bytes(res.status_message, "utf-8")
+        res.status_message = template.status_message
+        res._template = template
 
         for name in [b"cseq", b"call-id", b"via"]:
             res.headers.append(self.headers.get(name, None), True)
@@ -500,18 +541,19 @@ class Message(object):
         contact = Header(name=b"contact", value = cont_addr)
         res.headers.append(contact)
 
-        handler = self._session.config.get_handlers_by_personality(self._personality)
-
-        res.headers.append(Header(name = b"allow", value = ", ".join(handler)))
-        res.headers.append(Header(name = b"content-length", value = 0))
+        # shared pre-rendered headers
+        res.headers.append(template.headers)
 
         return res
 
     def dumps(self):
         # h = Header
         h = []
+        template = self._template
         if self.method is not None:
             h.append(self.method + b" " + self.uri.dumps() + b" " + self.protocol)
+        elif template is not None and template.matches(self):
+            h.append(template.status_line)
         elif self.response_code is not None:
             h.append(self.protocol + b" " + int2bytes(self.response_code) + b" " + self.status_message)
         else:
@@ -529,7 +571,7 @@ class Message(object):
 
     @classmethod
     def froms(cls, data, session=None):
-        return cls(**cls.loads(data, session=session)[1])
+        return cls(**cls.loads(data, session=session, complete=True)[1])
 
     def header_exist(self, header_name):
         """
@@ -552,52 +594,78 @@ class Message(object):
         return True
 
     @classmethod
-    def loads(cls, data, session=None):
+    def loads(cls, data, session=None, complete=False):
         """
         Parse a SIP-Message and return the used bytes
 
+        Lines may end with CRLF or a bare LF. The header values are parsed on first access.
+
+        :param data: The message as bytes or memoryview
+        :param bool complete: The data is one complete message (e.g. a UDP datagram), the empty line at the end of
+                              the header is optional
         :return: bytes used
         """
+        if type(data) == str:
+            data = bytes(data, "utf-8")
+
         # End Of Head
-        if type(data) == bytes:
-            pos = re.search(b"\r?\n\r?\n", data)
+        pos = cls._end_of_head.search(data)
+
+        if pos is not None:
+            # length of used data
+            l = pos.end()
+            head_end = pos.start()
+        elif complete:
+            l = len(data)
+            head_end = len(data)
         else:
-            pos = re.search("\r?\n\r?\n", data)
-            
-        if pos is None:
             return (0, {})
 
-        # length of used data
-        l = pos.end()
-
         # header without empty line
-        header = data[:pos.start()]
-        headers_data = re.split(b"\r?\n", header)
+        header = bytes(data[:head_end])
 
         # body without empty line
-        body = data[pos.end():]
+        body = bytes(data[l:])
+
+        lines = header.split(b"\n")
 
         # remove first line and parse it
         try:
-            h1, h2, h3 = headers_data[0].split(b" ", 2)
+            h1, h2, h3 = lines[0].rstrip(b"\r").split(b" ", 2)
         except:
-            logger.warning("Can't parse first line of sip message: %s", repr(headers_data[0])[:128])
+            logger.warning("Can't parse first line of sip message: %s", repr(lines[0])[:128])
             raise SipParsingError
 
-        del headers_data[0]
-
         response_code = None
         status_message = None
         try:
             response_code, protocol, status_message = int(h2), h1, h3
         except:
             method, uri, protocol = h1, rfc2396.Address.froms(h2), h3
-        
+
         # ToDo: check protocol
         headers = Headers()
-        for h in headers_data:
-            header = Header.froms(h)
-            headers.append(header)
+        name = None
+        value = None
+        for line in lines[1:]:
+            line = line.rstrip(b"\r")
+            if line[:1] in (b" ", b"\t") and name is not None:
+                # folded header line
+                value = value + b" " + line.strip()
+                continue
+            if name is not None:
+                headers.append(Header(name=name, raw=value))
+            name, sep, value = line.partition(b":")
+            if sep == b"":
+                if line.strip() != b"":
+                    logger.warning("Can't parse header line of sip message: %s", repr(line)[:128])
+                name = None
+                continue
+            name = name.strip().lower()
+            name = Header._header_compact2long.get(name, name)
+            value = value.strip()
+        if name is not None:
+            headers.append(Header(name=name, raw=value))
 
         sdp = None
         try:
@@ -649,6 +717,54 @@ class Message(object):
         self._personality = personality
 
 
+class ResponseTemplate(object):
+    """
+    Pre-rendered static parts of a response, shared by all responses with the same personality and status.
+
+    Only the transaction specific headers (Via, From, To, Call-ID, CSeq and Contact) are added per response.
+    """
+
+    # (personality, code, message, handlers) -> ResponseTemplate
+    _templates = {}
+
+    def __init__(self, code, status_message, handlers):
+        self.protocol = b"SIP/2.0"
+        self.response_code = code
+        self.status_message = status_message
+        self.status_line = self.protocol + b" " + int2bytes(code) + b" " + status_message
+
+        self.headers = [
+            Header(name=b"allow", raw=bytes(", ".join(handlers), "utf-8")),
+            Header(name=b"content-length", raw=b"0")
+        ]
+
+    @classmethod
+    def get(cls, personality, code, message, handlers):
+        if type(message) == str:
+            message = bytes(message, "utf-8")
+
+        key = (personality, code, message, tuple(handlers))
+        template = cls._templates.get(key)
+        if template is None:
+            status_message = message
+            if status_message is None:
+                status_message = status_messages.get(code, b"")
+            template = cls(code, status_message, handlers)
+            if len(cls._templates) < 1024:
+                cls._templates[key] = template
+        return template
+
+    def matches(self, msg):
+        """
+        Check if the status line of the message is still the status line of the template.
+        """
+        return (
+            msg.protocol == self.protocol and
+            msg.response_code == self.response_code and
+            msg.status_message == self.status_message
+        )
+
+
 class Via(object):
     """
     Parse and generate the content of a Via: Header.
@@ -0,0 +1,246 @@
+#################################################################################
+#                                Dionaea
+#                            - catches bugs -
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+################################################################################
+
+import json
+import logging
+import sqlite3
+import time
+
+from dionaea import pyev
+from dionaea.core import incident
+from dionaea.exception import LoaderError
+
+
+logger = logging.getLogger("spool")
+logger.setLevel(logging.DEBUG)
+
+
+class UploadSpool(object):
+    """
+    Persistent queue of 'dionaea.upload.request' incidents.
+
+    The requests are stored in a SQLite database and sent with a limited number of concurrent requests. The fields of
+    a request must contain a '_callback', the ihandler handling the callback has to call done() with the value of
+    '_userdata'. Requests without response are sent again with an exponential backoff. Requests which were pending
+    or running if dionaea stopped are sent again after a restart.
+
+    :param str filename: SQLite database file, use ':memory:' for a non persistent spool
+    :param int max_concurrent: Max number of concurrent requests
+    :param int max_attempts: Drop a request after this many attempts
+    :param float retry_delay: Delay in seconds before the first retry, doubled on every attempt
+    :param float request_timeout: Time in seconds to wait for the callback
+    :param float interval: Interval in seconds to check for timed out and delayed requests
+    :param float done_ttl: Time in seconds to remember the dedup keys of completed requests
+    """
+    def __init__(self, filename, max_concurrent=4, max_attempts=5, retry_delay=60, request_timeout=300, interval=5,
+                 done_ttl=30 * 24 * 3600):
+        self.max_concurrent = max_concurrent
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.request_timeout = request_timeout
+        self.done_ttl = done_ttl
+
+        # job -> time the request was sent
+        self._running = {}
+
+        self.dbh = sqlite3.connect(filename)
+        self.cursor = self.dbh.cursor()
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                job INTEGER PRIMARY KEY,
+                state TEXT NOT NULL, -- pending, running
+                dedup_key TEXT UNIQUE,
+                fields TEXT NOT NULL,
+                data TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_try REAL NOT NULL
+            )""")
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS spool_state_next_try_idx ON spool (state, next_try)""")
+        # dedup keys of completed requests
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS spool_done (
+                dedup_key TEXT PRIMARY KEY,
+                done_time REAL NOT NULL
+            )""")
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS spool_done_done_time_idx ON spool_done (done_time)""")
+        # resume requests which were running while dionaea was stopped
+        self.cursor.execute("""UPDATE spool SET state = 'pending' WHERE state = 'running'""")
+        self.dbh.commit()
+
+        count = self.cursor.execute("""SELECT COUNT(*) FROM spool""").fetchone()[0]
+        if count > 0:
+            logger.info("Resuming %d requests from spool %s", count, filename)
+
+        self._timer = pyev.Timer(0, interval, pyev.default_loop(), self._handle_timer)
+        self._timer.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a spool from the 'spool' section of an ihandler config.
+
+        :param dict config: The config
+        :return: The spool
+        :rtype: UploadSpool
+        """
+        if config is None:
+            config = {}
+        filename = config.get("file")
+        if filename is None:
+            logger.info("No spool file configured, pending uploads are lost on restart")
+            filename = ":memory:"
+        try:
+            return cls(
+                filename,
+                max_concurrent=int(config.get("max_concurrent", 4)),
+                max_attempts=int(config.get("max_attempts", 5)),
+                retry_delay=float(config.get("retry_delay", 60)),
+                request_timeout=float(config.get("request_timeout", 300)),
+                done_ttl=float(config.get("done_ttl", 30 * 24 * 3600)),
+            )
+        except ValueError as e:
+            raise LoaderError("Unable to parse spool config: %s", e)
+        except sqlite3.Error as e:
+            raise LoaderError("Unable to open spool file %s: %s", filename, e)
+
+    def add(self, fields, data=None, dedup_key=None):
+        """
+        Add a request to the spool.
+
+        :param dict fields: Values of the upload request incident
+        :param dict data: Additional data returned by get()
+        :param str dedup_key: Ignore the request if a request with the same key is queued or has been completed
+        :return: False if the request has been ignored
+        :rtype: bool
+        """
+        if dedup_key is not None:
+            row = self.cursor.execute(
+                """SELECT 1 FROM spool_done WHERE dedup_key = ?""", (dedup_key,)).fetchone()
+            if row is not None:
+                return False
+
+        self.cursor.execute(
+            """INSERT OR IGNORE INTO spool (state, dedup_key, fields, data, next_try) VALUES ('pending', ?, ?, ?, ?)""",
+            (dedup_key, json.dumps(fields), json.dumps(data), time.time())
+        )
+        if self.cursor.rowcount != 1:
+            return False
+        self.dbh.commit()
+
+        self._send()
+        return True
+
+    def get(self, userdata):
+        """
+        Get the data of a request.
+
+        :param str userdata: The value of '_userdata' of the callback incident
+        :return: Tuple (fields, data) or None if the request is unknown
+        """
+        try:
+            job = int(userdata)
+        except ValueError:
+            return None
+        row = self.cursor.execute("""SELECT fields, data FROM spool WHERE job = ?""", (job,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def done(self, userdata):
+        """
+        Remove a completed request from the spool.
+
+        :param str userdata: The value of '_userdata' of the callback incident
+        """
+        try:
+            job = int(userdata)
+        except ValueError:
+            return
+        self._running.pop(job, None)
+        row = self.cursor.execute("""SELECT dedup_key FROM spool WHERE job = ?""", (job,)).fetchone()
+        if row is not None:
+            if row[0] is not None:
+                self.cursor.execute(
+                    """INSERT OR REPLACE INTO spool_done (dedup_key, done_time) VALUES (?, ?)""", (row[0], time.time()))
+            self.cursor.execute("""DELETE FROM spool WHERE job = ?""", (job,))
+            self.dbh.commit()
+        self._send()
+
+    def stop(self):
+        self._timer.stop()
+        self.dbh.commit()
+        self.dbh.close()
+
+    def _handle_timer(self, watcher, events):
+        now = time.monotonic()
+        expired = [job for job, send_time in self._running.items() if send_time + self.request_timeout < now]
+        for job in expired:
+            del self._running[job]
+            self._retry(job)
+
+        self.cursor.execute("""DELETE FROM spool_done WHERE done_time < ?""", (time.time() - self.done_ttl,))
+        if len(expired) > 0 or self.cursor.rowcount > 0:
+            self.dbh.commit()
+        self._send()
+
+    def _retry(self, job):
+        row = self.cursor.execute("""SELECT attempts FROM spool WHERE job = ?""", (job,)).fetchone()
+        if row is None:
+            return
+        attempts = row[0] + 1
+        if attempts >= self.max_attempts:
+            logger.warning("Dropping request %d after %d attempts", job, attempts)
+            self.cursor.execute("""DELETE FROM spool WHERE job = ?""", (job,))
+            return
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        logger.info("Request %d timed out, retrying in %d seconds", job, delay)
+        self.cursor.execute(
+            """UPDATE spool SET state = 'pending', attempts = ?, next_try = ? WHERE job = ?""",
+            (attempts, time.time() + delay, job)
+        )
+
+    def _send(self):
+        count = self.max_concurrent - len(self._running)
+        if count <= 0:
+            return
+
+        rows = self.cursor.execute(
+            """SELECT job, fields FROM spool WHERE state = 'pending' AND next_try <= ? ORDER BY next_try LIMIT ?""",
+            (time.time(), count)
+        ).fetchall()
+        if len(rows) == 0:
+            return
+
+        self.cursor.executemany(
+            """UPDATE spool SET state = 'running' WHERE job = ?""",
+            [(row[0],) for row in rows]
+        )
+        self.dbh.commit()
+
+        now = time.monotonic()
+        for job, fields in rows:
+            self._running[job] = now
+            i = incident("dionaea.upload.request")
+            for k, v in json.loads(fields).items():
+                i.set(k, v)
+            i._userdata = str(job)
+            i.report()
@@ -29,13 +29,21 @@
 from dionaea import IHandlerLoader
 from dionaea.core import ihandler, incident, g_dionaea
 from dionaea.exception import LoaderError
-from dionaea.util import md5file
+from dionaea.util import HASH_ALGORITHMS, get_file_hashes, get_worker_pool, hashfile_multi, scandir
 
 import os
 import logging
+import re
+import uuid
 logger = logging.getLogger('store')
 logger.setLevel(logging.DEBUG)
 
+STORE_LAYOUTS = ("flat", "sharded")
+INDEX_FILENAME = ".index"
+
+# flat: <md5>, sharded: ab/cd/<sha256>
+STORE_NAME_REGEX = re.compile(r"^(?:[0-9a-f]{32}|([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60})$")
+
 
 class StoreHandlerLoader(IHandlerLoader):
     name = "store"
@@ -49,10 +57,142 @@ class StoreHandlerLoader(IHandlerLoader):
             return None
 
 
+class DownloadStore(object):
+    """
+    Files stored in the download directory. The names of all stored files are kept in an append-only index file,
+    which is loaded into memory at start. New files are linked without checking the download directory first, only
+    the files in the index are checked to still exist. If the index file does not exist it is created by scanning
+    the download directory.
+
+    :param str path: The download directory
+    :param str layout: 'flat' stores files as <md5>, 'sharded' as ab/cd/<sha256>
+    :param str index_filename: Path of the index file
+    """
+    def __init__(self, path, layout="flat", index_filename=None):
+        if layout not in STORE_LAYOUTS:
+            raise ValueError("Unknown layout '%s'" % layout)
+        self.path = path
+        self.layout = layout
+        if index_filename is None:
+            index_filename = os.path.join(path, INDEX_FILENAME)
+        self.index_filename = index_filename
+        self._names = set()
+        self._load_index()
+        self._index = open(self.index_filename, "a")
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def get_name(self, digests):
+        """
+        Get the name of a file in the store.
+
+        :param dict digests: Checksums of the file as returned by hashfile_multi()
+        :return: The name relative to the download directory
+        :rtype: str
+        """
+        if self.layout == "sharded":
+            sha256 = digests["sha256"]
+            return "/".join((sha256[0:2], sha256[2:4], sha256))
+        return digests["md5"]
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def add(self, filename, name):
+        """
+        Add a file to the store by creating a hard link.
+
+        :param str filename: The file to add
+        :param str name: Name of the file in the store
+        :return: False if the file already existed in the store, True otherwise
+        :rtype: bool
+        """
+        path = self.get_path(name)
+        indexed = name in self._names
+        if indexed and os.path.exists(path):
+            return False
+
+        if "/" in name:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        created = True
+        try:
+            os.link(filename, path)
+        except FileExistsError:
+            # Stored but missing in the index e.g. if the index has been removed while dionaea was running
+            created = False
+
+        if not indexed:
+            # Files removed from the download directory are stored again but the index is not changed
+            self._names.add(name)
+            self._index.write(name + "\n")
+            self._index.flush()
+        return created
+
+    def close(self):
+        self._index.close()
+
+    def _load_index(self):
+        try:
+            fp = open(self.index_filename, "r")
+        except FileNotFoundError:
+            logger.info("Index file %s not found, scanning %s", self.index_filename, self.path)
+            self._rebuild_index()
+            return
+
+        with fp:
+            for line in fp:
+                name = line.strip()
+                # Skip partially written lines
+                if STORE_NAME_REGEX.match(name):
+                    self._names.add(name)
+        logger.info("Loaded %d entries from index file %s", len(self._names), self.index_filename)
+
+    def _rebuild_index(self):
+        for name in scan_store(self.path):
+            self._names.add(name)
+
+        tmp_filename = self.index_filename + ".tmp"
+        with open(tmp_filename, "w") as fp:
+            for name in sorted(self._names):
+                fp.write(name + "\n")
+        os.rename(tmp_filename, self.index_filename)
+        logger.info("Created index file %s with %d entries", self.index_filename, len(self._names))
+
+
+def scan_store(path):
+    """
+    Find all files of the flat and the sharded layout in the download directory.
+
+    :param str path: The download directory
+    :return: Generator yielding the names relative to the download directory
+    """
+    for entry in scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            if STORE_NAME_REGEX.match(entry.name):
+                yield entry.name
+            continue
+        if not entry.is_dir(follow_symlinks=False) or len(entry.name) != 2:
+            continue
+        for sub_entry in scandir(entry.path):
+            if not sub_entry.is_dir(follow_symlinks=False):
+                continue
+            for file_entry in scandir(sub_entry.path):
+                name = "/".join((entry.name, sub_entry.name, file_entry.name))
+                if STORE_NAME_REGEX.match(name) and file_entry.is_file(follow_symlinks=False):
+                    yield name
+
+
 class storehandler(ihandler):
     def __init__(self, path, config=None):
         logger.debug("%s ready!" % (self.__class__.__name__))
         ihandler.__init__(self, path)
+        if config is None:
+            config = {}
 
         dionaea_config = g_dionaea.config().get("dionaea")
         self.download_dir = dionaea_config.get("download.dir")
@@ -64,32 +204,101 @@ class storehandler(ihandler):
             if not os.access(self.download_dir, os.W_OK):
                 raise LoaderError("Not allowed to create files in the '%s' directory", self.download_dir)
 
+        try:
+            self.hash_async_min_size = int(config.get("hash_async_min_size", 1024)) * 1024
+        except ValueError:
+            raise LoaderError("Unable to convert value of 'hash_async_min_size' to an integer")
+
+        layout = config.get("layout", "flat")
+        if layout not in STORE_LAYOUTS:
+            raise LoaderError("Unknown layout '%s', use one of %s", layout, ", ".join(STORE_LAYOUTS))
+
+        index_filename = config.get("index_file")
+        try:
+            self.store = DownloadStore(self.download_dir, layout=layout, index_filename=index_filename)
+        except OSError as e:
+            raise LoaderError("Unable to open the index of the download directory: %s", e)
+
     def handle_incident(self, icd):
         logger.debug("storing file")
         p = icd.path
-        # ToDo: use sha1 or sha256
-        md5 = md5file(p)
-        # ToDo: use sys.path.join()
-        n = os.path.join(self.download_dir, md5)
-        i = incident("dionaea.download.complete.hash")
-        i.file = n
-        i.url = icd.url
+        url = icd.url
+        con = None
         if hasattr(icd, 'con'):
-            i.con = icd.con
-        i.md5hash = md5
-        i.report()
+            con = icd.con
 
+        # Checksums are attached by the download broker if the file is already known
+        digests = get_file_hashes(icd)
+        if digests is not None:
+            self._store(p, url, con, digests)
+            return
+
+        if os.stat(p).st_size < self.hash_async_min_size:
+            self._store(p, url, con, hashfile_multi(p))
+            return
+
+        # The file is removed after the incident has been handled,
+        # keep a link to it until all checksums have been computed.
+        tmp_path = os.path.join(self.download_dir, "store-%s.tmp" % uuid.uuid4().hex)
         try:
-            os.stat(n)
-            i = incident("dionaea.download.complete.again")
-            logger.debug("file %s already existed" % md5)
+            os.link(p, tmp_path)
+        except OSError:
+            logger.warning("Unable to link file %s, computing checksums in the main loop", p, exc_info=True)
+            self._store(p, url, con, hashfile_multi(p))
+            return
+
+        if con is not None:
+            con.ref()
+
+        logger.debug("computing checksums of %s in a worker thread", p)
+        get_worker_pool().submit(
+            lambda future: self._handle_hash_result(future, tmp_path, url, con),
+            hashfile_multi,
+            tmp_path
+        )
+
+    def _handle_hash_result(self, future, path, url, con):
+        try:
+            digests = future.result()
         except OSError:
-            logger.debug("saving new file %s to %s" % (md5, n))
-            os.link(p, n)
+            logger.warning("Unable to compute checksums of %s", path, exc_info=True)
+        else:
+            self._store(path, url, con, digests)
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            if con is not None:
+                con.unref()
+
+    def _set_hashes(self, i, digests):
+        for name in HASH_ALGORITHMS:
+            setattr(i, name + "hash", digests[name])
+
+    def stop(self):
+        self.store.close()
+
+    def _store(self, p, url, con, digests):
+        name = self.store.get_name(digests)
+        n = self.store.get_path(name)
+        i = incident("dionaea.download.complete.hash")
+        i.file = n
+        i.url = url
+        if con is not None:
+            i.con = con
+        self._set_hashes(i, digests)
+        i.report()
+
+        if self.store.add(p, name):
+            logger.debug("saved new file %s to %s" % (name, n))
             i = incident("dionaea.download.complete.unique")
+        else:
+            i = incident("dionaea.download.complete.again")
+            logger.debug("file %s already existed" % name)
         i.file = n
-        if hasattr(icd, 'con'):
-            i.con = icd.con
-        i.url = icd.url
-        i.md5hash = md5
+        if con is not None:
+            i.con = con
+        i.url = url
+        self._set_hashes(i, digests)
         i.report()
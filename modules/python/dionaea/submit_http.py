@@ -1,9 +1,9 @@
-from dionaea.core import ihandler, incident, g_dionaea
-from dionaea.util import md5file, sha512file
+from dionaea.core import ihandler, g_dionaea
+from dionaea.spool import UploadSpool
+from dionaea.util import get_file_hash
 from dionaea import pyev, IHandlerLoader
 
 import logging
-import uuid
 import struct
 import socket
 from urllib.parse import urlparse
@@ -42,6 +42,15 @@ class submithttp_report:
         self.filetype = ''
         self.filename = ''
 
+    @classmethod
+    def from_dict(cls, data):
+        mr = cls(data["sha512h"], data["md5h"], data["filepath"])
+        mr.__dict__.update(data)
+        return mr
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
 
 class handler(ihandler):
     def __init__(self, path, config=None):
@@ -52,7 +61,7 @@ class handler(ihandler):
         self.email = config.get("email")
         self.user = config.get("user", "")
         self.passwd = config.get("pass", "")
-        self.cookies = {}
+        self.spool = UploadSpool.from_config(config.get("spool"))
 
         # heartbeats
         #dinfo = g_dionaea.version()
@@ -65,96 +74,97 @@ class handler(ihandler):
         #)
         self.loop = pyev.default_loop()
 
+    def stop(self):
+        self.spool.stop()
+
     def handle_incident(self, icd):
         pass
 
-    def handle_incident_dionaea_download_complete_unique(self, icd):
-        cookie = str(uuid.uuid4())
-
-        i = incident("dionaea.upload.request")
-        i._url = self.backendurl
-
-        i.sha512 = sha512file(icd.file)
-        i.md5 = md5file(icd.file)
-        i.email = self.email
-        i.user = self.user
-        i.set('pass', self.passwd)
+    def _request_fields(self, mr):
+        fields = {
+            "_url": self.backendurl,
+            "sha512": mr.sha512h,
+            "md5": mr.md5h,
+            "user": self.user,
+            "pass": self.passwd,
+        }
+        if self.email is not None:
+            fields["email"] = self.email
+        return fields
 
-        mr = submithttp_report(i.sha512, i.md5, icd.file)
+    def handle_incident_dionaea_download_complete_unique(self, icd):
+        mr = submithttp_report(get_file_hash(icd, "sha512"), get_file_hash(icd, "md5"), icd.file)
+        fields = self._request_fields(mr)
 
         if hasattr(icd, 'con'):
-            i.source_host = str(
+            mr.saddr = str(
                 struct.unpack('!I', socket.inet_aton(icd.con.remote.host))[0]
             )
-            i.source_port = str(icd.con.remote.port)
-            i.target_host = str(
+            mr.sport = str(icd.con.remote.port)
+            mr.daddr = str(
                 struct.unpack('!I', socket.inet_aton(icd.con.local.host))[0]
             )
-            i.target_port = str(icd.con.local.port)
-            mr.saddr, mr.sport, mr.daddr, mr.dport = i.source_host, i.source_port, i.target_host, i.target_port
+            mr.dport = str(icd.con.local.port)
+            fields["source_host"], fields["source_port"] = mr.saddr, mr.sport
+            fields["target_host"], fields["target_port"] = mr.daddr, mr.dport
         if hasattr(icd, 'url'):
-            i.url = icd.url
-            i.trigger = icd.url
+            url = icd.url
+            if isinstance(url, bytes):
+                url = url.decode("utf-8", "replace")
+            fields["url"] = url
+            fields["trigger"] = url
             try:
-                i.filename = urlparse(icd.url).path.split('/')[-1]
-                mr.filename = i.filename
+                mr.filename = urlparse(url).path.split('/')[-1]
+                fields["filename"] = mr.filename
             except:
                 pass
-            mr.download_url = icd.url
+            mr.download_url = url
 
-        i.filetype = filetype(icd.file)
-        mr.filetype = i.filetype
+        mr.filetype = filetype(icd.file)
+        fields["filetype"] = mr.filetype
 
-        i._callback = "dionaea.modules.python.submithttp.result"
-        i._userdata = cookie
-
-        self.cookies[cookie] = mr
-        i.report()
+        fields["_callback"] = "dionaea.modules.python.submithttp.result"
+        self.spool.add(fields, data=mr.to_dict())
 
     # handle agains in the same way
     handle_incident_dionaea_download_complete_again = handle_incident_dionaea_download_complete_unique
 
     def handle_incident_dionaea_modules_python_submithttp_result(self, icd):
-        fh = open(icd.path, mode="rb")
-        c = fh.read()
+        with open(icd.path, mode="rb") as fh:
+            c = fh.read()
         logger.info("submithttp result: {0}".format(c))
 
-        cookie = icd._userdata
-        mr = self.cookies[cookie]
+        job = self.spool.get(icd._userdata)
+        if job is None:
+            return
+        mr = submithttp_report.from_dict(job[1])
 
         # does backend want us to upload?
         if b'UNKNOWN' in c or b'S_FILEREQUEST' in c:
-            i = incident("dionaea.upload.request")
-            i._url = self.backendurl
-
-            i.sha512 = mr.sha512h
-            i.md5 = mr.md5h
-            i.email = self.email
-            i.user = self.user
-            i.set('pass', self.passwd)
+            fields = self._request_fields(mr)
+            fields["file://data"] = mr.filepath
 
-            i.set('file://data', mr.filepath)
+            fields["source_host"] = mr.saddr
+            fields["source_port"] = mr.sport
+            fields["target_host"] = mr.daddr
+            fields["target_port"] = mr.dport
+            fields["url"] = mr.download_url
+            fields["trigger"] = mr.download_url
 
-            i.source_host = mr.saddr
-            i.source_port = mr.sport
-            i.target_host = mr.daddr
-            i.target_port = mr.dport
-            i.url = mr.download_url
-            i.trigger = mr.download_url
+            fields["filetype"] = mr.filetype
+            fields["filename"] = mr.filename
 
-            i.filetype = mr.filetype
-            i.filename = mr.filename
+            fields["_callback"] = "dionaea.modules.python.submithttp.uploadresult"
 
-            i._callback = "dionaea.modules.python.submithttp.uploadresult"
-            i._userdata = cookie
+            # upload every file only once, e.g. if the result of an again download arrives first
+            if not self.spool.add(fields, data=mr.to_dict(), dedup_key=mr.sha512h):
+                logger.debug("File %s already uploaded or queued", mr.sha512h)
 
-            i.report()
-        else:
-            del self.cookies[cookie]
+        self.spool.done(icd._userdata)
 
     def handle_incident_dionaea_modules_python_submithttp_uploadresult(self, icd):
-        fh = open(icd.path, mode="rb")
-        c = fh.read()
+        with open(icd.path, mode="rb") as fh:
+            c = fh.read()
         logger.info("submithttp uploadresult: {0}".format(c))
 
-        del self.cookies[icd._userdata]
+        self.spool.done(icd._userdata)
@@ -28,7 +28,9 @@
 import logging
 
 from dionaea import IHandlerLoader
-from dionaea.core import ihandler, incident
+from dionaea.core import ihandler
+from dionaea.spool import UploadSpool
+from dionaea.util import get_file_hash
 
 logger = logging.getLogger('submit_http_post')
 logger.setLevel(logging.DEBUG)
@@ -39,7 +41,10 @@ class SubmitHTTPPostLoader(IHandlerLoader):
 
     @classmethod
     def start(cls, config=None):
-        return SubmitHTTPPost("dionaea.download.complete.unique", config=config)
+        handler = SubmitHTTPPost("dionaea.download.complete.unique", config=config)
+        # The callback incidents of the uploads have a different origin
+        result_handler = SubmitHTTPPostResult("dionaea.modules.python.submit_http_post.result", handler.spool)
+        return [handler, result_handler]
 
 
 class SubmitHTTPPost(ihandler):
@@ -47,9 +52,17 @@ class SubmitHTTPPost(ihandler):
         logger.debug("%s ready!", self.__class__.__name__)
         ihandler.__init__(self, path)
         self.tos = config.get("submit", [])
+        self.spool = UploadSpool.from_config(config.get("spool"))
+
+    def stop(self):
+        self.spool.stop()
 
     def handle_incident(self, icd):
+        pass
+
+    def handle_incident_dionaea_download_complete_unique(self, icd):
         logger.debug("submitting file")
+        sha512 = get_file_hash(icd, "sha512")
 
         for name, to in self.tos.items():
             urls = to.get("urls")
@@ -58,15 +71,29 @@ class SubmitHTTPPost(ihandler):
                 continue
 
             for url in urls:
-                i = incident("dionaea.upload.request")
-                i._url = url
+                fields = {
+                    "_url": url,
+                    "_callback": "dionaea.modules.python.submit_http_post.result",
+                }
 
                 # copy all values for this url
-                for k, v in to.get("field_values", {}):
-                    i.set(k, v)
+                for k, v in to.get("field_values", {}).items():
+                    fields[k] = v
 
                 file_fieldname = to.get("file_fieldname")
                 if file_fieldname is not None:
-                    i.set("file://%s" % file_fieldname, icd.file)
+                    fields["file://%s" % file_fieldname] = icd.file
+
+                self.spool.add(fields, dedup_key="%s %s" % (url, sha512))
+
+
+class SubmitHTTPPostResult(ihandler):
+    def __init__(self, path, spool):
+        ihandler.__init__(self, path)
+        self.spool = spool
+
+    def handle_incident(self, icd):
+        pass
 
-                i.report()
+    def handle_incident_dionaea_modules_python_submit_http_post_result(self, icd):
+        self.spool.done(icd._userdata)
@@ -43,6 +43,7 @@ from dionaea.exception import ServiceConfigError
 import tempfile
 import struct
 import logging
+import mmap
 import os
 
 
@@ -51,6 +52,15 @@ MIN_BLKSIZE = 8
 DEF_BLKSIZE = 512
 MAX_BLKSIZE = 65536
 
+# RFC 7440
+DEF_WINDOWSIZE = 1
+MIN_WINDOWSIZE = 1
+MAX_WINDOWSIZE = 65535
+# Max number of data bytes in one window, the window size is reduced for large blocks
+MAX_WINDOW_BYTES = 65536
+
+DAT_HEADER = struct.Struct("!HH")
+
 logger = logging.getLogger('tftp')
 logger.setLevel(logging.INFO)
 
@@ -60,7 +70,7 @@ class TFTPDownloadHandlerLoader(IHandlerLoader):
 
     @classmethod
     def start(cls, config=None):
-        return tftpdownloadhandler("dionaea.download.offer")
+        return tftpdownloadhandler("dionaea.download.fetch")
 
 
 class TFTPService(ServiceLoader):
@@ -636,23 +646,79 @@ class TftpPacketFactory(object):
         return packet
 
 
+class TftpCachedFile(object):
+    """A served file mapped into memory and shared by all sessions."""
+    def __init__(self, filename, st):
+        self.filename = filename
+        self.key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.refs = 0
+        if self.size == 0:
+            # Empty files can not be mapped
+            self.data = memoryview(b"")
+        else:
+            with open(filename, "rb") as fp:
+                self.data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def block(self, index, blksize):
+        """Return the block with the given zero based index for the given
+        blksize. The last block is always shorter than blksize, it might be
+        empty."""
+        return self.data[index * blksize:(index + 1) * blksize]
+
+
+class TftpFileCache(object):
+    """Process-wide cache of the files served by the TFTP server. Concurrent
+    sessions requesting the same file share one memory mapping."""
+    def __init__(self):
+        self._files = {}
+
+    def acquire(self, filename):
+        st = os.stat(filename)
+        cached_file = self._files.get(filename)
+        if cached_file is None or cached_file.key != (st.st_ino, st.st_size, st.st_mtime_ns):
+            logger.debug("Mapping file %s" % filename)
+            cached_file = TftpCachedFile(filename, st)
+            self._files[filename] = cached_file
+        cached_file.refs += 1
+        return cached_file
+
+    def release(self, cached_file):
+        cached_file.refs -= 1
+        if cached_file.refs <= 0 and self._files.get(cached_file.filename) is cached_file:
+            # Unused, the mapping is freed once all references are gone
+            del self._files[cached_file.filename]
+
+
+file_cache = TftpFileCache()
+
+
 class TftpServerHandler(TftpSession):
-    def __init__ (self, state, root, localhost, remotehost, remoteport, packet):
+    def __init__ (self, state, root, localhost, remotehost, remoteport, packet, max_windowsize=DEF_WINDOWSIZE):
         TftpSession.__init__(self)
         self.bind(localhost,0)
         self.connect(remotehost, remoteport)
         self.packet = packet
         self.state = state
         self.root = root
+        self.max_windowsize = max_windowsize
         self.mode = None
         self.filename = None
         self.options = { 'blksize': DEF_BLKSIZE }
         self.blocknumber = 0
-        self.buffer = None
+        # Absolute number of the last block sent and the last block acknowledged by the client
+        self.sent_block = 0
+        self.acked_block = 0
         self.fileobj = None
         self.timeouts.idle = 3
         self.timeouts.sustain = 120
 
+    def handle_disconnect(self):
+        if self.fileobj is not None:
+            file_cache.release(self.fileobj)
+            self.fileobj = None
+        return False
+
     def handle_timeout_idle(self):
         return False
 
@@ -724,11 +790,33 @@ class TftpServerHandler(TftpSession):
                         # Delete the option now that it's handled.
                         del recvpkt.options['tsize']
 
+                    if 'windowsize' in recvpkt.options:
+                        logger.debug("RRQ includes a windowsize option")
+                        try:
+                            windowsize = int(recvpkt.options['windowsize'])
+                        except ValueError:
+                            windowsize = 0
+                        # Delete the option now that it's handled.
+                        del recvpkt.options['windowsize']
+                        if windowsize >= MIN_WINDOWSIZE and windowsize <= MAX_WINDOWSIZE:
+                            # The server may reduce the window size (RFC 7440)
+                            windowsize = min(windowsize, self.max_windowsize)
+                            blksize = int(self.options['blksize'])
+                            windowsize = max(MIN_WINDOWSIZE, min(windowsize, MAX_WINDOW_BYTES // blksize))
+                            logger.info("Client requested windowsize = %d"
+                                        % windowsize)
+                            if windowsize != DEF_WINDOWSIZE:
+                                self.options['windowsize'] = windowsize
+                        else:
+                            logger.warning("Client %s requested invalid "
+                                           "windowsize %d, ignoring option"
+                                           % (self.remote.host, windowsize))
+
                     if len(list(recvpkt.options.keys())) > 0:
                         logger.warning("Client %s requested unsupported options: %s"
                                        % (self.remote.host, recvpkt.options))
 
-                    if self.options['blksize'] != DEF_BLKSIZE or 'tsize' in self.options:
+                    if self.options['blksize'] != DEF_BLKSIZE or 'tsize' in self.options or 'windowsize' in self.options:
                         logger.info("Options requested, sending OACK")
                         self.send_oack()
                     else:
@@ -761,15 +849,25 @@ class TftpServerHandler(TftpSession):
                 self.start_download()
             else:
                 if self.state.state == 'dat' or self.state.state == 'fin':
-                    if self.blocknumber == recvpkt.blocknumber:
+                    # Map the 16 bit block number to the blocks sent but not acknowledged yet
+                    delta = (recvpkt.blocknumber - self.acked_block) & 0xffff
+                    if delta > 0 and delta <= self.sent_block - self.acked_block:
                         logger.debug("Received ACK for block %d"
                                      % recvpkt.blocknumber)
-                        if self.state.state == 'fin':
+                        self.acked_block += delta
+                        if self.acked_block < self.sent_block:
+                            # The client did not receive the whole window,
+                            # continue with the block after the acknowledged one (RFC 7440)
+                            logger.debug("Received ACK for block %d inside the window, resending"
+                                         % recvpkt.blocknumber)
+                            self.state.state = 'dat'
+                            self.send_dat(resend=True)
+                        elif self.state.state == 'fin':
                             #                            raise TftpException, "Successful transfer."
                             self.close()
                         else:
                             self.send_dat()
-                    elif recvpkt.blocknumber < self.blocknumber:
+                    elif delta == 0 or delta > 0x8000:
                         # Don't resend a DAT due to an old ACK. Fixes the
                         # sorceror's apprentice problem.
                         logger.warn("Received old ACK for block number %d"
@@ -804,33 +902,46 @@ class TftpServerHandler(TftpSession):
         return len(data)
 
     def start_download(self):
-        """This method opens self.filename, stores the resulting file object
-        in self.fileobj, and calls send_dat()."""
+        """This method gets self.filename from the file cache, stores the
+        resulting cached file in self.fileobj, and calls send_dat()."""
         self.state.state = 'dat'
-        self.fileobj = open(self.filename, "rb")
+        try:
+            self.fileobj = file_cache.acquire(self.filename)
+        except (OSError, ValueError):
+            logger.warning("Unable to read file %s" % self.filename, exc_info=True)
+            self.senderror(TftpErrors.AccessViolation)
+            self.close()
+            return
         self.send_dat()
 
     def send_dat(self, resend=False):
-        """This method reads sends a DAT packet based on what is in self.buffer."""
-        if not resend:
-            blksize = int(self.options['blksize'])
-            self.buffer = self.fileobj.read(blksize)
-            logger.debug("Read %d bytes into buffer" % len(self.buffer))
-            if len(self.buffer) < blksize:
+        """This method sends the next window of DAT packets. Every packet is
+        the header followed by a slice of the mapped file, all packets are
+        sent with a single call.
+
+        If resend is True the window starts with the block after the last
+        acknowledged block."""
+        blksize = int(self.options['blksize'])
+        windowsize = int(self.options.get('windowsize', DEF_WINDOWSIZE))
+        if resend:
+            logger.warn("Resending from block number %d" % ((self.acked_block + 1) & 0xffff))
+            self.sent_block = self.acked_block
+
+        packets = []
+        for index in range(self.sent_block, self.sent_block + windowsize):
+            block = self.fileobj.block(index, blksize)
+            self.sent_block += 1
+            # Block numbers roll over to zero
+            self.blocknumber = self.sent_block & 0xffff
+            # bytes + memoryview copies the block once, the bytes are passed on without another copy
+            packets.append(DAT_HEADER.pack(3, self.blocknumber) + block)
+            if len(block) < blksize:
                 logger.info("Reached EOF on file %s" % self.filename)
                 self.state.state = 'fin'
-            self.blocknumber += 1
-            if self.blocknumber > 65535:
-                logger.debug("Blocknumber rolled over to zero")
-                self.blocknumber = 0
-        else:
-            logger.warn("Resending block number %d" % self.blocknumber)
-        dat = TftpPacketDAT()
-        dat.data = self.buffer
-        dat.blocknumber = self.blocknumber
-        logger.debug("Sending DAT packet %d" % self.blocknumber)
-        self.send(dat.encode().buffer)
+                break
 
+        logger.debug("Sending %d DAT packets, last block %d" % (len(packets), self.blocknumber))
+        self.send_many(packets)
 
     # FIXME - should these be factored-out into the session class?
     def send_oack(self):
@@ -845,6 +956,7 @@ class TftpServerHandler(TftpSession):
 
 class TftpServer(TftpSession):
     shared_config_values = [
+        "max_windowsize",
         "root"
     ]
 
@@ -852,6 +964,7 @@ class TftpServer(TftpSession):
         TftpSession.__init__(self)
         self.packet = TftpPacketFactory()
         self.root = ''
+        self.max_windowsize = 16
 
     def apply_config(self, config):
         self.root = config.get("root", self.root)
@@ -862,6 +975,17 @@ class TftpServer(TftpSession):
         if not os.access(self.root, os.R_OK):
             raise ServiceConfigError("Unable to list files in the '%s' directory", self.root)
 
+        try:
+            self.max_windowsize = int(config.get("max_windowsize", self.max_windowsize))
+        except ValueError:
+            raise ServiceConfigError("Unable to convert value of 'max_windowsize' to an integer")
+        if self.max_windowsize < MIN_WINDOWSIZE or self.max_windowsize > MAX_WINDOWSIZE:
+            raise ServiceConfigError(
+                "The value of 'max_windowsize' must be between %d and %d",
+                MIN_WINDOWSIZE,
+                MAX_WINDOWSIZE
+            )
+
     def handle_io_in(self,data):
         logger.debug("Data ready on our main socket")
         buffer = data
@@ -877,7 +1001,8 @@ class TftpServer(TftpSession):
             logger.debug("RRQ packet from %s:%i" %
                          (self.remote.host, self.remote.port))
             t = TftpServerHandler(TftpState(
-                'rrq'), self.root, self.local.host, self.remote.host, self.remote.port, self.packet)
+                'rrq'), self.root, self.local.host, self.remote.host, self.remote.port, self.packet,
+                max_windowsize=self.max_windowsize)
             t.handle_io_in(data)
         elif isinstance(recvpkt, TftpPacketWRQ):
             logger.warn("Write requests not implemented at this time.")
@@ -1105,6 +1230,11 @@ class TftpClient(TftpSession):
         if self.fileobj:
             self.fileobj.close()
             self.fileobj.unlink(self.fileobj.name)
+        icd = incident("dionaea.download.failed")
+        icd.url = self.url
+        if self.con is not None:
+            icd.con = self.con
+        icd.report()
         self.close()
 
 
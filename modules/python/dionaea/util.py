@@ -28,12 +28,28 @@
 
 import hashlib
 import logging
+import os
 import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 
 
 logger = logging.getLogger("util")
 logger.setLevel(logging.DEBUG)
 
+SHELLSHOCK_REGEX = re.compile(rb"\(\)\s*\t*\{.*;\s*\}\s*;")
+# Same as above but never matches across lines, used to scan joined values
+SHELLSHOCK_LINE_REGEX = re.compile(rb"\(\)[^\S\n]*\{.*;[^\S\n]*\}[^\S\n]*;")
+DOWNLOAD_URL_REGEX = re.compile(
+    rb"(wget|curl).+(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
+)
+
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "sha512")
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 def md5file(filename):
     """
@@ -66,14 +82,72 @@ def hashfile(filename, digest):
     :return: Checksum as hex string
     :rtype: str
     """
-    fh = open(filename, mode="rb")
-    while 1:
-        buf = fh.read(4096)
-        if len(buf) == 0:
-            break
-        digest.update(buf)
-    fh.close()
-    return digest.hexdigest()
+    return hashfile_multi(filename, {"digest": digest})["digest"]
+
+
+def hashfile_multi(filename, digests=None):
+    """
+    Compute several checksums of a file in a single pass.
+
+    :param str filename: File to read
+    :param dict digests: Hash objects by name, defaults to all HASH_ALGORITHMS
+    :return: Checksums as hex strings by name
+    :rtype: dict
+    """
+    if digests is None:
+        digests = dict((name, hashlib.new(name)) for name in HASH_ALGORITHMS)
+
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filename, mode="rb") as fh:
+        while True:
+            length = fh.readinto(buf)
+            if not length:
+                break
+            chunk = view[:length]
+            for digest in digests.values():
+                digest.update(chunk)
+
+    return dict((name, digest.hexdigest()) for name, digest in digests.items())
+
+
+def get_file_hash(icd, name):
+    """
+    Get a checksum of the file of a 'dionaea.download.complete.*' incident. The value attached by the store ihandler
+    is used if available, otherwise the checksum is computed.
+
+    :param icd: The incident
+    :param str name: Name of the hash algorithm e.g. md5, sha512
+    :return: Checksum as hex string
+    :rtype: str
+    """
+    try:
+        value = getattr(icd, name + "hash")
+    except AttributeError:
+        value = None
+    if value is not None:
+        return value
+    return hashfile(icd.file, hashlib.new(name))
+
+
+def get_file_hashes(icd):
+    """
+    Get all checksums attached to a 'dionaea.download.complete*' incident.
+
+    :param icd: The incident
+    :return: Checksums as hex strings by name or None if not all HASH_ALGORITHMS are available
+    :rtype: dict
+    """
+    digests = {}
+    for name in HASH_ALGORITHMS:
+        try:
+            value = getattr(icd, name + "hash")
+        except AttributeError:
+            return None
+        if not isinstance(value, str):
+            return None
+        digests[name] = value
+    return digests
 
 
 def detect_shellshock(connection, data, report_incidents=True):
@@ -85,24 +159,46 @@ def detect_shellshock(connection, data, report_incidents=True):
     :param report_incidents:
     :return: List of urls or None
     """
-    from dionaea.core import incident
-    regex = re.compile(b"\(\)\s*\t*\{.*;\s*\}\s*;")
-    if not regex.search(data):
+    if not SHELLSHOCK_REGEX.search(data):
         return None
     logger.debug("Shellshock attack found")
 
-    urls = []
-    regex = re.compile(
-        b"(wget|curl).+(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
-    )
-    for m in regex.finditer(data):
-        logger.debug("Found download command with url %s", m.group("url"))
-        urls.append(m.group("url"))
-        if report_incidents:
-            i = incident("dionaea.download.offer")
-            i.con = connection
-            i.url = m.group("url")
-            i.report()
+    return find_shell_download(connection, data, report_incidents=report_incidents)
+
+
+def detect_shellshock_lines(connection, lines, report_incidents=True):
+    """
+    Try to find Shellshock attacks in a list of values, e.g. all HTTP header values.
+
+    All values are joined and scanned in a single pass. The download command
+    regex is only applied to the values with a Shellshock pattern.
+
+    :param connection: The connection object
+    :param lines: List of values to analyse, values must not contain newlines
+    :param report_incidents:
+    :return: List of urls or None
+    """
+    data = b"\n".join(lines)
+    # Cheap prefilter, most requests do not contain a function definition at all
+    if b"()" not in data:
+        return None
+
+    urls = None
+    next_start = 0
+    for m in SHELLSHOCK_LINE_REGEX.finditer(data):
+        start = data.rfind(b"\n", 0, m.start()) + 1
+        if start < next_start:
+            # Value has already been analysed
+            continue
+        end = data.find(b"\n", m.end())
+        if end == -1:
+            end = len(data)
+        next_start = end + 1
+
+        logger.debug("Shellshock attack found")
+        if urls is None:
+            urls = []
+        urls += find_shell_download(connection, data[start:end], report_incidents=report_incidents)
 
     return urls
 
@@ -118,10 +214,10 @@ def find_shell_download(connection, data, report_incidents=True):
     """
     from dionaea.core import incident
     urls = []
-    regex = re.compile(
-        b"(wget|curl).+(?P<url>(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?)"
-    )
-    for m in regex.finditer(data):
+    if b"wget" not in data and b"curl" not in data:
+        return urls
+
+    for m in DOWNLOAD_URL_REGEX.finditer(data):
         logger.debug("Found download command with url %s", m.group("url"))
         urls.append(m.group("url"))
         if report_incidents:
@@ -131,3 +227,211 @@ def find_shell_download(connection, data, report_incidents=True):
             i.report()
 
     return urls
+
+
+class _DirEntry(object):
+    """
+    Minimal replacement for os.DirEntry if os.scandir() is not available (Python < 3.5)
+    """
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+        self._stat = None
+        self._lstat = None
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return S_ISREG(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def scandir(path):
+    """
+    Get all entries of a directory. Use os.scandir() if available, it uses the information returned by the
+    operating system while reading the directory and avoids additional stat calls.
+
+    :param str path: Path of the directory
+    :return: List of os.DirEntry like objects
+    :rtype: list
+    """
+    if hasattr(os, "scandir"):
+        return list(os.scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+class DirectoryListingCache(object):
+    """
+    Cache rendered directory listings in memory.
+
+    A cached listing is used as long as the mtime of the directory is unchanged. Adding, removing or renaming an
+    entry updates the mtime of the directory and the listing is rendered again on the next request.
+
+    :param int max_entries: Maximum number of cached listings
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._listings = OrderedDict()
+
+    def get(self, path, render, key=None):
+        """
+        Get the listing of a directory. The render function is called with a list of os.DirEntry objects if the
+        listing is not cached or if the cached value is outdated.
+
+        :param str path: Path of the directory
+        :param render: Function to render the listing
+        :param key: Additional key, required if the rendered result does not only depend on the directory
+        :return: The rendered listing
+        :raises OSError: If the directory can not be accessed
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cache_key = (path, key)
+        listing = self._listings.get(cache_key)
+        if listing is not None and listing[0] == mtime:
+            self._listings.move_to_end(cache_key)
+            return listing[1]
+
+        value = render(scandir(path))
+
+        self._listings[cache_key] = (mtime, value)
+        self._listings.move_to_end(cache_key)
+        while len(self._listings) > self.max_entries:
+            self._listings.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._listings.clear()
+
+
+class TokenBucket(object):
+    """
+    Token bucket to limit the rate of requests.
+
+    :param float rate: Tokens added per second
+    :param float capacity: Max number of tokens, defaults to rate
+    """
+    def __init__(self, rate, capacity=None):
+        if capacity is None:
+            capacity = rate
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last_update = time.monotonic()
+
+    def _update(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_update) * self.rate)
+        self._last_update = now
+
+    def available(self):
+        """
+        :return: Number of available tokens
+        :rtype: int
+        """
+        self._update()
+        return int(self._tokens)
+
+    def consume(self, count=1):
+        """
+        Take tokens from the bucket.
+
+        :param int count: Number of tokens
+        :return: True if enough tokens were available
+        :rtype: bool
+        """
+        self._update()
+        if self._tokens < count:
+            return False
+        self._tokens -= count
+        return True
+
+    def drain(self):
+        """
+        Remove all tokens e.g. if the remote side reports a rate limit.
+        """
+        self._update()
+        self._tokens = 0.0
+
+
+class WorkerPool(object):
+    """
+    Run blocking functions on worker threads. The callback is invoked with the finished future in the main loop,
+    so it is safe to report incidents or access connections.
+
+    :param int max_workers: Maximum number of worker threads
+    """
+    def __init__(self, max_workers=2):
+        from dionaea import pyev
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._done = deque()
+        self._async = pyev.Async(pyev.default_loop(), self._handle_done)
+        self._async.start()
+
+    def submit(self, callback, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on a worker thread.
+
+        :param callback: Called with the future in the main loop, might be None
+        :param func: The function to run
+        :return: The future
+        :rtype: concurrent.futures.Future
+        """
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda f: self._finish(f, callback))
+        return future
+
+    def _finish(self, future, callback):
+        # Called in the worker thread, deque.append() is thread-safe
+        self._done.append((future, callback))
+        self._async.send()
+
+    def _handle_done(self, watcher, events):
+        while len(self._done) > 0:
+            future, callback = self._done.popleft()
+            if callback is None:
+                continue
+            try:
+                callback(future)
+            except Exception:
+                logger.error("Error in worker callback", exc_info=True)
+
+    def shutdown(self, wait=True):
+        self._async.stop()
+        self._executor.shutdown(wait=wait)
+
+
+_worker_pool = None
+
+
+def get_worker_pool():
+    """
+    Get the worker pool shared by all modules.
+
+    :return: The worker pool
+    :rtype: WorkerPool
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool()
+    return _worker_pool
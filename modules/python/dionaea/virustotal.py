@@ -27,9 +27,11 @@
 
 from dionaea import IHandlerLoader
 from dionaea.core import ihandler, incident, g_dionaea
+from dionaea.util import TokenBucket
 
 import logging
 import json
+import time
 import uuid
 import sqlite3
 from dionaea import pyev
@@ -52,17 +54,41 @@ class vtreport:
         self.md5hash = md5hash
         self.file = file
         self.status = status
+        self.start_time = time.monotonic()
+
 
 class virustotalhandler(ihandler):
+    # Process the backlog in this order, (status, query)
+    backlog_queries = (
+        # comment on files which were submitted at least 60 seconds ago
+        ("comment", """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'comment' AND submit_time < strftime("%s",'now')-1*60 ORDER BY submit_time LIMIT ?"""),
+        # try to receive reports for files we submitted
+        ("query", """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'query' AND submit_time < strftime("%s",'now')-15*60 AND lastcheck_time < strftime("%s",'now')-15*60 ORDER BY submit_time LIMIT ?"""),
+        # submit files not known to virustotal
+        ("submit", """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'submit' LIMIT ?"""),
+        # query new files
+        ("new", """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'new' ORDER BY timestamp DESC LIMIT ?"""),
+    )
+
     def __init__(self, path, config=None):
         logger.debug("%s ready!" % (self.__class__.__name__))
         ihandler.__init__(self, path)
         self.apikey = config.get("apikey")
+        self.url = config.get("url", "https://www.virustotal.com/vtapi/v2/")
+        if not self.url.endswith("/"):
+            self.url += "/"
         self.cookies = {}
         self.loop = pyev.default_loop()
 
+        self.max_concurrent = int(config.get("max_concurrent", 4))
+        self.request_timeout = int(config.get("request_timeout", 300))
+        rate_limit = config.get("rate_limit", {})
+        requests = float(rate_limit.get("requests", 4))
+        interval = float(rate_limit.get("interval", 60))
+        self.rate_limit = TokenBucket(requests / interval, capacity=requests)
+
         self.backlog_timer = pyev.Timer(
-            0, 20, self.loop, self.__handle_backlog_timeout)
+            0, float(config.get("interval", 5)), self.loop, self.__handle_backlog_timeout)
         self.backlog_timer.start()
         p = config.get("file")
         self.dbh = sqlite3.connect(p)
@@ -78,54 +104,77 @@ class virustotalhandler(ihandler):
                 lastcheck_time INTEGER,
                 submit_time INTEGER
             );""")
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS backlogfiles_status_submit_time_idx
+            ON backlogfiles (status, submit_time)""")
+        # Requests which were running while dionaea was stopped
+        self.cursor.execute("""
+            UPDATE backlogfiles SET status = substr(status, 1, length(status) - 1) WHERE status LIKE '%-'""")
+        self.dbh.commit()
 
     def __handle_backlog_timeout(self, watcher, event):
         logger.debug("backlog_timeout")
+        self.__expire_requests()
 
-        # try to comment on files
-        # comment on files which were submitted at least 60 seconds ago
-        sfs = self.cursor.execute(
-            """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'comment' AND submit_time < strftime("%s",'now')-1*60 LIMIT 1""")
-        for sf in sfs:
-            self.cursor.execute(
-                """UPDATE backlogfiles SET status = 'comment-' WHERE backlogfile = ?""", (sf[0],))
+        count = min(self.max_concurrent - len(self.cookies), self.rate_limit.available())
+        if count <= 0:
             self.dbh.commit()
-            self.make_comment(sf[0], sf[1], sf[2], 'comment')
             return
 
-        # try to receive reports for files we submitted
-        sfs = self.cursor.execute(
-            """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'query' AND submit_time < strftime("%s",'now')-15*60 AND lastcheck_time < strftime("%s",'now')-15*60 LIMIT 1""")
-        for sf in sfs:
+        # fetch the rows of all stages with one transaction
+        jobs = []
+        for status, query in self.backlog_queries:
+            if len(jobs) >= count:
+                break
+            for sf in self.cursor.execute(query, (count - len(jobs),)).fetchall():
+                jobs.append((status, sf))
+
+        self.cursor.executemany(
+            """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""",
+            [(status + "-", sf[0]) for status, sf in jobs]
+        )
+        self.dbh.commit()
+
+        for status, sf in jobs:
+            self.rate_limit.consume()
+            if status == "comment":
+                self.make_comment(sf[0], sf[1], sf[2], status)
+            elif status == "submit":
+                self.scan_file(sf[0], sf[1], sf[2], status)
+            else:
+                self.get_file_report(sf[0], sf[1], sf[2], status)
+
+    def __expire_requests(self):
+        # The upload request does not report failed requests, free the slot and retry later
+        now = time.monotonic()
+        for cookie, vtr in list(self.cookies.items()):
+            if vtr.start_time + self.request_timeout > now:
+                continue
+            logger.warning("Request for %s timed out", vtr.md5hash)
             self.cursor.execute(
-                """UPDATE backlogfiles SET status = 'query-' WHERE backlogfile = ?""", (sf[0],))
-            self.dbh.commit()
-            self.get_file_report(sf[0], sf[1], sf[2], 'query')
-            return
+                """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""", (vtr.status, vtr.backlogfile))
+            del self.cookies[cookie]
 
-        # submit files not known to virustotal
-        sfs = self.cursor.execute(
-            """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'submit' LIMIT 1""")
-        for sf in sfs:
-            self.cursor.execute(
-                """UPDATE backlogfiles SET status = 'submit-' WHERE backlogfile = ?""", (sf[0],))
+    def __finish_request(self, cookie):
+        del self.cookies[cookie]
+        # commit the status transitions of the batch
+        if len(self.cookies) == 0:
             self.dbh.commit()
-            self.scan_file(sf[0], sf[1], sf[2], 'submit')
-            return
 
-        # query new files
-        sfs = self.cursor.execute(
-            """SELECT backlogfile, md5_hash, path FROM backlogfiles WHERE status = 'new' ORDER BY timestamp DESC LIMIT 1""")
-        for sf in sfs:
-            self.cursor.execute(
-                """UPDATE backlogfiles SET status = 'new-' WHERE backlogfile = ?""", (sf[0],))
-            self.dbh.commit()
-            self.get_file_report(sf[0], sf[1], sf[2], 'new')
-            return
+    def __throttle(self, vtr):
+        logger.warn("api throttle")
+        self.rate_limit.drain()
+        self.cursor.execute(
+            """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""", (vtr.status, vtr.backlogfile))
+
+    def __load_response(self, icd):
+        with open(icd.path, mode='r') as f:
+            return json.load(f)
 
     def stop(self):
         self.backlog_timer.stop()
         self.backlog_timer = None
+        self.dbh.commit()
 
     def handle_incident(self, icd):
         pass
@@ -139,7 +188,7 @@ class virustotalhandler(ihandler):
         self.cookies[cookie] = vtreport(backlogfile, md5_hash, path, status)
 
         i = incident("dionaea.upload.request")
-        i._url = "https://www.virustotal.com/vtapi/v2/file/report"
+        i._url = self.url + "file/report"
         i.resource = md5_hash
         i.apikey = self.apikey
         i._callback = "dionaea.modules.python.virustotal.get_file_report"
@@ -147,17 +196,16 @@ class virustotalhandler(ihandler):
         i.report()
 
     def handle_incident_dionaea_modules_python_virustotal_get_file_report(self, icd):
-        f = open(icd.path, mode='r')
-        j = json.load(f)
-
         cookie = icd._userdata
-        vtr = self.cookies[cookie]
+        vtr = self.cookies.get(cookie)
+        if vtr is None:
+            # timed out
+            return
+
+        j = self.__load_response(icd)
 
         if j['response_code'] == -2:
-            logger.warn("api throttle")
-            self.cursor.execute(
-                """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""", (vtr.status, vtr.backlogfile))
-            self.dbh.commit()
+            self.__throttle(vtr)
         elif j['response_code'] == -1:
             logger.warn("something is wrong with your virustotal api key")
         elif j['response_code'] == 0: # file unknown
@@ -167,13 +215,11 @@ class virustotalhandler(ihandler):
                     """UPDATE backlogfiles SET status = 'submit', lastcheck_time = strftime("%s",'now') WHERE backlogfile = ?""", (vtr.backlogfile,))
             elif vtr.status == 'query':
                 self.cursor.execute(
-                    """UPDATE backlogfiles SET lastcheck_time = strftime("%s",'now') WHERE backlogfile = ?""", (vtr.backlogfile,))
-            self.dbh.commit()
+                    """UPDATE backlogfiles SET status = 'query', lastcheck_time = strftime("%s",'now') WHERE backlogfile = ?""", (vtr.backlogfile,))
         elif j['response_code'] == 1: # file known
             #            self.cursor.execute("""UPDATE backlogfiles SET status = 'comment', lastcheck_time = strftime("%s",'now') WHERE backlogfile = ?""", (vtr.backlogfile,))
             self.cursor.execute(
                 """DELETE FROM backlogfiles WHERE backlogfile = ?""", (vtr.backlogfile,) )
-            self.dbh.commit()
 
             logger.debug("report {}".format(j) )
 
@@ -183,14 +229,14 @@ class virustotalhandler(ihandler):
             i.report()
         else:
             logger.warn("virustotal reported {}".format(j))
-        del self.cookies[cookie]
+        self.__finish_request(cookie)
 
     def scan_file(self, backlogfile, md5_hash, path, status):
         cookie = str(uuid.uuid4())
         self.cookies[cookie] = vtreport(backlogfile, md5_hash, path, status)
 
         i = incident("dionaea.upload.request")
-        i._url = "https://www.virustotal.com/vtapi/v2/file/scan"
+        i._url = self.url + "file/scan"
         i.apikey = self.apikey
         i.set('file://file', path)
         i._callback = "dionaea.modules.python.virustotal_scan_file"
@@ -199,17 +245,16 @@ class virustotalhandler(ihandler):
 
 
     def handle_incident_dionaea_modules_python_virustotal_scan_file(self, icd):
-        f = open(icd.path, mode='r')
-        j = json.load(f)
-        logger.debug("scan_file {}".format(j))
         cookie = icd._userdata
-        vtr = self.cookies[cookie]
+        vtr = self.cookies.get(cookie)
+        if vtr is None:
+            return
+
+        j = self.__load_response(icd)
+        logger.debug("scan_file {}".format(j))
 
         if j['response_code'] == -2:
-            logger.warn("api throttle")
-            self.cursor.execute(
-                """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""", (vtr.status, vtr.backlogfile))
-            self.dbh.commit()
+            self.__throttle(vtr)
         elif j['response_code'] == -1:
             logger.warn("something is wrong with your virustotal api key")
         elif j['response_code'] == 1:
@@ -217,15 +262,14 @@ class virustotalhandler(ihandler):
             # recycle this entry for the query
             self.cursor.execute(
                 """UPDATE backlogfiles SET scan_id = ?, status = 'comment', submit_time = strftime("%s",'now') WHERE backlogfile = ?""", (scan_id, vtr.backlogfile,))
-            self.dbh.commit()
-        del self.cookies[cookie]
+        self.__finish_request(cookie)
 
     def make_comment(self, backlogfile, md5_hash, path, status):
         cookie = str(uuid.uuid4())
         self.cookies[cookie] = vtreport(backlogfile, md5_hash, path, status)
 
         i = incident("dionaea.upload.request")
-        i._url = "https://www.virustotal.com/vtapi/v2/comments/put"
+        i._url = self.url + "comments/put"
         i.apikey = self.apikey
         i.resource = md5_hash
         i.comment = "This sample was captured in the wild and uploaded by the dionaea honeypot.\n#honeypot #malware #networkworm"
@@ -235,22 +279,20 @@ class virustotalhandler(ihandler):
 
     def handle_incident_dionaea_modules_python_virustotal_make_comment(self, icd):
         cookie = icd._userdata
-        vtr = self.cookies[cookie]
-        f = open(icd.path, mode='r')
+        vtr = self.cookies.get(cookie)
+        if vtr is None:
+            return
+
         try:
-            j = json.load(f)
+            j = self.__load_response(icd)
             if j['response_code'] == -2:
-                logger.warn("api throttle")
-                self.cursor.execute(
-                    """UPDATE backlogfiles SET status = ? WHERE backlogfile = ?""", (vtr.status, vtr.backlogfile))
-                self.dbh.commit()
+                self.__throttle(vtr)
             elif j['response_code'] == -1:
                 logger.warn("something is wrong with your virustotal api key")
             elif j['response_code'] == 1:
                 self.cursor.execute(
                     """UPDATE backlogfiles SET status = 'query' WHERE backlogfile = ? """, (vtr.backlogfile, ))
-                self.dbh.commit()
 
         except Exception as e:
             pass
-        del self.cookies[cookie]
+        self.__finish_request(cookie)
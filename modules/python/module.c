@@ -66,6 +66,9 @@
 #include "processor.h"
 #include "util.h"
 #include "module.h"
+#include "dns.h"
+
+#include <udns.h>
 
 #define D_LOG_DOMAIN "python"
 PyObject *PyInit_core(void);
@@ -109,6 +112,12 @@ static struct python_runtime
 		struct processor processor;
 	} traceables;
 	GString *sys_path;
+	struct
+	{
+		struct ev_prepare release;
+		struct ev_check acquire;
+		PyThreadState *state;
+	} gil;
 } runtime;
 
 
@@ -123,6 +132,26 @@ struct import
 
 
 
+/*
+ * The GIL is released while the loop waits for events,
+ * so python worker threads can run while dionaea is idle.
+ * It is acquired again before any other watcher is invoked.
+ */
+static void python_gil_release_cb(EV_P_ struct ev_prepare *w, int revents)
+{
+	if( runtime.gil.state == NULL )
+		runtime.gil.state = PyEval_SaveThread();
+}
+
+static void python_gil_acquire_cb(EV_P_ struct ev_check *w, int revents)
+{
+	if( runtime.gil.state != NULL )
+	{
+		PyEval_RestoreThread(runtime.gil.state);
+		runtime.gil.state = NULL;
+	}
+}
+
 static bool config(void)
 {
 	// ToDo: Try to reload config
@@ -276,6 +305,9 @@ static bool freepy(void)
 {
 	g_debug("%s %s", __PRETTY_FUNCTION__, __FILE__);
 	ev_io_stop(g_dionaea->loop, &runtime.python_cli_io_in);
+	ev_prepare_stop(g_dionaea->loop, &runtime.gil.release);
+	ev_check_stop(g_dionaea->loop, &runtime.gil.acquire);
+	python_gil_acquire_cb(g_dionaea->loop, &runtime.gil.acquire, 0);
 	if( isatty(STDOUT_FILENO) )
 		tcsetattr(0, TCSADRAIN, &runtime.read_termios);
 
@@ -347,6 +379,7 @@ static bool new(struct dionaea *dionaea)
 	Py_SetProgramName(pybin);
 
 	Py_Initialize();
+	PyEval_InitThreads();
 
 	runtime.sys_path = g_string_new(PREFIX"/lib/dionaea/python/");
 
@@ -450,6 +483,15 @@ static bool new(struct dionaea *dionaea)
 
 	runtime.mkshell_ihandler = ihandler_new("dionaea.*.mkshell", python_mkshell_ihandler_cb, NULL);
 
+	// release the GIL as late as possible and acquire it before all other watchers
+	runtime.gil.state = NULL;
+	ev_prepare_init(&runtime.gil.release, python_gil_release_cb);
+	ev_set_priority(&runtime.gil.release, EV_MINPRI);
+	ev_prepare_start(g_dionaea->loop, &runtime.gil.release);
+	ev_check_init(&runtime.gil.acquire, python_gil_acquire_cb);
+	ev_set_priority(&runtime.gil.acquire, EV_MAXPRI);
+	ev_check_start(g_dionaea->loop, &runtime.gil.acquire);
+
 	g_hash_table_insert(g_dionaea->processors->names, (void *)proc_python_bistream.name, &proc_python_bistream);
 	return true;
 }
@@ -499,6 +541,80 @@ static int cmp_ifaddrs_by_ifa_name(const void *p1, const void *p2)
 	return strcmp((*(struct ifaddrs **)p1)->ifa_name, (*(struct ifaddrs **)p2)->ifa_name);
 }
 
+struct py_resolve_query
+{
+	char *hostname;
+	PyObject *callback;
+};
+
+static void py_resolve_a4_cb(struct dns_ctx *ctx, struct dns_rr_a4 *result, void *data)
+{
+	struct py_resolve_query *query = data;
+	g_debug("%s hostname %s result %p", __PRETTY_FUNCTION__, query->hostname, result);
+
+	PyObject *addresses = PyList_New(0);
+	if( result != NULL )
+	{
+		int i;
+		for( i=0; i<result->dnsa4_nrr; i++ )
+		{
+			char addr[INET6_ADDRSTRLEN];
+			inet_ntop(PF_INET, &result->dnsa4_addr[i], addr, INET6_ADDRSTRLEN);
+			PyObject *pyaddr = PyUnicode_FromString(addr);
+			PyList_Append(addresses, pyaddr);
+			Py_DECREF(pyaddr);
+		}
+		free(result);
+	}
+
+	PyObject *ret = PyObject_CallFunction(query->callback, "sO", query->hostname, addresses);
+	if( ret == NULL )
+		traceback();
+	else
+		Py_DECREF(ret);
+
+	Py_DECREF(addresses);
+	Py_DECREF(query->callback);
+	g_free(query->hostname);
+	g_free(query);
+}
+
+/*
+ * Resolve the IPv4 addresses of a hostname using udns without blocking the loop.
+ * args is a tuple (hostname, callback), callback(hostname, addresses) is
+ * called with an empty list of addresses if the lookup failed.
+ */
+PyObject *pyresolve(PyObject *self, PyObject *args)
+{
+	char *hostname;
+	PyObject *callback;
+
+	if( !PyArg_ParseTuple(args, "sO", &hostname, &callback) )
+		return NULL;
+
+	if( !PyCallable_Check(callback) )
+	{
+		PyErr_SetString(PyExc_TypeError, "callback must be callable");
+		return NULL;
+	}
+
+	struct py_resolve_query *query = g_malloc0(sizeof(struct py_resolve_query));
+	query->hostname = g_strdup(hostname);
+	query->callback = callback;
+	Py_INCREF(callback);
+
+	if( dns_submit_a4(g_dionaea->dns->dns, hostname, 0, py_resolve_a4_cb, query) == NULL )
+	{
+		Py_DECREF(callback);
+		g_free(query->hostname);
+		g_free(query);
+		PyErr_Format(PyExc_ValueError, "unable to submit dns query for %s", hostname);
+		return NULL;
+	}
+
+	Py_RETURN_NONE;
+}
+
 PyObject *pyversion(PyObject *self, PyObject *args)
 {
 #define DICT_SET_ITEM(d, k, v) \
@@ -45,6 +45,7 @@ void traceback(void);
 PyObject *pygetifaddrs(PyObject *self, PyObject *args);
 PyObject *py_config(PyObject *self, PyObject *args);
 PyObject *pyversion(PyObject *self, PyObject *args);
+PyObject *pyresolve(PyObject *self, PyObject *args);
 
 
 struct ihandler;
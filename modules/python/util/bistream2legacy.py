@@ -0,0 +1,76 @@
+#!/opt/dionaea/bin/python3
+#
+# Convert RTP bistream files written by the sip service into the legacy
+# 'stream = [...]' format.
+#
+
+import argparse
+import struct
+import sys
+
+MAGIC = b"DIONAEA-BISTREAM\x01"
+# direction (0 = in, 1 = out), timestamp, length of the payload
+FRAME_HEADER = struct.Struct("<BdI")
+DIRECTIONS = ("in", "out")
+
+
+class FormatError(Exception):
+    pass
+
+
+def read_frames(fp):
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise FormatError("not a bistream file")
+
+    while True:
+        header = fp.read(FRAME_HEADER.size)
+        if len(header) == 0:
+            return
+        if len(header) < FRAME_HEADER.size:
+            raise FormatError("truncated frame header")
+        direction, timestamp, length = FRAME_HEADER.unpack(header)
+        data = fp.read(length)
+        if len(data) < length:
+            raise FormatError("truncated frame")
+        yield DIRECTIONS[direction], timestamp, data
+
+
+def convert(filenames, out):
+    out.write("stream = [")
+    first = True
+    for filename in filenames:
+        with open(filename, "rb") as fp:
+            for direction, timestamp, data in read_frames(fp):
+                if not first:
+                    out.write(", ")
+                out.write(repr((direction, data)))
+                first = False
+    out.write("]")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert dionaea RTP bistream files into the legacy 'stream = [...]' format")
+    parser.add_argument(
+        "files", nargs="+", help="the bistream files, the parts of a rotated stream in order")
+    parser.add_argument(
+        "-o", "--output", help="write to this file instead of stdout")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    if args.output is not None:
+        out = open(args.output, "w")
+
+    try:
+        convert(args.files, out)
+    except (FormatError, OSError) as e:
+        print("Unable to convert: %s" % e, file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
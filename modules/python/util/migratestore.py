@@ -0,0 +1,117 @@
+#!/opt/dionaea/bin/python3
+#
+# Move the files of a flat download directory (<md5>) into the sharded
+# layout (ab/cd/<sha256>) used by the store ihandler and rebuild its index.
+#
+# Stop dionaea before running this script.
+#
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+INDEX_FILENAME = ".index"
+
+MD5_REGEX = re.compile(r"^[0-9a-f]{32}$")
+SHARDED_REGEX = re.compile(r"^([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}$")
+
+
+def sha256file(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        while True:
+            buf = fp.read(1024 * 1024)
+            if not buf:
+                break
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+def sharded_name(sha256):
+    return "/".join((sha256[0:2], sha256[2:4], sha256))
+
+
+def find_flat_files(path):
+    for name in sorted(os.listdir(path)):
+        filename = os.path.join(path, name)
+        if MD5_REGEX.match(name) and os.path.isfile(filename) and not os.path.islink(filename):
+            yield name
+
+
+def find_sharded_files(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), path)
+            if SHARDED_REGEX.match(name):
+                yield name
+
+
+def migrate(path, dry_run=False, verbose=False):
+    migrated = 0
+    duplicates = 0
+    for name in find_flat_files(path):
+        filename = os.path.join(path, name)
+        new_name = sharded_name(sha256file(filename))
+        new_filename = os.path.join(path, new_name)
+        if verbose:
+            print("%s -> %s" % (name, new_name))
+        if dry_run:
+            migrated += 1
+            continue
+
+        os.makedirs(os.path.dirname(new_filename), exist_ok=True)
+        if os.path.exists(new_filename):
+            # Already migrated, e.g. by an interrupted run
+            os.unlink(filename)
+            duplicates += 1
+            continue
+        os.rename(filename, new_filename)
+        migrated += 1
+
+    return migrated, duplicates
+
+
+def write_index(path, index_filename):
+    names = sorted(find_sharded_files(path))
+    tmp_filename = index_filename + ".tmp"
+    with open(tmp_filename, "w") as fp:
+        for name in names:
+            fp.write(name + "\n")
+    os.rename(tmp_filename, index_filename)
+    return len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate a flat dionaea download directory to the sharded layout")
+    parser.add_argument("path", help="the download directory e.g. /opt/dionaea/var/dionaea/binaries")
+    parser.add_argument(
+        "--index", help="the index file (default: <path>/%s)" % INDEX_FILENAME)
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="only print what would be done")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print every migrated file")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print("'%s' is not a directory" % args.path, file=sys.stderr)
+        return 1
+
+    index_filename = args.index
+    if index_filename is None:
+        index_filename = os.path.join(args.path, INDEX_FILENAME)
+
+    migrated, duplicates = migrate(args.path, dry_run=args.dry_run, verbose=args.verbose or args.dry_run)
+    print("migrated %i files, removed %i duplicates" % (migrated, duplicates))
+    if args.dry_run:
+        return 0
+
+    count = write_index(args.path, index_filename)
+    print("wrote %i entries to %s" % (count, index_filename))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
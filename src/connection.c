@@ -1246,30 +1246,41 @@ void connection_disconnect(struct connection *con)
  * @param size   length of the data
  *
  * @see connection_send_string
+ * @see connection_send_queue
  */
 void connection_send(struct connection *con, const void *data, uint32_t size)
 {
 	g_debug("%s con %p data %p size %i",__PRETTY_FUNCTION__, con, data, size);
 
+	connection_send_queue(con, data, size);
+	connection_send_flush(con);
+}
+
+/**
+ * Buffer something to send without flushing the buffer
+ * For udp connections every call queues one packet,
+ * use connection_send_flush to send all queued packets at once
+ *
+ * @param con    The connection
+ * @param data   The data to send
+ * @param size   length of the data
+ *
+ * @see connection_send_flush
+ */
+void connection_send_queue(struct connection *con, const void *data, uint32_t size)
+{
+	g_debug("%s con %p data %p size %i",__PRETTY_FUNCTION__, con, data, size);
+
 	switch( con->trans )
 	{
 	case connection_transport_tcp:
 		g_string_append_len(con->transport.tcp.io_out, (gchar *)data, size);
-		// flush as much as possible
-		// revents=0 indicates send() might return 0
-		// in this case we do not close & free the connection
-		if( con->state == connection_state_established && !connection_flag_isset(con, connection_busy_sending) )
-			connection_tcp_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
 		break;
 
 	case connection_transport_tls:
 		g_string_append_len(con->transport.tls.io_out, (gchar *)data, size);
-		// flush as much as possible
-		if( con->state == connection_state_established && !connection_flag_isset(con, connection_busy_sending) )
-			connection_tls_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
 		break;
 
-
 	case connection_transport_dtls:
 		{
 			int err = SSL_write(con->transport.dtls.ssl, data, size);
@@ -1285,7 +1296,6 @@ void connection_send(struct connection *con, const void *data, uint32_t size)
 			memcpy(&packet->to, &con->remote.addr, sizeof(struct sockaddr_storage));
 			memcpy(&packet->from, &con->local.addr, sizeof(struct sockaddr_storage));
 			con->transport.udp.io_out = g_list_append(con->transport.udp.io_out, packet);
-			connection_udp_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
 		}
 		break;
 	case connection_transport_io:
@@ -1293,6 +1303,44 @@ void connection_send(struct connection *con, const void *data, uint32_t size)
 	}
 }
 
+/**
+ * Send the data buffered by connection_send_queue
+ * does not block, flushes as much as possible
+ *
+ * @param con    The connection
+ *
+ * @see connection_send_queue
+ */
+void connection_send_flush(struct connection *con)
+{
+	g_debug("%s con %p",__PRETTY_FUNCTION__, con);
+
+	switch( con->trans )
+	{
+	case connection_transport_tcp:
+		// flush as much as possible
+		// revents=0 indicates send() might return 0
+		// in this case we do not close & free the connection
+		if( con->state == connection_state_established && !connection_flag_isset(con, connection_busy_sending) )
+			connection_tcp_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
+		break;
+
+	case connection_transport_tls:
+		// flush as much as possible
+		if( con->state == connection_state_established && !connection_flag_isset(con, connection_busy_sending) )
+			connection_tls_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
+		break;
+
+	case connection_transport_udp:
+		connection_udp_io_out_cb(g_dionaea->loop, &con->events.io_out, 0);
+		break;
+
+	case connection_transport_dtls:
+	case connection_transport_io:
+		break;
+	}
+}
+
 /**
  * Send a zero terminated string
  *
@@ -3449,62 +3497,87 @@ ssize_t recvfromto(int sockfd, void *buf, size_t len, int flags,
 	return rlen;
 }
 
-ssize_t sendtofrom(int fd, void *buf, size_t len, int flags, struct sockaddr *to, socklen_t tolen, struct sockaddr *from, socklen_t fromlen)
+/**
+ * Control message buffer large enough for IPv4 and IPv6 packet info
+ */
+union pktinfo_cbuf
 {
-	struct iovec iov[1];
-	struct msghdr msg;
+#if defined(SOL_IP) && defined(IP_PKTINFO)
+	char v4[CMSG_SPACE(sizeof(struct in_pktinfo))];
+#endif
+#if defined(SOL_IPV6) && defined(IPV6_PKTINFO)
+	char v6[CMSG_SPACE(sizeof(struct in6_pktinfo))];
+#endif
+	struct cmsghdr align;
+};
 
+/**
+ * Prepare a msghdr to send a packet with the given source address
+ *
+ * @param msg    The msghdr to fill
+ * @param iov    The io vector, must stay valid until the message is sent
+ * @param cbuf   The control message buffer, must stay valid until the message is sent
+ *
+ * @return 0 on success, -1 if the address family of from is not supported
+ */
+static int msghdr_init_from(struct msghdr *msg, struct iovec *iov, union pktinfo_cbuf *cbuf, void *buf, size_t len, int flags, struct sockaddr *to, socklen_t tolen, struct sockaddr *from)
+{
 	struct cmsghdr* cmsgptr;
-	cmsgptr = NULL;
-
-	iov[0].iov_base = buf;
-	iov[0].iov_len = len;
 
-	memset(&msg, 0, sizeof(msg));
-	msg.msg_name = (void *) to;
-	msg.msg_namelen = tolen;
-	msg.msg_iov = iov;
-	msg.msg_iovlen = 1;
-	msg.msg_flags = flags;
+	iov->iov_base = buf;
+	iov->iov_len = len;
 
+	memset(msg, 0, sizeof(struct msghdr));
+	msg->msg_name = (void *) to;
+	msg->msg_namelen = tolen;
+	msg->msg_iov = iov;
+	msg->msg_iovlen = 1;
+	msg->msg_flags = flags;
 
+	memset(cbuf, 0, sizeof(union pktinfo_cbuf));
 
 	if( from->sa_family == PF_INET )
 	{ /* IPv4 */
 #if defined(SOL_IP) && defined(IP_PKTINFO)
-		char cbuf[CMSG_SPACE(sizeof(struct in_pktinfo))];
-		memset(cbuf, 0, sizeof(cbuf));
-		msg.msg_control = cbuf;
-		msg.msg_controllen = sizeof(cbuf);
+		msg->msg_control = cbuf->v4;
+		msg->msg_controllen = sizeof(cbuf->v4);
 
-		cmsgptr = CMSG_FIRSTHDR(&msg);
+		cmsgptr = CMSG_FIRSTHDR(msg);
 		cmsgptr->cmsg_level = SOL_IP;
 		cmsgptr->cmsg_type = IP_PKTINFO;
 		cmsgptr->cmsg_len = CMSG_LEN(sizeof(struct in_pktinfo));
 		memcpy(&((struct in_pktinfo *)(CMSG_DATA(cmsgptr)))->ipi_spec_dst.s_addr, ADDROFFSET(from),  sizeof(struct in_addr) );
-		return sendmsg(fd, &msg, 0);
+		return 0;
 #endif
 	}else
 	if( from->sa_family == PF_INET6 )
 	{ /* IPv6 */
 #if defined(SOL_IPV6) && defined(IPV6_PKTINFO)
-		char cbuf[CMSG_SPACE(sizeof(struct in6_pktinfo))];
-		memset(cbuf, 0, sizeof(cbuf));
-		msg.msg_control = cbuf;
-		msg.msg_controllen = sizeof(cbuf);
+		msg->msg_control = cbuf->v6;
+		msg->msg_controllen = sizeof(cbuf->v6);
 
-		cmsgptr = CMSG_FIRSTHDR(&msg);
+		cmsgptr = CMSG_FIRSTHDR(msg);
 		cmsgptr->cmsg_level = SOL_IPV6;
 		cmsgptr->cmsg_type = IPV6_PKTINFO;
 		cmsgptr->cmsg_len = CMSG_LEN(sizeof(struct in6_pktinfo));
 		memcpy(&((struct in6_pktinfo *)(CMSG_DATA(cmsgptr)))->ipi6_addr, ADDROFFSET(from),  sizeof(struct in6_addr) );
-		return sendmsg(fd, &msg, 0);
+		return 0;
 #endif
-	}else
-	{
-		errno = EINVAL;
-		return -1;
 	}
+	errno = EINVAL;
+	return -1;
+}
+
+ssize_t sendtofrom(int fd, void *buf, size_t len, int flags, struct sockaddr *to, socklen_t tolen, struct sockaddr *from, socklen_t fromlen)
+{
+	struct iovec iov[1];
+	struct msghdr msg;
+	union pktinfo_cbuf cbuf;
+
+	if( msghdr_init_from(&msg, iov, &cbuf, buf, len, flags, to, tolen, from) == -1 )
+		return -1;
+
+	return sendmsg(fd, &msg, 0);
 }
 
 void connection_udp_io_in_cb(EV_P_ struct ev_io *w, int revents)
@@ -3576,16 +3649,101 @@ void connection_udp_io_in_cb(EV_P_ struct ev_io *w, int revents)
 	}
 }
 
+static socklen_t udp_packet_addr_size(struct udp_packet *packet)
+{
+	return ((struct sockaddr *)&packet->to)->sa_family == PF_INET ? sizeof(struct sockaddr_in) :
+		   ((struct sockaddr *)&packet->to)->sa_family == PF_INET6 ? sizeof(struct sockaddr_in6) :
+		   ((struct sockaddr *)&packet->to)->sa_family == AF_UNIX ? sizeof(struct sockaddr_un) : -1;
+}
+
+static void udp_packet_free(GList **packets, GList *elem)
+{
+	struct udp_packet *packet = elem->data;
+	g_string_free(packet->data, TRUE);
+	g_free(packet);
+	*packets = g_list_delete_link(*packets, elem);
+}
+
+#ifdef HAVE_SENDMMSG
+#define UDP_SENDMMSG_MAX 64
+
+/**
+ * Send the queued packets using sendmmsg
+ * up to UDP_SENDMMSG_MAX packets are sent with a single system call
+ *
+ * @return true if all packets have been processed,
+ *         false if the remaining packets have to be sent using sendtofrom
+ */
+static bool _connection_send_packets_mmsg(struct connection *con, int fd, GList **packets)
+{
+	struct mmsghdr msgs[UDP_SENDMMSG_MAX];
+	struct iovec iovs[UDP_SENDMMSG_MAX];
+	union pktinfo_cbuf cbufs[UDP_SENDMMSG_MAX];
+
+	while( *packets != NULL )
+	{
+		GList *elem;
+		unsigned int count = 0;
+
+		for( elem = g_list_first(*packets); elem != NULL && count < UDP_SENDMMSG_MAX; elem = g_list_next(elem) )
+		{
+			struct udp_packet *packet = elem->data;
+			socklen_t size = udp_packet_addr_size(packet);
+			if( msghdr_init_from(&msgs[count].msg_hdr, &iovs[count], &cbufs[count], packet->data->str, packet->data->len, 0, (struct sockaddr *)&packet->to, size, (struct sockaddr *)&packet->from) == -1 )
+				break;
+			msgs[count].msg_len = 0;
+			count++;
+		}
+
+		if( count == 0 )
+			/* let sendtofrom report the error for the first packet */
+			return false;
+
+		int ret = sendmmsg(fd, msgs, count, 0);
+		if( ret == -1 )
+		{
+			if( errno == EAGAIN || errno == EWOULDBLOCK )
+				return true;
+			if( errno == ENOSYS )
+				return false;
+			/* drop the first packet, the same way sendtofrom errors are handled */
+			g_warning("sendmmsg failed %s",  strerror(errno));
+			udp_packet_free(packets, g_list_first(*packets));
+			return true;
+		}
+
+		for( int i = 0; i < ret; i++ )
+		{
+			elem = g_list_first(*packets);
+			struct udp_packet *packet = elem->data;
+			if( con->type == connection_type_accept && con->processor_data != NULL )
+				processors_io_out(con, packet->data->str, packet->data->len);
+			if( msgs[i].msg_len != packet->data->len )
+				g_warning("sendmmsg sent %u of %u bytes", msgs[i].msg_len, (unsigned int)packet->data->len);
+			udp_packet_free(packets, elem);
+		}
+
+		if( (unsigned int)ret < count )
+			/* socket buffer is full, wait for io_out */
+			return true;
+	}
+	return true;
+}
+#endif
+
 void _connection_send_packets(struct connection *con, int fd, GList **packets)
 {
 	GList *elem;
 
+#ifdef HAVE_SENDMMSG
+	if( g_list_next(g_list_first(*packets)) != NULL && _connection_send_packets_mmsg(con, fd, packets) )
+		return;
+#endif
+
 	while( (elem = g_list_first(*packets)) != NULL )
 	{
 		struct udp_packet *packet = elem->data;
-		socklen_t size = ((struct sockaddr *)&packet->to)->sa_family == PF_INET ? sizeof(struct sockaddr_in) :
-						 ((struct sockaddr *)&packet->to)->sa_family == PF_INET6 ? sizeof(struct sockaddr_in6) :
-						 ((struct sockaddr *)&packet->to)->sa_family == AF_UNIX ? sizeof(struct sockaddr_un) : -1;
+		socklen_t size = udp_packet_addr_size(packet);
 
 		int ret;
 		/*
@@ -3613,23 +3771,17 @@ void _connection_send_packets(struct connection *con, int fd, GList **packets)
 			{
 				g_debug("domain %i size %i", ((struct sockaddr *)&packet->to)->sa_family, size);
 				g_warning("sendtofrom failed %s",  strerror(errno));
-				g_string_free(packet->data, TRUE);
-				g_free(packet);
-				*packets = g_list_delete_link(*packets, elem);
+				udp_packet_free(packets, elem);
 			}
 			break;
 		} else
 		if( ret == packet->data->len )
 		{
-			g_string_free(packet->data, TRUE);
-			g_free(packet);
-			*packets = g_list_delete_link(*packets, elem);
+			udp_packet_free(packets, elem);
 		} else
 		{
 			g_warning("sendtofrom failed %s",  strerror(errno));
-			g_string_free(packet->data, TRUE);
-			g_free(packet);
-			*packets = g_list_delete_link(*packets, elem);
+			udp_packet_free(packets, elem);
 			break;
 		}
 	}